@@ -0,0 +1,51 @@
+"""
+Time to import the handler in a fresh interpreter, with the slowest imports
+from its cold-start timeline, and the time to import runpod on top of it,
+which the worker does while ComfyUI boots.
+
+    python benchmarks/bench_cold_start.py --runs 5
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import rp_handler
+imported = time.perf_counter()
+import runpod
+done = time.perf_counter()
+print(json.dumps({
+    "handler_s": imported - start,
+    "runpod_s": done - imported,
+    "imports_ms": rp_handler.cold_start_timeline.report()["imports_ms"],
+}))
+"""
+
+
+def main(runs):
+    results = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, "-c", SCRIPT], cwd=SRC, capture_output=True, text=True, check=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    handler = min(result["handler_s"] for result in results)
+    runpod = min(result["runpod_s"] for result in results)
+    print(f"import rp_handler: {handler * 1000:7.1f}ms, then import runpod: {runpod * 1000:7.1f}ms")
+    slowest = list(results[-1]["imports_ms"].items())[:5]
+    print("slowest imports of the handler: " + ", ".join(f"{name} {ms:.1f}ms" for name, ms in slowest))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+    main(args.runs)
@@ -0,0 +1,81 @@
+"""
+Compare how long it takes to detect that a prompt is done when polling /history
+and when listening to the websocket of ComfyUI.
+
+Both paths run against the stand-in server in fake_comfy.py, so the numbers
+only show the overhead of the detection itself, not real render times.
+
+    python benchmarks/bench_completion.py --jobs 20 --render-time 0.5
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+
+WORKFLOW = {
+    "9": {
+        "inputs": {"filename_prefix": "ComfyUI", "images": ["8", 0]},
+        "class_type": "SaveImage",
+    }
+}
+
+
+def run_polling(render_time):
+    prompt_id = rp_handler.queue_workflow(WORKFLOW)["prompt_id"]
+    start = time.perf_counter()
+    rp_handler.wait_for_history_polling(prompt_id)
+    return time.perf_counter() - start - render_time
+
+
+def run_websocket(render_time):
+    client_id = str(uuid.uuid4())
+    ws = rp_handler.open_websocket(client_id)
+    try:
+        prompt_id = rp_handler.queue_workflow(WORKFLOW, client_id)["prompt_id"]
+        start = time.perf_counter()
+        rp_handler.wait_for_history_websocket(ws, prompt_id)
+        return time.perf_counter() - start - render_time
+    finally:
+        ws.close()
+
+
+def report(name, overheads, requests_made, jobs):
+    overheads_ms = sorted(o * 1000 for o in overheads)
+    p95 = overheads_ms[int(0.95 * (len(overheads_ms) - 1))]
+    print(
+        f"{name:<10} overhead mean {statistics.mean(overheads_ms):7.1f} ms"
+        f" | p50 {statistics.median(overheads_ms):7.1f} ms"
+        f" | p95 {p95:7.1f} ms"
+        f" | /history calls per job {requests_made / jobs:6.1f}"
+    )
+
+
+def main(jobs, render_time):
+    with FakeComfyServer(render_time=render_time) as server:
+        rp_handler.COMFY_HOST = server.address
+        print(
+            f"{jobs} jobs, render time {render_time}s, "
+            f"polling interval {rp_handler.COMFY_POLLING_INTERVAL_MS}ms"
+        )
+
+        for name, run in (("polling", run_polling), ("websocket", run_websocket)):
+            server.request_counts.clear()
+            overheads = [run(render_time) for _ in range(jobs)]
+            report(name, overheads, server.request_counts.get("history", 0), jobs)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--render-time", type=float, default=0.5)
+    args = parser.parse_args()
+    main(args.jobs, args.render_time)
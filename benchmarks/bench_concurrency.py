@@ -0,0 +1,101 @@
+"""
+Throughput of the worker when it runs one job at a time and when it runs
+several jobs at once (COMFY_MAX_CONCURRENT_JOBS), so that the inputs of the
+next job are uploaded while ComfyUI renders the current one.
+
+Runs against the stand-in server in fake_comfy.py, which renders one prompt
+at a time for a fixed time, like a single GPU. Every job uploads its own
+input images, which takes --upload-latency seconds per image. The jobs are
+handed to async_handler the way the runpod SDK does it, at most
+COMFY_MAX_CONCURRENT_JOBS at a time.
+
+    python benchmarks/bench_concurrency.py --jobs 20 --render-time 0.5 --concurrency 1 2 3
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+
+WORKFLOW = {
+    "3": {"inputs": {"image": "input.png"}, "class_type": "LoadImage"},
+    "9": {
+        "inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0]},
+        "class_type": "SaveImage",
+    },
+}
+
+
+def make_job(index, images_per_job):
+    images = [
+        {
+            "name": f"job{index}_{image_index}.png",
+            "image": base64.b64encode(os.urandom(64 * 1024)).decode("utf-8"),
+        }
+        for image_index in range(images_per_job)
+    ]
+    return {"id": f"job-{index}", "input": {"workflow": WORKFLOW, "images": images}}
+
+
+async def run_jobs(jobs, concurrency):
+    # The SDK never runs more jobs than the concurrency modifier allows
+    slots = asyncio.Semaphore(concurrency)
+
+    async def run(job):
+        async with slots:
+            return await rp_handler.async_handler(job)
+
+    return await asyncio.gather(*(run(job) for job in jobs))
+
+
+def main(jobs, render_time, upload_latency, images_per_job, concurrencies):
+    with FakeComfyServer(render_time=render_time, upload_latency=upload_latency) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # Every job has new images, keep them off the disk
+        rp_handler.input_store = None
+        rp_handler.comfy_readiness.wait_until_ready()
+        print(
+            f"{jobs} jobs, render time {render_time}s, "
+            f"{images_per_job} input images per job at {upload_latency}s each, "
+            f"COMFY_UPLOAD_CONCURRENCY={rp_handler.COMFY_UPLOAD_CONCURRENCY}"
+        )
+
+        for concurrency in concurrencies:
+            rp_handler.COMFY_MAX_CONCURRENT_JOBS = concurrency
+            rp_handler._job_executor = ThreadPoolExecutor(max_workers=concurrency)
+            batch = [make_job(index, images_per_job) for index in range(jobs)]
+
+            start = time.perf_counter()
+            results = asyncio.run(run_jobs(batch, concurrency))
+            elapsed = time.perf_counter() - start
+
+            failed = sum(1 for result in results if "error" in result)
+            print(
+                f"concurrency {concurrency}: {elapsed:6.2f}s"
+                f" | {jobs / elapsed:5.2f} jobs/s"
+                f" | GPU busy {jobs * render_time / elapsed * 100:5.1f}%"
+                f" | failed {failed}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=20)
+    parser.add_argument("--render-time", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.1)
+    parser.add_argument("--images-per-job", type=int, default=4)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 3])
+    args = parser.parse_args()
+    main(
+        args.jobs, args.render_time, args.upload_latency, args.images_per_job, args.concurrency
+    )
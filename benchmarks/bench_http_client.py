@@ -0,0 +1,82 @@
+"""
+Per-call latency of the HTTP calls to ComfyUI, with a new connection per call
+(like the handler did before) and with the pooled ComfyHttpClient.
+
+The history entry that is fetched contains the Jasper workflow, so that the
+JSON parsing is as expensive as for a real job.
+
+    python benchmarks/bench_http_client.py --calls 500
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+import urllib.request
+
+import requests
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.append(os.path.join(ROOT, "src"))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from comfy_http import ComfyHttpClient
+from fake_comfy import FakeComfyServer
+
+PROMPT_ID = "benchmark"
+
+
+def report(name, durations):
+    durations_ms = sorted(d * 1000 for d in durations)
+    p95 = durations_ms[int(0.95 * (len(durations_ms) - 1))]
+    print(
+        f"{name:<36} mean {statistics.mean(durations_ms):6.2f} ms"
+        f" | p50 {statistics.median(durations_ms):6.2f} ms"
+        f" | p95 {p95:6.2f} ms"
+    )
+
+
+def measure(call, calls):
+    durations = []
+    for _ in range(calls):
+        start = time.perf_counter()
+        call()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def main(calls):
+    with open(os.path.join(ROOT, "JasperAI_Runpod_Final_API.json")) as workflow_file:
+        workflow = json.load(workflow_file)
+
+    with FakeComfyServer() as server:
+        server.history[PROMPT_ID] = {
+            "prompt": [0, PROMPT_ID, workflow, {}, ["9"]],
+            "outputs": {"9": {"images": [{"filename": "a.png", "subfolder": "", "type": "output"}]}},
+            "status": {"status_str": "success", "completed": True, "messages": []},
+        }
+        index_url = f"http://{server.address}/"
+        history_url = f"http://{server.address}/history/{PROMPT_ID}"
+        client = ComfyHttpClient()
+
+        def urllib_history():
+            with urllib.request.urlopen(history_url) as response:
+                return json.loads(response.read())
+
+        print(f"{calls} calls per path against {server.address}")
+        report("before: requests.get /", measure(lambda: requests.get(index_url), calls))
+        report("after:  pooled client /", measure(lambda: client.get(index_url), calls))
+        report("before: urllib + json /history", measure(urllib_history, calls))
+        report(
+            "after:  pooled client /history",
+            measure(lambda: client.get_json(history_url), calls),
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--calls", type=int, default=500)
+    args = parser.parse_args()
+    main(args.calls)
@@ -0,0 +1,55 @@
+"""
+Cost of measuring a phase with JobTimings, enabled and disabled, and the
+timings of a job against the stand-in server in fake_comfy.py.
+
+    python benchmarks/bench_job_timings.py --iterations 1000000
+"""
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+from job_timings import JobTimings
+
+WORKFLOW = {
+    "3": {"inputs": {"seed": 1}, "class_type": "KSampler"},
+    "9": {"inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0]}, "class_type": "SaveImage"},
+}
+
+
+def measure(timings, iterations):
+    def phase():
+        with timings.phase("wait"):
+            pass
+
+    return min(timeit.repeat(phase, number=iterations, repeat=5)) / iterations
+
+
+def main(iterations):
+    baseline = min(timeit.repeat(lambda: None, number=iterations, repeat=5)) / iterations
+    for enabled in (False, True):
+        cost = measure(JobTimings(enabled), iterations) - baseline
+        print(f"{'enabled' if enabled else 'disabled':8s}: {cost * 1e6:6.3f}µs per phase")
+
+    with FakeComfyServer(render_time=0.2) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # The stand-in server has no /object_info
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.COMFY_JOB_TIMINGS = True
+        result = rp_handler.handler({"id": "bench", "input": {"workflow": WORKFLOW}})
+        print(f"timings of a job: {json.dumps(result['timings'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1000000)
+    args = parser.parse_args()
+    main(args.iterations)
@@ -0,0 +1,66 @@
+"""
+Cost of tracing a phase with JobTracer, and the time of a job with and
+without a trace against the stand-in server in fake_comfy.py.
+
+    python benchmarks/bench_job_trace.py --iterations 1000000 --jobs 20
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+from job_timings import JobTimings
+from job_trace import JobTracer
+
+WORKFLOW = {
+    "3": {"inputs": {"seed": 1}, "class_type": "KSampler"},
+    "9": {"inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0]}, "class_type": "SaveImage"},
+}
+
+
+def measure(timings, iterations):
+    def phase():
+        with timings.phase("wait"):
+            pass
+
+    return min(timeit.repeat(phase, number=iterations, repeat=5)) / iterations
+
+
+def main(iterations, jobs):
+    baseline = min(timeit.repeat(lambda: None, number=iterations, repeat=5)) / iterations
+    untraced = measure(JobTimings(), iterations) - baseline
+    traced = measure(JobTimings(tracer=JobTracer("bench")), iterations) - baseline
+    print(f"per phase: {untraced * 1e6:6.3f}µs timed, {traced * 1e6:6.3f}µs timed and traced")
+
+    with FakeComfyServer(render_time=0.05, node_time=0.01) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # The stand-in server has no /object_info
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.COMFY_TRACE_PATH = tempfile.mkdtemp()
+        rp_handler.comfy_readiness.wait_until_ready()
+
+        for percent in (0, 100):
+            rp_handler.COMFY_TRACE_SAMPLE_PERCENT = percent
+            start = time.perf_counter()
+            for index in range(jobs):
+                result = rp_handler.handler({"id": f"bench-{index}", "input": {"workflow": WORKFLOW}})
+            elapsed = (time.perf_counter() - start) / jobs
+            print(f"{percent:3d}% traced: {elapsed * 1000:7.2f}ms per job")
+        print(f"last trace: {result['trace_path']}, open it in https://ui.perfetto.dev")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=1000000)
+    parser.add_argument("--jobs", type=int, default=20)
+    args = parser.parse_args()
+    main(args.iterations, args.jobs)
@@ -0,0 +1,63 @@
+"""
+Cost of recording a metric, on one thread and on several threads at the
+same time, compared with a counter behind a lock.
+
+    python benchmarks/bench_metrics.py --iterations 200000 --threads 8
+"""
+
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+
+from metrics import Counter, Histogram
+
+
+class LockedCounter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.value += amount
+
+
+def run(record, iterations, threads):
+    def work():
+        for _ in range(iterations):
+            record()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return (time.perf_counter() - start) / (iterations * threads)
+
+
+def main(iterations, threads):
+    counter = Counter("jobs_total", "Jobs", ("status",))
+    histogram = Histogram("phase_seconds", "Phases", ("phase",))
+    locked = LockedCounter()
+    recorders = {
+        "counter": lambda: counter.inc(1, "success"),
+        "histogram": lambda: histogram.observe(0.3, "wait"),
+        "locked counter": lambda: locked.inc(1, "success"),
+    }
+    for name, record in recorders.items():
+        single = run(record, iterations, 1)
+        parallel = run(record, iterations, threads)
+        print(f"{name:14s}: {single * 1e6:6.3f}µs on 1 thread, {parallel * 1e6:6.3f}µs on {threads} threads")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--iterations", type=int, default=200000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+    main(args.iterations, args.threads)
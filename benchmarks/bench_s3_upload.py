@@ -0,0 +1,105 @@
+"""
+Throughput and peak memory of uploading output images to S3, the old way
+(new boto client per image, whole file read into memory, one put_object) and
+with the cached client and managed transfer of rp_handler.upload_image.
+
+Every upload runs in a fresh subprocess, so that the peak RSS of one run
+doesn't hide the next one. The uploads go to the stand-in in fake_s3.py.
+
+    python benchmarks/bench_s3_upload.py --sizes 1 10 50 --uploads 5
+"""
+
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from fake_s3 import FakeS3Server
+
+
+def max_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def upload_old(rp_upload, image_location, uploads):
+    for _ in range(uploads):
+        boto_client, _ = rp_upload.get_boto_client()
+        with open(image_location, "rb") as input_file:
+            output = input_file.read()
+        boto_client.put_object(
+            Bucket="benchmark", Key="image.png", Body=output, ContentType="image/png"
+        )
+        boto_client.generate_presigned_url(
+            "get_object", Params={"Bucket": "benchmark", "Key": "image.png"}, ExpiresIn=604800
+        )
+        del output
+
+
+def upload_new(rp_handler, image_location, uploads):
+    for _ in range(uploads):
+        rp_handler.upload_image("benchmark", image_location, bucket_name="benchmark")
+
+
+def run_worker(mode, image_location, uploads):
+    """Runs in the subprocess, prints "<seconds> <peak RSS growth in MB>"."""
+    # Import everything up front, so only the upload itself counts, rp_upload imports boto3 in both modes
+    import rp_handler
+    from runpod.serverless.utils import rp_upload
+
+    rss_before = max_rss_mb()
+    start = time.perf_counter()
+    if mode == "old":
+        upload_old(rp_upload, image_location, uploads)
+    else:
+        upload_new(rp_handler, image_location, uploads)
+    print(f"{time.perf_counter() - start} {max_rss_mb() - rss_before}")
+
+
+def main(sizes, uploads):
+    with FakeS3Server() as server, tempfile.TemporaryDirectory() as folder:
+        env = {
+            **os.environ,
+            "BUCKET_ENDPOINT_URL": server.endpoint_url,
+            "BUCKET_ACCESS_KEY_ID": "benchmark",
+            "BUCKET_SECRET_ACCESS_KEY": "benchmark",
+        }
+        print(f"{uploads} uploads per size against {server.endpoint_url}")
+
+        for size in sizes:
+            image_location = os.path.join(folder, f"{size}mb.png")
+            with open(image_location, "wb") as image_file:
+                image_file.write(os.urandom(size * 1024 * 1024))
+
+            for mode in ("old", "new"):
+                output = subprocess.run(
+                    [sys.executable, __file__, "--worker", mode, image_location, str(uploads)],
+                    env=env,
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                ).stdout
+                seconds, rss_mb = map(float, output.strip().splitlines()[-1].split())
+                throughput = size * uploads / seconds
+                print(
+                    f"{size:>3} MB {mode}: {throughput:7.1f} MB/s"
+                    f" | {seconds / uploads * 1000:7.1f} ms per upload"
+                    f" | peak RSS +{rss_mb:6.1f} MB"
+                )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == "--worker":
+        run_worker(sys.argv[2], sys.argv[3], int(sys.argv[4]))
+        sys.exit(0)
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 5, 10, 25, 50])
+    parser.add_argument("--uploads", type=int, default=5)
+    args = parser.parse_args()
+    main(args.sizes, args.uploads)
@@ -0,0 +1,72 @@
+"""
+Time until the next job is done when the job before it timed out, with the
+prompt of the timed out job left running on the GPU and with it cancelled.
+
+Runs against the stand-in server in fake_comfy.py, which renders one prompt
+at a time. The first job renders a workflow with --nodes nodes of
+--node-time seconds each, but has a timeout_s of --timeout. The second job
+renders a single node and has to wait for the GPU until the first prompt is
+done or interrupted.
+
+    python benchmarks/bench_timeout.py --nodes 20 --node-time 0.5 --timeout 1
+"""
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+
+
+def make_workflow(nodes):
+    workflow = {str(node): {"inputs": {"seed": node}, "class_type": "KSampler"} for node in range(1, nodes)}
+    workflow[str(nodes)] = {"inputs": {"filename_prefix": "ComfyUI"}, "class_type": "SaveImage"}
+    return workflow
+
+
+def main(nodes, node_time, timeout):
+    stuck = {"workflow": make_workflow(nodes), "timeout_s": timeout}
+    quick = {"workflow": make_workflow(1)}
+    cancel_prompts = rp_handler.cancel_prompts
+
+    with FakeComfyServer(render_time=0.1, node_time=node_time) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # The stand-in server has no /object_info
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.COMFY_OPTIMIZE_WORKFLOW = False
+        rp_handler.comfy_readiness.wait_until_ready()
+        print(f"a prompt of {nodes * node_time:.1f}s with a timeout of {timeout}s, then a prompt of {node_time + 0.1:.1f}s")
+
+        for cancel in (False, True):
+            # Without cancellation the prompt keeps the GPU busy, like before the deadlines
+            rp_handler.cancel_prompts = cancel_prompts if cancel else lambda prompt_ids: None
+
+            start = time.perf_counter()
+            timed_out = rp_handler.handler({"id": "stuck", "input": stuck})
+            returned = time.perf_counter() - start
+            result = rp_handler.handler({"id": "next", "input": quick})
+            elapsed = time.perf_counter() - start
+
+            print(
+                f"{'cancelled' if cancel else 'left running':12s}: timed out after {returned:5.2f}s"
+                f" | next job done after {elapsed:5.2f}s ({result.get('status') or result.get('error')})"
+            )
+            assert "timed out" in timed_out.get("error", "")
+            # Let the prompt that was left running finish before the next round
+            while server.running or server.pending:
+                time.sleep(0.05)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--nodes", type=int, default=20)
+    parser.add_argument("--node-time", type=float, default=0.5)
+    parser.add_argument("--timeout", type=float, default=1.0)
+    args = parser.parse_args()
+    main(args.nodes, args.node_time, args.timeout)
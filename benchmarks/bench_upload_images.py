@@ -0,0 +1,67 @@
+"""
+Time upload_images for a Jasper-sized set of input images with different
+values of COMFY_UPLOAD_CONCURRENCY, and with COMFY_INPUT_STAGING=filesystem.
+
+The stand-in server adds a fixed latency to every upload, like a busy ComfyUI.
+
+    python benchmarks/bench_upload_images.py --images 26 --size-kb 512 --latency 0.05
+"""
+
+import argparse
+import base64
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+
+
+def main(image_count, size_kb, latency, concurrencies, rounds):
+    images = [
+        {
+            "name": f"input_{i}.png",
+            "image": base64.b64encode(os.urandom(size_kb * 1024)).decode("utf-8"),
+        }
+        for i in range(image_count)
+    ]
+
+    with FakeComfyServer(upload_latency=latency) as server:
+        rp_handler.COMFY_HOST = server.address
+        print(
+            f"{image_count} images of {size_kb} KB, {latency * 1000:.0f} ms latency per upload"
+        )
+
+        def run(name):
+            durations = []
+            for _ in range(rounds):
+                start = time.perf_counter()
+                result = rp_handler.upload_images(images)
+                durations.append(time.perf_counter() - start)
+                assert result["status"] == "success", result
+            print(f"{name:<26}: {min(durations) * 1000:8.1f} ms (best of {rounds})")
+
+        rp_handler.COMFY_INPUT_STAGING = "http"
+        for concurrency in concurrencies:
+            rp_handler.COMFY_UPLOAD_CONCURRENCY = concurrency
+            run(f"http, concurrency {concurrency}")
+
+        with tempfile.TemporaryDirectory() as input_path:
+            rp_handler.COMFY_INPUT_STAGING = "filesystem"
+            rp_handler.COMFY_INPUT_PATH = input_path
+            run(f"filesystem, concurrency {concurrency}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--images", type=int, default=26)
+    parser.add_argument("--size-kb", type=int, default=512)
+    parser.add_argument("--latency", type=float, default=0.05)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8])
+    parser.add_argument("--rounds", type=int, default=3)
+    args = parser.parse_args()
+    main(args.images, args.size_kb, args.latency, args.concurrency, args.rounds)
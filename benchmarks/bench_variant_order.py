@@ -0,0 +1,75 @@
+"""
+Time and cache hit ratio of a batch of variants of the Jasper colour workflow
+in the order they were sent and in the order of the VariantScheduler.
+
+Runs against the stand-in server in fake_comfy.py with --cache-nodes, which
+skips the nodes that are unchanged since the previous prompt like ComfyUI,
+and charges --node-time seconds for every other node. The variants cover
+every combination of the tokens, vases and creative modes, shuffled.
+
+    python benchmarks/bench_variant_order.py --tokens Rabbit Fox Owl --node-time 0.02
+"""
+
+import argparse
+import itertools
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+from variant_scheduler import VariantScheduler
+
+WORKFLOW_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "JasperAI_Runpod_Final_ColorTest_New_API_V2.json"
+)
+
+
+def main(tokens, node_time, seed):
+    with open(WORKFLOW_PATH) as workflow_file:
+        workflow = json.load(workflow_file)
+    variants = [
+        {"PromptTokenInput": token, "WhatVase?": vase, "IsCreative?": creative, "GlobalSeed": 1}
+        for token, vase, creative in itertools.product(tokens, [1, 2, 3, 4], [1, 2])
+    ]
+    random.Random(seed).shuffle(variants)
+
+    with FakeComfyServer(render_time=0, node_time=node_time, cache_nodes=True) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # The stand-in server has no /object_info
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.comfy_readiness.wait_until_ready()
+        print(f"{len(variants)} variants, {node_time}s per node that isn't cached")
+
+        for ordered in (False, True):
+            rp_handler.COMFY_ORDER_VARIANTS = ordered
+            # Every run starts from an empty cache
+            rp_handler.variant_scheduler = VariantScheduler()
+            server._previous_signatures = set()
+
+            start = time.perf_counter()
+            result = rp_handler.handler(
+                {"id": "bench", "input": {"workflow": workflow, "variants": variants}}
+            )
+            elapsed = time.perf_counter() - start
+
+            ratio = result["cache_hit_ratio"]
+            print(
+                f"{'scheduled' if ordered else 'as sent':9s}: {elapsed:6.2f}s"
+                f" | cache hit ratio expected {ratio['expected']:.3f}, observed {ratio['observed']:.3f}"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--tokens", nargs="+", default=["Rabbit", "Fox", "Owl"])
+    parser.add_argument("--node-time", type=float, default=0.02)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+    main(args.tokens, args.node_time, args.seed)
@@ -0,0 +1,91 @@
+"""
+Time to render N variants of a workflow as N separate jobs, one after the
+other, and as a single job with N "variants".
+
+Runs against the stand-in server in fake_comfy.py, which renders one prompt
+at a time for a fixed time, like a single GPU. Every job uploads the same
+input images, which takes --upload-latency seconds per image, and pays
+--job-overhead seconds for the request to RunPod. A batch uploads the images
+once and queues all variants back to back, so the GPU doesn't wait for the
+next job in between.
+
+    python benchmarks/bench_variants.py --variants 20 --render-time 0.5
+"""
+
+import argparse
+import base64
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+
+WORKFLOW = {
+    "3": {"inputs": {"image": "input.png"}, "class_type": "LoadImage"},
+    "552": {"inputs": {"value": 1}, "class_type": "INTConstant", "_meta": {"title": "WhatVase?"}},
+    "9": {
+        "inputs": {"filename_prefix": "ComfyUI", "images": ["3", 0], "vase": ["552", 0]},
+        "class_type": "SaveImage",
+    },
+}
+
+
+def main(variants, render_time, upload_latency, images_per_job, job_overhead):
+    images = [
+        {"name": f"input_{index}.png", "image": base64.b64encode(os.urandom(64 * 1024)).decode("utf-8")}
+        for index in range(images_per_job)
+    ]
+    params = [{"WhatVase?": index % 4 + 1} for index in range(variants)]
+
+    with FakeComfyServer(render_time=render_time, upload_latency=upload_latency) as server:
+        rp_handler.COMFY_HOST = server.address
+        os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+        # Every job sends its images again, keep them off the disk
+        rp_handler.input_store = None
+        # The stand-in server has no /object_info
+        rp_handler.COMFY_VALIDATE_WORKFLOW = False
+        rp_handler.comfy_readiness.wait_until_ready()
+        print(
+            f"{variants} variants, render time {render_time}s, {images_per_job} input images "
+            f"at {upload_latency}s each, {job_overhead}s overhead per job"
+        )
+
+        start = time.perf_counter()
+        for index, variant in enumerate(params):
+            time.sleep(job_overhead)
+            rp_handler.handler(
+                {"id": f"job-{index}", "input": {"workflow": WORKFLOW, "params": variant, "images": images}}
+            )
+        separate = time.perf_counter() - start
+
+        start = time.perf_counter()
+        time.sleep(job_overhead)
+        result = rp_handler.handler(
+            {"id": "batch", "input": {"workflow": WORKFLOW, "variants": params, "images": images}}
+        )
+        batch = time.perf_counter() - start
+
+        failed = sum(1 for variant in result["variants"] if variant["status"] != "success")
+        for name, elapsed in (("separate jobs", separate), ("one batch", batch)):
+            print(
+                f"{name:13s}: {elapsed:6.2f}s | {variants / elapsed:5.2f} variants/s"
+                f" | GPU busy {variants * render_time / elapsed * 100:5.1f}%"
+            )
+        print(f"failed variants in the batch: {failed}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--variants", type=int, default=20)
+    parser.add_argument("--render-time", type=float, default=0.5)
+    parser.add_argument("--upload-latency", type=float, default=0.1)
+    parser.add_argument("--images-per-job", type=int, default=2)
+    parser.add_argument("--job-overhead", type=float, default=0.1)
+    args = parser.parse_args()
+    main(
+        args.variants, args.render_time, args.upload_latency, args.images_per_job, args.job_overhead
+    )
@@ -0,0 +1,72 @@
+"""
+Time of the first job of a worker with and without a warmup of the Jasper
+colour workflow, against the stand-in server in fake_comfy.py.
+
+The stand-in server charges --load-time seconds for the first node of every
+class_type, like ComfyUI loading the model of a checkpoint, LoRA or
+ControlNet loader, and --node-time seconds for every node. Every run starts
+with a fresh server.
+
+    python benchmarks/bench_warmup.py --load-time 0.2 --node-time 0.005
+"""
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+from readiness import ComfyReadiness
+
+WORKFLOW_PATH = os.path.join(
+    os.path.dirname(__file__), "..", "JasperAI_Runpod_Final_ColorTest_New_API_V2.json"
+)
+
+
+def main(load_time, node_time):
+    with open(WORKFLOW_PATH) as workflow_file:
+        workflow = json.load(workflow_file)
+    job_input = {"workflow": workflow, "params": {"PromptTokenInput": "Rabbit", "GlobalSeed": 7}}
+    # The stand-in server has no /object_info
+    rp_handler.COMFY_VALIDATE_WORKFLOW = False
+    # A warmup is a job input, with the same workflow as the job
+    warmup_file = tempfile.NamedTemporaryFile("w", suffix=".json", delete=False)
+    with warmup_file:
+        json.dump({"input": job_input}, warmup_file)
+    rp_handler.COMFY_WARMUP_WORKFLOWS = [warmup_file.name]
+
+    for warm in (False, True):
+        with FakeComfyServer(render_time=0, node_time=node_time, load_time=load_time) as server:
+            rp_handler.COMFY_HOST = server.address
+            os.environ["COMFY_OUTPUT_PATH"] = server.output_dir
+            rp_handler.comfy_readiness = ComfyReadiness(
+                rp_handler.wait_for_comfy_boot, lambda: rp_handler.check_server(f"http://{server.address}", 1, 0)
+            )
+
+            start = time.perf_counter()
+            if warm:
+                rp_handler.boot_comfy()
+            warmup = time.perf_counter() - start
+
+            start = time.perf_counter()
+            result = rp_handler.handler({"id": "bench", "input": job_input})
+            first_job = time.perf_counter() - start
+            print(
+                f"{'warm' if warm else 'cold'}: warmup {warmup:6.2f}s, first job {first_job:6.2f}s"
+                f" ({result.get('status', result.get('error'))})"
+            )
+    os.unlink(warmup_file.name)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--load-time", type=float, default=0.2)
+    parser.add_argument("--node-time", type=float, default=0.005)
+    args = parser.parse_args()
+    main(args.load_time, args.node_time)
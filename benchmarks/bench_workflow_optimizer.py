@@ -0,0 +1,73 @@
+"""
+Node count and queue-to-done time of the JasperAI workflows in the root of
+the repo, as they are and after optimize_workflow() folded their switches
+and dropped the branches they don't select.
+
+Runs against the stand-in server in fake_comfy.py, where every node of a
+prompt takes --node-time seconds on top of the fixed render time, like the
+validation and the LoadImage nodes of ComfyUI. The optimizer itself is
+timed separately, it runs in the handler before the workflow is queued.
+
+    python benchmarks/bench_workflow_optimizer.py --jobs 5 --node-time 0.01
+"""
+
+import argparse
+import glob
+import json
+import os
+import statistics
+import sys
+import time
+import uuid
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+import rp_handler
+from fake_comfy import FakeComfyServer
+from workflow_optimizer import optimize_workflow
+
+ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+
+
+def queue_to_done(workflow):
+    client_id = str(uuid.uuid4())
+    ws = rp_handler.open_websocket(client_id)
+    try:
+        start = time.perf_counter()
+        prompt_id = rp_handler.queue_workflow(workflow, client_id)["prompt_id"]
+        rp_handler.wait_for_history_websocket(ws, prompt_id)
+        return time.perf_counter() - start
+    finally:
+        ws.close()
+
+
+def main(jobs, render_time, node_time):
+    with FakeComfyServer(render_time=render_time, node_time=node_time) as server:
+        rp_handler.COMFY_HOST = server.address
+        print(f"{jobs} jobs per workflow, render time {render_time}s, {node_time}s per node")
+
+        for path in sorted(glob.glob(os.path.join(ROOT, "JasperAI_*_API*.json"))):
+            with open(path) as workflow_file:
+                workflow = json.load(workflow_file)
+
+            start = time.perf_counter()
+            optimized = optimize_workflow(workflow)
+            optimize_ms = (time.perf_counter() - start) * 1000
+
+            before = statistics.median(queue_to_done(workflow) for _ in range(jobs))
+            after = statistics.median(queue_to_done(optimized) for _ in range(jobs))
+            print(
+                f"{os.path.basename(path)}: {len(workflow):3d} -> {len(optimized):3d} nodes"
+                f" | {before:6.3f}s -> {after:6.3f}s"
+                f" | optimizer {optimize_ms:5.2f}ms"
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--jobs", type=int, default=5)
+    parser.add_argument("--render-time", type=float, default=0.5)
+    parser.add_argument("--node-time", type=float, default=0.01)
+    args = parser.parse_args()
+    main(args.jobs, args.render_time, args.node_time)
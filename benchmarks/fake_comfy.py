@@ -0,0 +1,358 @@
+"""
+A local stand-in for the ComfyUI server, used by the benchmarks in this folder.
+
+It implements the parts of the ComfyUI HTTP and websocket API that
+rp_handler.py talks to. Queued prompts are "rendered" one after the other,
+like on a single GPU, by sleeping for a fixed time, during which the usual websocket events are sent to the client that
+queued the prompt. Finished prompts are written into the history and a blank
+PNG is written to the output folder. Prompts can be deleted from the queue and
+interrupted like in ComfyUI.
+
+Run it standalone with:
+
+    python benchmarks/fake_comfy.py --port 8188 --render-time 2.0
+"""
+
+import argparse
+import asyncio
+import base64
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+from aiohttp import web, WSMsgType
+
+# A 1x1 transparent PNG
+BLANK_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAQAAAC1HAwCAAAAC0lEQVR42mNkYAAAAAYAAjCB0C8AAAAASUVORK5CYII="
+)
+
+
+class FakeComfyServer:
+    """
+    Stand-in ComfyUI server running an aiohttp app on a background thread.
+
+    Args:
+        host (str): The interface to bind to
+        port (int): The port to bind to, 0 picks a free port
+        render_time (float): Seconds each prompt takes to "render"
+        output_dir (str, optional): Where to write the generated images
+        upload_latency (float): Seconds each image upload takes
+        node_time (float): Seconds each node of a prompt takes on top of the render time,
+            like validating it and loading its inputs
+        cache_nodes (bool): Skip the nodes that are unchanged since the previous prompt and
+            report them in "execution_cached", like the cache of ComfyUI
+        load_time (float): Seconds the first node of every class_type takes on top, like loading its model
+    """
+
+    # How many "progress" events are sent per node
+    STEPS = 4
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        render_time=1.0,
+        output_dir=None,
+        upload_latency=0.0,
+        node_time=0.0,
+        cache_nodes=False,
+        load_time=0.0,
+    ):
+        self.host = host
+        self.port = port
+        self.render_time = render_time
+        self.upload_latency = upload_latency
+        self.node_time = node_time
+        self.cache_nodes = cache_nodes
+        self.load_time = load_time
+        self._loaded_classes = set()
+        self._previous_signatures = set()
+        self.output_dir = output_dir or tempfile.mkdtemp(prefix="fake-comfy-output-")
+        self.history = {}
+        self.sockets = {}
+        # The names of the uploaded input images
+        self.inputs = set()
+        # The prompts waiting for the GPU, the one that renders and the task of each
+        self.pending = []
+        self.running = None
+        self._tasks = {}
+        self.request_counts = {}
+        self._loop = None
+        self._runner = None
+        self._gpu = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def address(self):
+        """The host:port the server is listening on, like COMFY_HOST"""
+        return f"{self.host}:{self.port}"
+
+    def _count(self, name):
+        self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    async def _index(self, request):
+        self._count("index")
+        return web.Response(text="ComfyUI")
+
+    async def _prompt(self, request):
+        self._count("prompt")
+        body = await request.json()
+        prompt_id = str(uuid.uuid4())
+        self.pending.append(prompt_id)
+        self._tasks[prompt_id] = asyncio.ensure_future(
+            self._render(prompt_id, body.get("prompt", {}), body.get("client_id"))
+        )
+        return web.json_response({"prompt_id": prompt_id, "number": 0, "node_errors": {}})
+
+    async def _history(self, request):
+        self._count("history")
+        prompt_id = request.match_info["prompt_id"]
+        if prompt_id in self.history:
+            return web.json_response({prompt_id: self.history[prompt_id]})
+        return web.json_response({})
+
+    async def _queue(self, request):
+        self._count("queue")
+        return web.json_response(
+            {
+                "queue_running": [[0, self.running, {}, {}, []]] if self.running else [],
+                "queue_pending": [
+                    [number, prompt_id, {}, {}, []] for number, prompt_id in enumerate(self.pending, 1)
+                ],
+            }
+        )
+
+    async def _delete_from_queue(self, request):
+        self._count("delete_from_queue")
+        body = await request.json()
+        for prompt_id in body.get("delete", []):
+            if prompt_id in self.pending:
+                self._tasks[prompt_id].cancel()
+        return web.Response()
+
+    async def _interrupt(self, request):
+        self._count("interrupt")
+        body = await request.json() if request.can_read_body else {}
+        prompt_id = body.get("prompt_id") or self.running
+        if prompt_id is not None and prompt_id == self.running:
+            self._tasks[prompt_id].cancel()
+        return web.Response()
+
+    async def _upload_image(self, request):
+        self._count("upload_image")
+        form = await request.post()
+        image = form["image"]
+        await asyncio.sleep(self.upload_latency)
+        self.inputs.add(image.filename)
+        return web.json_response({"name": image.filename, "subfolder": "", "type": "input"})
+
+    async def _view(self, request):
+        self._count("view")
+        name = request.query.get("filename", "")
+        if request.query.get("type") != "input" or name not in self.inputs:
+            return web.Response(status=404)
+        return web.Response(body=b"", content_type="image/png")
+
+    async def _ws(self, request):
+        self._count("ws")
+        client_id = request.query.get("clientId") or uuid.uuid4().hex
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets[client_id] = ws
+        await ws.send_json(
+            {"type": "status", "data": {"status": {"exec_info": {"queue_remaining": 0}}, "sid": client_id}}
+        )
+        try:
+            async for message in ws:
+                if message.type == WSMsgType.ERROR:
+                    break
+        finally:
+            self.sockets.pop(client_id, None)
+        return ws
+
+    async def _send(self, client_id, event_type, data):
+        ws = self.sockets.get(client_id)
+        if ws is not None and not ws.closed:
+            await ws.send_json({"type": event_type, "data": data})
+
+    async def _render(self, prompt_id, workflow, client_id):
+        try:
+            async with self._gpu:
+                self.pending.remove(prompt_id)
+                self.running = prompt_id
+                try:
+                    await self._execute(prompt_id, workflow, client_id)
+                finally:
+                    self.running = None
+        except asyncio.CancelledError:
+            if prompt_id in self.pending:
+                # Deleted from the queue before it started
+                self.pending.remove(prompt_id)
+            else:
+                await self._send(client_id, "execution_interrupted", {"prompt_id": prompt_id})
+                self.history[prompt_id] = {
+                    "prompt": [0, prompt_id, workflow, {}, []],
+                    "outputs": {},
+                    "status": {"status_str": "error", "completed": False, "messages": []},
+                }
+        finally:
+            self._tasks.pop(prompt_id, None)
+
+    @staticmethod
+    def _signatures(workflow):
+        """A node is unchanged when its class, its values and the nodes it is linked to are."""
+        signatures = {}
+
+        def signature(node_id):
+            if node_id not in signatures:
+                node = workflow.get(node_id) or {}
+                signatures[node_id] = None
+                signatures[node_id] = repr(
+                    (
+                        node.get("class_type"),
+                        sorted(
+                            (name, (signature(value[0]), value[1]) if isinstance(value, list) else value)
+                            for name, value in (node.get("inputs") or {}).items()
+                        ),
+                    )
+                )
+            return signatures[node_id]
+
+        for node_id in workflow:
+            signature(node_id)
+        return signatures
+
+    async def _execute(self, prompt_id, workflow, client_id):
+        await self._send(client_id, "execution_start", {"prompt_id": prompt_id})
+        node_ids = list(workflow) or ["1"]
+        per_step = self.render_time / len(node_ids) / self.STEPS
+
+        cached = []
+        if self.cache_nodes:
+            signatures = self._signatures(workflow)
+            cached = [node_id for node_id in workflow if signatures[node_id] in self._previous_signatures]
+            self._previous_signatures = set(signatures.values())
+        await self._send(client_id, "execution_cached", {"nodes": cached, "prompt_id": prompt_id})
+
+        for node_id in node_ids:
+            if node_id in cached:
+                continue
+            await self._send(client_id, "executing", {"node": node_id, "prompt_id": prompt_id})
+            if self.node_time:
+                await asyncio.sleep(self.node_time)
+            class_type = (workflow.get(node_id) or {}).get("class_type")
+            if self.load_time and class_type not in self._loaded_classes:
+                self._loaded_classes.add(class_type)
+                await asyncio.sleep(self.load_time)
+            for step in range(1, self.STEPS + 1):
+                await asyncio.sleep(per_step)
+                await self._send(
+                    client_id,
+                    "progress",
+                    {"value": step, "max": self.STEPS, "node": node_id, "prompt_id": prompt_id},
+                )
+
+        filename = f"ComfyUI_{prompt_id[:8]}_.png"
+        with open(os.path.join(self.output_dir, filename), "wb") as image_file:
+            image_file.write(BLANK_PNG)
+        output = {"images": [{"filename": filename, "subfolder": "", "type": "output"}]}
+        await self._send(
+            client_id, "executed", {"node": node_ids[-1], "output": output, "prompt_id": prompt_id}
+        )
+        await self._send(client_id, "execution_success", {"prompt_id": prompt_id})
+
+        # Like ComfyUI, the history is written after "execution_success" and
+        # before the final "executing" event with node set to None
+        self.history[prompt_id] = {
+            "prompt": [0, prompt_id, workflow, {}, [node_ids[-1]]],
+            "outputs": {node_ids[-1]: output},
+            "status": {
+                "status_str": "success",
+                "completed": True,
+                "messages": [["execution_cached", {"nodes": cached, "prompt_id": prompt_id}]],
+            },
+        }
+        await self._send(client_id, "executing", {"node": None, "prompt_id": prompt_id})
+
+    def _make_app(self):
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_get("/", self._index)
+        app.router.add_post("/prompt", self._prompt)
+        app.router.add_get("/history/{prompt_id}", self._history)
+        app.router.add_get("/queue", self._queue)
+        app.router.add_post("/queue", self._delete_from_queue)
+        app.router.add_post("/interrupt", self._interrupt)
+        app.router.add_post("/upload/image", self._upload_image)
+        app.router.add_get("/view", self._view)
+        app.router.add_get("/ws", self._ws)
+        return app
+
+    async def _serve(self):
+        self._gpu = asyncio.Lock()
+        self._runner = web.AppRunner(self._make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self):
+        """Start the server on a daemon thread and wait until it is listening"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        """Stop the server and wait for its thread to exit"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a stand-in ComfyUI server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8188)
+    parser.add_argument("--render-time", type=float, default=1.0)
+    parser.add_argument("--output-dir", default=None)
+    parser.add_argument("--upload-latency", type=float, default=0.0)
+    parser.add_argument("--node-time", type=float, default=0.0)
+    parser.add_argument("--cache-nodes", action="store_true")
+    parser.add_argument("--load-time", type=float, default=0.0)
+    args = parser.parse_args()
+
+    server = FakeComfyServer(
+        args.host,
+        args.port,
+        args.render_time,
+        args.output_dir,
+        args.upload_latency,
+        args.node_time,
+        args.cache_nodes,
+        args.load_time,
+    ).start()
+    print(f"fake-comfy - listening on {server.address}, output in {server.output_dir}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
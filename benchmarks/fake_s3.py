@@ -0,0 +1,114 @@
+"""
+A local stand-in for AWS S3, used by the benchmarks in this folder.
+
+It accepts single PutObject requests and multipart uploads on any bucket with
+path-style addressing and throws the bytes away, only counting them. That is
+enough for boto3's put_object and upload_file.
+"""
+
+import asyncio
+import threading
+import uuid
+
+from aiohttp import web
+
+
+class FakeS3Server:
+    """
+    Stand-in S3 server running an aiohttp app on a background thread.
+
+    Args:
+        host (str): The interface to bind to
+        port (int): The port to bind to, 0 picks a free port
+    """
+
+    def __init__(self, host="127.0.0.1", port=0):
+        self.host = host
+        self.port = port
+        self.received_bytes = 0
+        self.request_counts = {}
+        self._loop = None
+        self._runner = None
+        self._thread = None
+        self._started = threading.Event()
+
+    @property
+    def endpoint_url(self):
+        """The URL to use as BUCKET_ENDPOINT_URL"""
+        return f"http://{self.host}:{self.port}"
+
+    def _count(self, name):
+        self.request_counts[name] = self.request_counts.get(name, 0) + 1
+
+    async def _drain(self, request):
+        async for chunk in request.content.iter_any():
+            self.received_bytes += len(chunk)
+
+    async def _put(self, request):
+        await self._drain(request)
+        if "partNumber" in request.query:
+            self._count("upload_part")
+        else:
+            self._count("put_object")
+        return web.Response(headers={"ETag": f'"{uuid.uuid4().hex}"'})
+
+    async def _post(self, request):
+        bucket = request.match_info["bucket"]
+        key = request.match_info["key"]
+        await self._drain(request)
+        if "uploads" in request.query:
+            self._count("create_multipart_upload")
+            body = (
+                "<InitiateMultipartUploadResult>"
+                f"<Bucket>{bucket}</Bucket><Key>{key}</Key><UploadId>{uuid.uuid4().hex}</UploadId>"
+                "</InitiateMultipartUploadResult>"
+            )
+        else:
+            self._count("complete_multipart_upload")
+            body = (
+                "<CompleteMultipartUploadResult>"
+                f"<Bucket>{bucket}</Bucket><Key>{key}</Key><ETag>\"{uuid.uuid4().hex}\"</ETag>"
+                "</CompleteMultipartUploadResult>"
+            )
+        return web.Response(text=body, content_type="application/xml")
+
+    def _make_app(self):
+        app = web.Application(client_max_size=1024**3)
+        app.router.add_put("/{bucket}/{key:.+}", self._put)
+        app.router.add_post("/{bucket}/{key:.+}", self._post)
+        return app
+
+    async def _serve(self):
+        self._runner = web.AppRunner(self._make_app(), access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        self.port = self._runner.addresses[0][1]
+        self._started.set()
+
+    def _run(self):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        self._loop.run_until_complete(self._serve())
+        self._loop.run_forever()
+        self._loop.run_until_complete(self._runner.cleanup())
+        self._loop.close()
+
+    def start(self):
+        """Start the server on a daemon thread and wait until it is listening"""
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._started.wait()
+        return self
+
+    def stop(self):
+        """Stop the server and wait for its thread to exit"""
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
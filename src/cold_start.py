@@ -0,0 +1,181 @@
+import builtins
+import contextlib
+import os
+import re
+import threading
+import time
+
+# A line of ComfyUI after "Import times for custom nodes:", like "   1.2 seconds: /app/ComfyUI/custom_nodes/X"
+CUSTOM_NODE_IMPORT_TIME = re.compile(r"^\s*([\d.]+) seconds( \(IMPORT FAILED\))?: (.+?)\s*$")
+
+
+def process_start_time(pid="self"):
+    """
+    The Unix time at which a process started, from /proc
+
+    Returns:
+        float: The time, or None if it can't be read, like outside of Linux
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as stat_file:
+            # The name of the process can contain spaces, the fields after it can't
+            fields = stat_file.read().rsplit(")", 1)[1].split()
+        with open("/proc/stat") as stat_file:
+            boot_time = next(int(line.split()[1]) for line in stat_file if line.startswith("btime"))
+        return boot_time + int(fields[19]) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
+
+
+def custom_node_import_times(log_path):
+    """
+    The import times of the custom nodes that ComfyUI logged at its start
+
+    Returns:
+        dict: Milliseconds by the folder name of the custom node, from the slowest on. Nodes that
+              failed to import end with " (failed)".
+    """
+    times = {}
+    try:
+        with open(log_path, errors="replace") as log_file:
+            in_import_times = False
+            for line in log_file:
+                if line.startswith("Import times for custom nodes"):
+                    in_import_times = True
+                    continue
+                match = CUSTOM_NODE_IMPORT_TIME.match(line) if in_import_times else None
+                if match is None:
+                    in_import_times = False
+                    continue
+                name = os.path.basename(match.group(3).rstrip("/"))
+                if match.group(2):
+                    name += " (failed)"
+                times[name] = round(float(match.group(1)) * 1000, 1)
+    except OSError:
+        return {}
+    return dict(sorted(times.items(), key=lambda item: -item[1]))
+
+
+class ColdStartTimeline:
+    """
+    When each phase of the boot of a worker happened, from the start of the container
+
+    start.sh appends a "<unix time> <name>" line to marks_path for each of
+    its phases, starting with "container_start", and the handler adds its
+    own marks. When start.sh left no marks, the start of the first process of
+    the container is used. Imports can be timed by their top-level module,
+    and the import times of the custom nodes are taken from the log of
+    ComfyUI.
+
+    Args:
+        marks_path (str, optional): The file start.sh writes its marks to
+        comfy_log_path (str, optional): The log of ComfyUI
+    """
+
+    def __init__(self, marks_path=None, comfy_log_path=None):
+        self.marks_path = marks_path
+        self.comfy_log_path = comfy_log_path
+        # (name, unix time) of the marks of the handler
+        self.marks = []
+        self.imports = {}
+        self.reported = False
+        self._lock = threading.Lock()
+        self._original_import = None
+        started = process_start_time()
+        if started is not None:
+            self.marks.append(("handler_process", started))
+
+    def mark(self, name, once=False):
+        """Something happened now, with once only the first time."""
+        with self._lock:
+            if once and any(mark == name for mark, _ in self.marks):
+                return
+            self.marks.append((name, time.time()))
+
+    def start_import_profile(self):
+        """
+        Time the imports of the current thread until stop_import_profile(), by their top-level module
+
+        Modules that are imported by another module count towards that module.
+        """
+        original = self._original_import = builtins.__import__
+        thread = threading.get_ident()
+        depth = [0]
+
+        def timed_import(name, *args, **kwargs):
+            if depth[0] or threading.get_ident() != thread:
+                return original(name, *args, **kwargs)
+            depth[0] += 1
+            start = time.perf_counter()
+            try:
+                return original(name, *args, **kwargs)
+            finally:
+                depth[0] -= 1
+                module = name.split(".")[0] or "(relative)"
+                self.imports[module] = self.imports.get(module, 0.0) + time.perf_counter() - start
+
+        builtins.__import__ = timed_import
+
+    def stop_import_profile(self):
+        if self._original_import is not None:
+            builtins.__import__ = self._original_import
+            self._original_import = None
+
+    @contextlib.contextmanager
+    def profile_imports(self):
+        """Time the imports in a with block, __import__ is restored even if one of them raises."""
+        self.start_import_profile()
+        try:
+            yield
+        finally:
+            self.stop_import_profile()
+
+    def load_marks(self):
+        """The marks of start.sh, an empty list if there are none."""
+        marks = []
+        if not self.marks_path:
+            return marks
+        try:
+            with open(self.marks_path) as marks_file:
+                for line in marks_file:
+                    at, _, name = line.strip().partition(" ")
+                    try:
+                        marks.append((name, float(at)))
+                    except ValueError:
+                        continue
+        except OSError:
+            pass
+        return marks
+
+    def report(self):
+        """
+        The timeline of the boot
+
+        Returns:
+            dict: 'since_container_start_ms' with the milliseconds of every mark from the start of the
+                  container, in the order they happened, 'imports_ms' with the time of the imports that took
+                  at least a millisecond by module, and the 'custom_nodes_ms' of ComfyUI, both from the
+                  slowest on
+        """
+        with self._lock:
+            marks = sorted(self.load_marks() + self.marks, key=lambda mark: mark[1])
+        origin = next((at for name, at in marks if name == "container_start"), None)
+        if origin is None:
+            origin = process_start_time(1) or (marks[0][1] if marks else time.time())
+            marks.insert(0, ("container_start", origin))
+        imports = {
+            module: round(seconds * 1000, 1) for module, seconds in self.imports.items() if seconds >= 0.001
+        }
+        return {
+            "since_container_start_ms": {name: round((at - origin) * 1000, 1) for name, at in marks},
+            "imports_ms": dict(sorted(imports.items(), key=lambda item: -item[1])),
+            "custom_nodes_ms": custom_node_import_times(self.comfy_log_path) if self.comfy_log_path else {},
+        }
+
+    def report_once(self):
+        """The report, only for the first call, None after that."""
+        with self._lock:
+            if self.reported:
+                return None
+            self.reported = True
+        return self.report()
@@ -0,0 +1,217 @@
+import queue
+import threading
+import time
+import uuid
+
+import websocket
+
+from comfy_http import json_loads
+
+
+class EventSubscription:
+    """
+    The execution events of one prompt, received through a ComfyEventRouter
+
+    Has the recv() and close() of a websocket.WebSocket, so it can be used
+    wherever the handler would otherwise read from its own websocket.
+
+    Args:
+        router (ComfyEventRouter): The router the subscription belongs to
+        timeout (float): Seconds recv() waits for an event
+    """
+
+    def __init__(self, router, timeout):
+        self.router = router
+        self.timeout = timeout
+        self.prompt_id = None
+        self._messages = queue.Queue()
+
+    def bind(self, prompt_id):
+        """Start receiving the events of a prompt, including the ones that arrived before."""
+        self.prompt_id = prompt_id
+        self.router._bind(self)
+
+    def recv(self):
+        """
+        Return the next message of the prompt
+
+        Raises:
+            websocket.WebSocketTimeoutException: If no message arrived within the timeout
+            websocket.WebSocketException, OSError: If the connection of the router dropped
+        """
+        try:
+            message = self._messages.get(timeout=self.timeout)
+        except queue.Empty:
+            raise websocket.WebSocketTimeoutException(
+                f"no event for prompt {self.prompt_id} in {self.timeout}s"
+            )
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def settimeout(self, timeout):
+        self.timeout = timeout
+
+    def close(self):
+        self.router._unsubscribe(self)
+
+
+class ComfyEventRouter:
+    """
+    One websocket connection to ComfyUI shared by all jobs of the worker
+
+    All prompts are queued with the client_id of the router, so ComfyUI sends
+    their events to its connection. A background thread reads them and hands
+    every event to the subscription of its prompt_id. Events of prompts that
+    have no subscription yet (the prompt_id is only known once /prompt
+    answered) are kept for buffer_ttl seconds. Binary messages (previews) carry
+    no prompt_id and go to the prompt that is executing.
+
+    When the connection drops, every subscription gets the error, so the jobs
+    can fall back to polling, and the router reconnects.
+
+    Args:
+        connect (callable): Called with the client_id, returns a connected websocket.WebSocket
+        recv_timeout (float): Seconds a subscription waits for an event
+        buffer_ttl (float): Seconds events of unknown prompts are kept
+        reconnect_delay (float): Seconds to wait before reconnecting, doubled up to 10 seconds
+        on_success (callable, optional): Called whenever the connection was established
+        on_failure (callable, optional): Called with the error whenever the connection failed or dropped
+    """
+
+    def __init__(
+        self,
+        connect,
+        recv_timeout=10.0,
+        buffer_ttl=300.0,
+        reconnect_delay=0.5,
+        on_success=None,
+        on_failure=None,
+    ):
+        self.connect = connect
+        self.recv_timeout = recv_timeout
+        self.buffer_ttl = buffer_ttl
+        self.reconnect_delay = reconnect_delay
+        self.on_success = on_success
+        self.on_failure = on_failure
+        self.client_id = str(uuid.uuid4())
+        # Subscriptions by prompt_id, and the ones that don't know their prompt_id yet
+        self._subscriptions = {}
+        self._unbound = set()
+        # (time of the first event, [messages]) by prompt_id
+        self._buffers = {}
+        self._executing = None
+        self._lock = threading.Lock()
+        self._connected = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Connect in the background, if that didn't happen yet."""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="comfy-events", daemon=True
+                )
+                self._thread.start()
+
+    def subscribe(self, timeout=5.0):
+        """
+        Subscribe to the events of a prompt that is about to be queued, see EventSubscription.bind
+
+        Args:
+            timeout (float): Seconds to wait for the connection
+
+        Returns:
+            EventSubscription: The subscription, or None if the router is not connected
+        """
+        self.start()
+        if not self._connected.wait(timeout):
+            return None
+        subscription = EventSubscription(self, self.recv_timeout)
+        with self._lock:
+            self._unbound.add(subscription)
+        return subscription
+
+    def _bind(self, subscription):
+        with self._lock:
+            self._unbound.discard(subscription)
+            self._subscriptions[subscription.prompt_id] = subscription
+            _, messages = self._buffers.pop(subscription.prompt_id, (None, []))
+        for message in messages:
+            subscription._messages.put(message)
+
+    def _unsubscribe(self, subscription):
+        with self._lock:
+            self._unbound.discard(subscription)
+            if self._subscriptions.get(subscription.prompt_id) is subscription:
+                del self._subscriptions[subscription.prompt_id]
+
+    def _route(self, message):
+        if isinstance(message, str):
+            try:
+                data = json_loads(message).get("data") or {}
+            except (ValueError, AttributeError):
+                return
+            prompt_id = data.get("prompt_id") if isinstance(data, dict) else None
+            if prompt_id is None:
+                return
+            if "node" in data:
+                self._executing = prompt_id if data["node"] is not None else None
+        else:
+            prompt_id = self._executing
+            if prompt_id is None:
+                return
+
+        with self._lock:
+            subscription = self._subscriptions.get(prompt_id)
+            if subscription is None:
+                now = time.monotonic()
+                for stale in [
+                    key for key, (first_seen, _) in self._buffers.items()
+                    if now - first_seen > self.buffer_ttl
+                ]:
+                    del self._buffers[stale]
+                self._buffers.setdefault(prompt_id, (now, []))[1].append(message)
+                return
+        subscription._messages.put(message)
+
+    def _fail(self, error):
+        self._connected.clear()
+        with self._lock:
+            subscriptions = list(self._subscriptions.values()) + list(self._unbound)
+            self._subscriptions.clear()
+            self._unbound.clear()
+            self._buffers.clear()
+            self._executing = None
+        for subscription in subscriptions:
+            subscription._messages.put(error)
+        if self.on_failure is not None:
+            self.on_failure(error)
+
+    def _run(self):
+        delay = self.reconnect_delay
+        while True:
+            try:
+                ws = self.connect(self.client_id)
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"runpod-worker-comfy - event websocket connection failed: {str(e)}")
+                self._fail(e)
+                time.sleep(delay)
+                delay = min(delay * 2, 10.0)
+                continue
+
+            delay = self.reconnect_delay
+            self._connected.set()
+            if self.on_success is not None:
+                self.on_success()
+            try:
+                while True:
+                    try:
+                        self._route(ws.recv())
+                    except websocket.WebSocketTimeoutException:
+                        continue
+            except (websocket.WebSocketException, OSError) as e:
+                print(f"runpod-worker-comfy - event websocket dropped, reconnecting: {str(e)}")
+                self._fail(e)
+            finally:
+                ws.close()
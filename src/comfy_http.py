@@ -0,0 +1,170 @@
+import json
+import random
+import time
+
+import urllib3
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Status codes that are worth retrying, because ComfyUI (or a proxy in front of it) is busy
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+# Methods that can be sent twice without changing the result
+IDEMPOTENT_METHODS = {"GET", "HEAD", "OPTIONS", "PUT", "DELETE"}
+# Errors of urllib3 that mean that the connection failed or timed out
+TRANSIENT_ERRORS = (
+    urllib3.exceptions.NewConnectionError,
+    urllib3.exceptions.ConnectTimeoutError,
+    urllib3.exceptions.ReadTimeoutError,
+    urllib3.exceptions.ProtocolError,
+)
+
+
+def json_loads(data):
+    """Parse JSON from bytes or str, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def json_dumps(obj):
+    """Serialize an object to JSON bytes, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj).encode("utf-8")
+
+
+class ComfyHttpError(Exception):
+    """Raised when ComfyUI answers with a status code other than 2xx."""
+
+    def __init__(self, message, status=None):
+        super().__init__(message)
+        self.status = status
+
+
+class ComfyConnectionError(ComfyHttpError):
+    """Raised when ComfyUI can't be reached or doesn't answer in time."""
+
+
+class ComfyHttpClient:
+    """
+    HTTP client for the ComfyUI API that reuses its connections
+
+    All requests go through one urllib3 pool, so the TCP connections to ComfyUI
+    are kept alive between calls. Every request has a connect and a read
+    timeout. Idempotent requests are retried with jittered exponential backoff
+    when the connection fails or ComfyUI answers with 502, 503 or 504.
+
+    Args:
+        connect_timeout (float): Seconds to wait for the TCP connection
+        read_timeout (float): Seconds to wait for the response
+        max_retries (int): How often an idempotent request is retried
+        backoff_base (float): Seconds of the first backoff, doubled on every retry
+        backoff_max (float): Upper limit of a single backoff in seconds
+        pool_size (int): How many connections per host are kept open
+        on_success (callable, optional): Called whenever ComfyUI answered a request
+        on_failure (callable, optional): Called with the error whenever ComfyUI could not be reached
+    """
+
+    def __init__(
+        self,
+        connect_timeout=5.0,
+        read_timeout=30.0,
+        max_retries=3,
+        backoff_base=0.1,
+        backoff_max=2.0,
+        pool_size=16,
+        on_success=None,
+        on_failure=None,
+    ):
+        self.timeout = urllib3.Timeout(connect=connect_timeout, read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.on_success = on_success
+        self.on_failure = on_failure
+        # Retries are handled by request(), so urllib3 must not retry on its own
+        self.pool = urllib3.PoolManager(maxsize=pool_size, retries=False)
+
+    def backoff(self, attempt):
+        """Seconds to sleep before the given retry ("full jitter")."""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    def request(self, method, url, idempotent=None, retries=None, timeout=None, **kwargs):
+        """
+        Send a request, retrying it if it is idempotent and failed for a transient reason
+
+        Args:
+            method (str): The HTTP method
+            url (str): The full URL
+            idempotent (bool, optional): Override if the request may be retried, by default derived from the method
+            retries (int, optional): Override the number of retries
+            timeout (urllib3.Timeout, optional): Override the connect and read timeout
+            **kwargs: Passed on to urllib3, like body, fields or headers
+
+        Returns:
+            urllib3.HTTPResponse: The response of the last attempt, with the body already read
+
+        Raises:
+            ComfyConnectionError: If the last attempt failed to connect or timed out
+        """
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        if not idempotent:
+            retries = 0
+        elif retries is None:
+            retries = self.max_retries
+
+        for attempt in range(retries + 1):
+            try:
+                response = self.pool.request(
+                    method, url, timeout=timeout or self.timeout, **kwargs
+                )
+                if response.status not in RETRYABLE_STATUS_CODES:
+                    if self.on_success is not None:
+                        self.on_success()
+                    return response
+                if attempt == retries:
+                    return response
+            except TRANSIENT_ERRORS as e:
+                if attempt == retries:
+                    if self.on_failure is not None:
+                        self.on_failure(e)
+                    raise ComfyConnectionError(f"{method} {url} failed: {e}") from e
+
+            time.sleep(self.backoff(attempt))
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def parse_json(self, response, url):
+        """
+        Parse the JSON body of a response, None if it is empty like the one of POST /interrupt
+
+        Raises:
+            ComfyHttpError: If the response has a status code other than 2xx
+        """
+        if not 200 <= response.status < 300:
+            raise ComfyHttpError(
+                f"HTTP {response.status} from {url}: "
+                f"{response.data[:2000].decode('utf-8', 'replace')}",
+                status=response.status,
+            )
+        return json_loads(response.data) if response.data else None
+
+    def get_json(self, url, **kwargs):
+        """GET a URL and return the parsed JSON body."""
+        return self.parse_json(self.get(url, **kwargs), url)
+
+    def post_json(self, url, payload, **kwargs):
+        """POST a JSON payload and return the parsed JSON body."""
+        headers = {"Content-Type": "application/json", **kwargs.pop("headers", {})}
+        return self.parse_json(
+            self.post(url, body=json_dumps(payload), headers=headers, **kwargs), url
+        )
@@ -0,0 +1,148 @@
+import hashlib
+import os
+import re
+import tempfile
+import threading
+from collections import OrderedDict
+
+SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+
+
+def is_sha256(value):
+    """Check if a value is a lowercase hex encoded SHA-256 digest."""
+    return isinstance(value, str) and SHA256_PATTERN.match(value) is not None
+
+
+class InputStore:
+    """
+    Content-addressed store for input images on the local disk or the network volume
+
+    Every image is stored once under its SHA-256, so clients can send the hash
+    instead of the image when the worker has seen the image before. When the
+    store grows beyond its size budget, the least recently used images are
+    removed. The order of use is kept in memory and restored from the
+    modification times of the files when the worker starts.
+
+    Args:
+        root (str): The folder of the store
+        max_bytes (int): The size budget of the store
+    """
+
+    def __init__(self, root, max_bytes):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._entries = None
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def path(self, sha256):
+        """The path of the image with the given hash."""
+        return os.path.join(self.root, sha256[:2], sha256)
+
+    def _load(self):
+        """Index the images already on disk, oldest first."""
+        entries = []
+        if os.path.isdir(self.root):
+            for folder in os.scandir(self.root):
+                if not folder.is_dir():
+                    continue
+                for entry in os.scandir(folder.path):
+                    if is_sha256(entry.name):
+                        stat = entry.stat()
+                        entries.append((stat.st_mtime, entry.name, stat.st_size))
+        entries.sort()
+        self._entries = OrderedDict((sha256, size) for _, sha256, size in entries)
+        self._total_bytes = sum(self._entries.values())
+
+    def _index(self):
+        if self._entries is None:
+            self._load()
+        return self._entries
+
+    def _touch(self, sha256):
+        self._index().move_to_end(sha256)
+        try:
+            os.utime(self.path(sha256))
+        except OSError:
+            pass
+
+    def _evict(self, keep):
+        entries = self._index()
+        while self._total_bytes > self.max_bytes and len(entries) > 1:
+            sha256, size = next(iter(entries.items()))
+            if sha256 == keep:
+                entries.move_to_end(sha256)
+                continue
+            del entries[sha256]
+            self._total_bytes -= size
+            try:
+                os.unlink(self.path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def has(self, sha256):
+        """Check if the image with the given hash is in the store."""
+        with self._lock:
+            if sha256 in self._index():
+                return True
+        # Another worker on the same network volume may have added it
+        return os.path.exists(self.path(sha256))
+
+    def get(self, sha256):
+        """
+        Read an image from the store
+
+        Returns:
+            bytes: The image, or None if it is not in the store
+        """
+        try:
+            with open(self.path(sha256), "rb") as image_file:
+                blob = image_file.read()
+        except FileNotFoundError:
+            with self._lock:
+                size = self._index().pop(sha256, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+
+        with self._lock:
+            if sha256 not in self._index():
+                self._entries[sha256] = len(blob)
+                self._total_bytes += len(blob)
+            self._touch(sha256)
+        return blob
+
+    def put(self, blob):
+        """
+        Add an image to the store, if it is not in there yet
+
+        Returns:
+            str: The SHA-256 of the image
+        """
+        sha256 = hashlib.sha256(blob).hexdigest()
+        with self._lock:
+            if sha256 in self._index():
+                self._touch(sha256)
+                return sha256
+
+        image_path = self.path(sha256)
+        if not os.path.exists(image_path):
+            os.makedirs(os.path.dirname(image_path), exist_ok=True)
+            # Write to a temporary file first, so readers never see a partial image
+            with tempfile.NamedTemporaryFile(
+                dir=os.path.dirname(image_path), prefix=".", suffix=".tmp", delete=False
+            ) as temp_file:
+                try:
+                    temp_file.write(blob)
+                except BaseException:
+                    os.unlink(temp_file.name)
+                    raise
+            os.replace(temp_file.name, image_path)
+
+        with self._lock:
+            if sha256 not in self._index():
+                self._entries[sha256] = len(blob)
+                self._total_bytes += len(blob)
+            self._touch(sha256)
+            self._evict(keep=sha256)
+        return sha256
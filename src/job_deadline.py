@@ -0,0 +1,93 @@
+import threading
+import time
+
+
+class JobTimeoutError(Exception):
+    """Raised when a job ran past its deadline, stopped making progress or was cancelled."""
+
+
+class JobDeadline:
+    """
+    The wall-clock time limit of a job and the prompts it has in ComfyUI
+
+    Besides the deadline of the whole job, a watchdog fails a prompt that
+    started to execute but reported no progress for stall_timeout seconds.
+    The time a prompt waits in the queue of ComfyUI only counts towards the
+    deadline, as other prompts run on the GPU in the meantime.
+
+    Args:
+        timeout (float): Seconds the job may take, from now on
+        stall_timeout (float, optional): Seconds an executing prompt may go without progress, 0 or None to disable
+    """
+
+    def __init__(self, timeout, stall_timeout=None):
+        self.timeout = timeout
+        self.stall_timeout = stall_timeout
+        self.started = time.monotonic()
+        self.expires_at = self.started + timeout
+        # When the executing prompt last made progress, None while no prompt executes
+        self.last_progress = None
+        # The prompts that were queued and are not done yet, to cancel them
+        self.prompt_ids = []
+        self._cancelled = threading.Event()
+        self._lock = threading.Lock()
+
+    def time_left(self):
+        """Seconds until the deadline, 0 once it passed."""
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def next_check(self, limit):
+        """Seconds until check() should be called again, at most limit."""
+        wait = min(limit, self.time_left())
+        if self.stall_timeout and self.last_progress is not None:
+            wait = min(wait, self.last_progress + self.stall_timeout - time.monotonic())
+        # Never 0, which would make a socket non-blocking
+        return max(wait, 0.01)
+
+    def track(self, prompt_id):
+        """A prompt of the job was queued."""
+        with self._lock:
+            self.prompt_ids.append(prompt_id)
+
+    def done(self, prompt_id):
+        """A prompt of the job is done, it doesn't need to be cancelled anymore."""
+        with self._lock:
+            if prompt_id in self.prompt_ids:
+                self.prompt_ids.remove(prompt_id)
+        self.last_progress = None
+
+    def pending(self):
+        """The prompts of the job that are not done yet."""
+        with self._lock:
+            return list(self.prompt_ids)
+
+    def progress(self):
+        """The executing prompt made progress, this also starts the watchdog."""
+        self.last_progress = time.monotonic()
+
+    def cancel(self):
+        """The job was cancelled, check() raises from now on."""
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def check(self):
+        """
+        Raise if the job has to stop waiting for ComfyUI
+
+        Raises:
+            JobTimeoutError: If the job was cancelled, ran past its deadline or the executing prompt stalled
+        """
+        now = time.monotonic()
+        if self.cancelled:
+            raise JobTimeoutError("The job was cancelled")
+        if now >= self.expires_at:
+            raise JobTimeoutError(f"The job timed out after {self.timeout:g}s")
+        if (
+            self.stall_timeout
+            and self.last_progress is not None
+            and now - self.last_progress >= self.stall_timeout
+        ):
+            raise JobTimeoutError(f"The prompt made no progress for {self.stall_timeout:g}s")
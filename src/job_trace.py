@@ -0,0 +1,142 @@
+import collections
+import json
+import os
+import tempfile
+import threading
+import time
+
+# The track of the node executions of ComfyUI, real threads have their ident as track
+COMFYUI_TRACK = 1
+
+
+class _Span:
+    """Records one span, see JobTracer.span()."""
+
+    __slots__ = ("tracer", "name", "category", "args", "started")
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.tracer.complete(self.name, self.started, time.perf_counter(), self.category, self.args)
+        return False
+
+
+class JobTracer:
+    """
+    Spans of a job on a single time axis, exported as Chrome trace events
+
+    Spans are kept as tuples in a ring buffer of max_events, so recording
+    one is a single append, and a job that records more only keeps the last
+    ones. Spans of the handler are on the track of the thread that recorded
+    them, the nodes that ComfyUI executed on a track of their own. The
+    export opens in chrome://tracing and https://ui.perfetto.dev.
+
+    Args:
+        job_id (str): The ID of the job, for the file name and the process name
+        max_events (int): The size of the ring buffer
+    """
+
+    def __init__(self, job_id, max_events=10000):
+        self.job_id = job_id
+        self.events = collections.deque(maxlen=max_events)
+        self.recorded = 0
+        self.thread_names = {}
+        # time.monotonic() of the same moment, for the timestamps of the NodeProfiler
+        self.origin = time.perf_counter()
+        self.monotonic_origin = time.monotonic()
+
+    def span(self, name, category="handler", **args):
+        """A context manager that records the time spent in it as a span."""
+        return _Span(self, name, category, args or None)
+
+    def complete(self, name, start, end, category="handler", args=None, track=None):
+        """
+        Record a span between two time.perf_counter() values
+
+        Args:
+            track (int, optional): The track of the span, by default the current thread
+        """
+        if track is None:
+            track = threading.get_ident()
+            if track not in self.thread_names:
+                self.thread_names[track] = threading.current_thread().name
+        self.events.append((name, category, start, end, track, args))
+        self.recorded += 1
+
+    def add_profile(self, profiler, **args):
+        """Record the nodes that ComfyUI executed for a prompt, from its NodeProfiler."""
+        offset = self.origin - self.monotonic_origin
+        for node_id, start, end in profiler.runs:
+            self.complete(
+                profiler.class_type(node_id),
+                start + offset,
+                end + offset,
+                "comfyui",
+                {"node": node_id, **args},
+                COMFYUI_TRACK,
+            )
+
+    def export(self):
+        """
+        The spans as a Chrome trace, with microsecond timestamps since the tracer was created
+
+        Returns:
+            dict: The trace with its 'traceEvents'
+        """
+        pid = os.getpid()
+        events = [
+            {"name": "process_name", "ph": "M", "pid": pid, "args": {"name": f"job {self.job_id}"}},
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": COMFYUI_TRACK, "args": {"name": "ComfyUI"}},
+        ]
+        events.extend(
+            {"name": "thread_name", "ph": "M", "pid": pid, "tid": track, "args": {"name": name}}
+            for track, name in self.thread_names.items()
+        )
+        for name, category, start, end, track, args in list(self.events):
+            event = {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": round((start - self.origin) * 1e6, 1),
+                "dur": round((end - start) * 1e6, 1),
+                "pid": pid,
+                "tid": track,
+            }
+            if args:
+                event["args"] = args
+            events.append(event)
+        return {
+            "traceEvents": events,
+            "displayTimeUnit": "ms",
+            "otherData": {"job_id": self.job_id, "dropped_events": self.recorded - len(self.events)},
+        }
+
+    def write(self, root):
+        """
+        Write the trace to <root>/<job ID>.trace.json
+
+        Returns:
+            str: The path of the file
+
+        Raises:
+            OSError: If the file can't be written
+        """
+        os.makedirs(root, exist_ok=True)
+        path = os.path.join(root, f"{self.job_id}.trace.json")
+        fd, tmp_path = tempfile.mkstemp(dir=root, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as trace_file:
+                json.dump(self.export(), trace_file, separators=(",", ":"))
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        return path
@@ -0,0 +1,388 @@
+import bisect
+import http.server
+import json
+import math
+import os
+import socket
+import threading
+import time
+
+# Upper bounds in seconds of the buckets of a latency histogram, from a quick upload to a long render
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+class _Shards:
+    """
+    The values of a metric, one per thread, so that recording takes no lock
+
+    Every thread only writes its own shard. The lock is only taken when a
+    thread records its first value and when the metrics are collected. The
+    shards of threads that ended are folded into one, so that the short-lived
+    threads of a ThreadPoolExecutor don't pile up.
+
+    Args:
+        new (callable): Creates the empty value of a shard
+        merge (callable): Called with (into, shard) to add a shard to another
+    """
+
+    def __init__(self, new, merge):
+        self._new = new
+        self._merge = merge
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # (thread, shard) of the threads that recorded a value
+        self._shards = []
+        self._ended = new()
+
+    def get(self):
+        """The shard of the current thread."""
+        try:
+            return self._local.shard
+        except AttributeError:
+            shard = self._local.shard = self._new()
+            with self._lock:
+                self._shards.append((threading.current_thread(), shard))
+            return shard
+
+    def collect(self):
+        """The sum of all shards, a new value."""
+        total = self._new()
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread.is_alive():
+                    alive.append((thread, shard))
+                else:
+                    self._merge(self._ended, shard)
+            self._shards = alive
+            self._merge(total, self._ended)
+            for _, shard in alive:
+                self._merge(total, shard)
+        return total
+
+
+def _merge_counts(into, shard):
+    for labels, value in list(shard.items()):
+        into[labels] = into.get(labels, 0) + value
+
+
+def _merge_buckets(into, shard):
+    for labels, row in list(shard.items()):
+        total = into.get(labels)
+        if total is None:
+            into[labels] = list(row)
+        else:
+            for index, value in enumerate(row):
+                total[index] += value
+
+
+class Counter:
+    """
+    A value that only goes up, like the number of jobs
+
+    Args:
+        name (str): The name of the metric
+        help (str): What it counts
+        labelnames (tuple): The names of the labels, their values are given to inc()
+    """
+
+    type = "counter"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._shards = _Shards(dict, _merge_counts)
+
+    def inc(self, amount=1, *labels):
+        shard = self._shards.get()
+        shard[labels] = shard.get(labels, 0) + amount
+
+    def samples(self):
+        """(suffix, labels, value) of every value of the metric."""
+        return [("", labels, value) for labels, value in sorted(self._shards.collect().items())]
+
+
+class Gauge:
+    """
+    A value that is set, like the free VRAM
+
+    Setting a value replaces the one before, which is a single atomic store.
+
+    Args:
+        name (str): The name of the metric
+        help (str): What it measures
+        labelnames (tuple): The names of the labels, their values are given to set()
+    """
+
+    type = "gauge"
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._values = {}
+
+    def set(self, value, *labels):
+        self._values[labels] = value
+
+    def samples(self):
+        return [("", labels, value) for labels, value in sorted(self._values.copy().items())]
+
+
+class Histogram:
+    """
+    How often a value fell into each of a fixed set of buckets, like the duration of a phase
+
+    Args:
+        name (str): The name of the metric
+        help (str): What it measures
+        labelnames (tuple): The names of the labels, their values are given to observe()
+        buckets (tuple): The upper bounds of the buckets, in increasing order
+    """
+
+    type = "histogram"
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self.buckets = tuple(buckets)
+        # Per labels, the count of every bucket, of the values above the last bucket, and their sum
+        self._shards = _Shards(dict, _merge_buckets)
+
+    def observe(self, value, *labels):
+        shard = self._shards.get()
+        row = shard.get(labels)
+        if row is None:
+            row = shard[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        row[bisect.bisect_left(self.buckets, value)] += 1
+        row[-1] += value
+
+    def samples(self):
+        samples = []
+        for labels, row in sorted(self._shards.collect().items()):
+            count = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), row):
+                count += bucket_count
+                samples.append(("_bucket", labels + (_format_value(bound),), count))
+            samples.append(("_sum", labels, row[-1]))
+            samples.append(("_count", labels, count))
+        return samples
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+class MetricsRegistry:
+    """The metrics of the worker, rendered for Prometheus or as a snapshot."""
+
+    def __init__(self):
+        self.metrics = []
+
+    def _add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name, help, labelnames=()):
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def render(self):
+        """
+        The metrics in the Prometheus text format
+
+        Returns:
+            str: The exposition, version 0.0.4
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for suffix, labels, value in metric.samples():
+                names = metric.labelnames + (("le",) if suffix == "_bucket" else ())
+                label_text = ",".join(f'{name}="{_escape(label)}"' for name, label in zip(names, labels))
+                label_text = f"{{{label_text}}}" if label_text else ""
+                lines.append(f"{metric.name}{suffix}{label_text} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        """
+        The metrics as plain values, e.g. for a JSON line
+
+        Returns:
+            dict: By metric name, a list of [labels, value], with the labels as a dict. The value of a
+                  histogram is its cumulative bucket 'counts', its 'sum' and its 'count'.
+        """
+        snapshot = {}
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                rows = metric._shards.collect()
+                snapshot[metric.name] = [
+                    [
+                        dict(zip(metric.labelnames, labels)),
+                        {
+                            "counts": [sum(row[: index + 1]) for index in range(len(metric.buckets) + 1)],
+                            "sum": round(row[-1], 6),
+                            "count": sum(row[:-1]),
+                        },
+                    ]
+                    for labels, row in sorted(rows.items())
+                ]
+            else:
+                snapshot[metric.name] = [
+                    [dict(zip(metric.labelnames, labels)), value] for _, labels, value in metric.samples()
+                ]
+        return snapshot
+
+
+class MetricsServer:
+    """
+    Serves the metrics of a registry on http://<host>:<port>/metrics, in a daemon thread
+
+    With a health callable, /health also serves its result as JSON, with status 503 while
+    its "healthy" is false.
+
+    Args:
+        registry (MetricsRegistry): The metrics
+        port (int): The port, 0 picks a free one
+        host (str): The address to listen on
+        health (callable, optional): Returns the health of the worker as a dictionary
+    """
+
+    def __init__(self, registry, port, host="0.0.0.0", health=None):
+        class Handler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                path = self.path.split("?")[0]
+                if path == "/metrics":
+                    self.reply(200, "text/plain; version=0.0.4; charset=utf-8", self.server.registry.render())
+                elif path == "/health" and self.server.health is not None:
+                    health = self.server.health()
+                    self.reply(200 if health.get("healthy") else 503, "application/json", json.dumps(health))
+                else:
+                    self.send_error(404)
+
+            def reply(self, status, content_type, text):
+                body = text.encode()
+                self.send_response(status)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.registry = registry
+        self.server.health = health
+        self.port = self.server.server_address[1]
+        self._thread = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="metrics-server", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class MetricsSampler:
+    """
+    Samples gauges and writes a snapshot of the metrics every interval seconds, in a daemon thread
+
+    Snapshots are appended as JSON lines to one file per worker and day in
+    root, and files older than retention_days are removed.
+
+    Args:
+        registry (MetricsRegistry): The metrics
+        sample (callable, optional): Called before every snapshot to set the gauges
+        interval (float): Seconds between two snapshots
+        root (str, optional): The folder of the snapshots, None to only sample
+        retention_days (int): Days after which the files are removed
+        worker_id (str, optional): Part of the file names, by default the RunPod pod ID or the host name
+    """
+
+    def __init__(self, registry, sample=None, interval=15.0, root=None, retention_days=7, worker_id=None):
+        self.registry = registry
+        self.sample = sample
+        self.interval = interval
+        self.root = root
+        self.retention_days = retention_days
+        self.worker_id = worker_id or os.environ.get("RUNPOD_POD_ID") or socket.gethostname()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pruned_day = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name="metrics-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """Sample the gauges and write a snapshot, errors are logged."""
+        if self.sample is not None:
+            try:
+                self.sample()
+            except Exception as e:
+                print(f"runpod-worker-comfy - can't sample the metrics: {str(e)}")
+        if self.root:
+            try:
+                self.write_snapshot()
+            except OSError as e:
+                print(f"runpod-worker-comfy - can't write the metrics snapshot: {str(e)}")
+
+    def write_snapshot(self):
+        """
+        Append a snapshot of the metrics to the file of today
+
+        Raises:
+            OSError: If the file can't be written
+        """
+        now = time.time()
+        day = time.strftime("%Y-%m-%d", time.gmtime(now))
+        line = json.dumps(
+            {"time": round(now, 3), "worker_id": self.worker_id, "metrics": self.registry.snapshot()},
+            separators=(",", ":"),
+        )
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, f"{day}-{self.worker_id}.jsonl"), "a") as snapshot_file:
+            snapshot_file.write(line + "\n")
+        if self._pruned_day != day:
+            self._pruned_day = day
+            self.prune()
+
+    def prune(self):
+        """Remove the files of all workers that are older than retention_days."""
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        for name in os.listdir(self.root):
+            path = os.path.join(self.root, name)
+            try:
+                if name.endswith(".jsonl") and os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
@@ -0,0 +1,286 @@
+import argparse
+import glob
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+# ComfyUI sends no more events for a prompt after these
+END_EVENTS = ("execution_success", "execution_error", "execution_interrupted")
+
+
+class NodeProfiler:
+    """
+    The execution time of every node of a prompt, from the websocket events of ComfyUI
+
+    ComfyUI sends "executing" when a node starts, so a node runs until the
+    next "executing" event, its "executed" event (only output nodes have
+    one) or the end of the prompt. Nodes that ComfyUI took from its cache are
+    listed in "execution_cached" and take no time.
+
+    Args:
+        workflow (dict): The workflow of the prompt, for the class_type of the nodes
+    """
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.started = None
+        self.ended = None
+        # (node_id, start) of the node that is executing
+        self.current = None
+        # (node_id, start, end) of every node that ran, in the order they ran
+        self.runs = []
+        self.cached = []
+
+    def wrap(self, on_event=None):
+        """An on_event callback that feeds the profiler and then calls on_event, if there is one."""
+
+        def profile_event(event_type, data):
+            self.update(event_type, data)
+            if on_event is not None:
+                on_event(event_type, data)
+
+        return profile_event
+
+    def update(self, event_type, data):
+        """Track an event of the prompt, binary messages have no event_type and are ignored."""
+        if event_type is None:
+            return
+        now = time.monotonic()
+        if self.started is None:
+            self.started = now
+        if event_type == "execution_cached":
+            self.cached = list(data.get("nodes") or [])
+        elif event_type == "executing":
+            self._finish(now)
+            if data.get("node") is None:
+                self.ended = now
+            else:
+                self.current = (data["node"], now)
+        elif event_type == "executed":
+            if self.current is not None and self.current[0] == data.get("node"):
+                self._finish(now)
+        elif event_type in END_EVENTS:
+            self._finish(now)
+            self.ended = self.ended or now
+
+    def _finish(self, now):
+        if self.current is not None:
+            node_id, start = self.current
+            self.runs.append((node_id, start, now))
+            self.current = None
+
+    def class_type(self, node_id):
+        node = self.workflow.get(node_id)
+        return node.get("class_type", "unknown") if isinstance(node, dict) else "unknown"
+
+    def profile(self):
+        """
+        The compact profile of the prompt
+
+        Returns:
+            dict: 'total_ms' from the first to the last event, 'nodes' as [node_id, class_type,
+                  start_ms, duration_ms] in the order they ran, 'classes' as [class_type, runs,
+                  total_ms] from the slowest class on, and the number of 'cached' nodes
+        """
+        if self.started is None:
+            return {"total_ms": 0.0, "nodes": [], "classes": [], "cached": 0}
+        ended = self.ended or (self.runs[-1][2] if self.runs else self.started)
+        nodes = []
+        classes = {}
+        for node_id, start, end in self.runs:
+            class_type = self.class_type(node_id)
+            duration = round((end - start) * 1000, 3)
+            nodes.append([node_id, class_type, round((start - self.started) * 1000, 3), duration])
+            runs, total = classes.get(class_type, (0, 0.0))
+            classes[class_type] = (runs + 1, total + duration)
+        return {
+            "total_ms": round((ended - self.started) * 1000, 3),
+            "nodes": nodes,
+            "classes": sorted(
+                ([class_type, runs, round(total, 3)] for class_type, (runs, total) in classes.items()),
+                key=lambda row: -row[2],
+            ),
+            "cached": len(self.cached),
+        }
+
+
+def _add_run(stats, duration, cached=False):
+    """Add a run of a node to its stats, a list of [runs, cached, total_ms, max_ms]."""
+    stats[0] += 1
+    if cached:
+        stats[1] += 1
+        return
+    stats[2] = round(stats[2] + duration, 3)
+    stats[3] = max(stats[3], duration)
+
+
+class NodeProfileStore:
+    """
+    Node timings of many jobs on disk, added up per day
+
+    Every worker writes its own file per day, so that workers sharing a
+    network volume don't overwrite each other, and removes the files that
+    are older than retention_days. The stats of a node class are its runs,
+    how many of them came from the cache, and the total and maximum
+    milliseconds of the other runs. Nodes are kept as "<class_type>#<node_id>".
+
+    Args:
+        root (str): The folder of the files
+        retention_days (int): Days after which the files are removed
+        worker_id (str, optional): Part of the file names, by default the RunPod pod ID or the host name
+    """
+
+    def __init__(self, root, retention_days=7, worker_id=None):
+        self.root = root
+        self.retention_days = retention_days
+        self.worker_id = worker_id or os.environ.get("RUNPOD_POD_ID") or socket.gethostname()
+        self._lock = threading.Lock()
+        self._pruned_day = None
+
+    def path(self, day):
+        return os.path.join(self.root, f"{day}-{self.worker_id}.json")
+
+    def record(self, profiler):
+        """
+        Add the nodes of a prompt to the file of today
+
+        Raises:
+            OSError: If the file can't be written
+        """
+        day = time.strftime("%Y-%m-%d", time.gmtime())
+        with self._lock:
+            path = self.path(day)
+            try:
+                with open(path, "rb") as profile_file:
+                    aggregate = json.loads(profile_file.read())
+            except FileNotFoundError:
+                aggregate = {"prompts": 0, "classes": {}, "nodes": {}}
+
+            aggregate["prompts"] += 1
+            for node_id, start, end in profiler.runs:
+                class_type = profiler.class_type(node_id)
+                duration = round((end - start) * 1000, 3)
+                _add_run(aggregate["classes"].setdefault(class_type, [0, 0, 0.0, 0.0]), duration)
+                _add_run(aggregate["nodes"].setdefault(f"{class_type}#{node_id}", [0, 0, 0.0, 0.0]), duration)
+            for node_id in profiler.cached:
+                class_type = profiler.class_type(node_id)
+                _add_run(aggregate["classes"].setdefault(class_type, [0, 0, 0.0, 0.0]), 0, cached=True)
+                _add_run(aggregate["nodes"].setdefault(f"{class_type}#{node_id}", [0, 0, 0.0, 0.0]), 0, cached=True)
+
+            os.makedirs(self.root, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.root, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "w") as profile_file:
+                    json.dump(aggregate, profile_file, separators=(",", ":"))
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+
+            if self._pruned_day != day:
+                self._pruned_day = day
+                self.prune()
+
+    def prune(self):
+        """Remove the files of all workers that are older than retention_days."""
+        cutoff = time.time() - self.retention_days * 24 * 3600
+        for path in glob.glob(os.path.join(self.root, "*.json")):
+            try:
+                if os.path.getmtime(path) < cutoff:
+                    os.unlink(path)
+            except OSError:
+                pass
+
+
+def load_aggregate(root, days=None):
+    """
+    Add up the files of all workers in a folder
+
+    Args:
+        root (str): The folder of the files
+        days (int, optional): Only the files of the last days, by default all of them
+
+    Returns:
+        dict: The number of 'prompts' and the stats of the 'classes' and 'nodes', see NodeProfileStore
+    """
+    total = {"prompts": 0, "classes": {}, "nodes": {}}
+    since = time.strftime("%Y-%m-%d", time.gmtime(time.time() - (days - 1) * 24 * 3600)) if days else ""
+    for path in sorted(glob.glob(os.path.join(root, "*.json"))):
+        if os.path.basename(path)[:10] < since:
+            continue
+        try:
+            with open(path, "rb") as profile_file:
+                aggregate = json.loads(profile_file.read())
+        except (OSError, ValueError):
+            continue
+        total["prompts"] += aggregate.get("prompts", 0)
+        for group in ("classes", "nodes"):
+            for name, (runs, cached, total_ms, max_ms) in aggregate.get(group, {}).items():
+                stats = total[group].setdefault(name, [0, 0, 0.0, 0.0])
+                stats[0] += runs
+                stats[1] += cached
+                stats[2] = round(stats[2] + total_ms, 3)
+                stats[3] = max(stats[3], max_ms)
+    return total
+
+
+def top_nodes(aggregate, by="classes", n=20, sort="total"):
+    """
+    The slowest node classes or nodes of an aggregate
+
+    Args:
+        aggregate (dict): See load_aggregate
+        by (str): "classes" or "nodes"
+        n (int): How many to return
+        sort (str): "total", "mean" or "max" milliseconds
+
+    Returns:
+        list: Dicts with the 'name', 'runs', 'cached', 'total_ms', 'mean_ms', 'max_ms' and the
+              'share' of the total time of all nodes
+    """
+    all_ms = sum(stats[2] for stats in aggregate[by].values()) or 1.0
+    rows = []
+    for name, (runs, cached, total_ms, max_ms) in aggregate[by].items():
+        executed = runs - cached
+        rows.append(
+            {
+                "name": name,
+                "runs": runs,
+                "cached": cached,
+                "total_ms": total_ms,
+                "mean_ms": round(total_ms / executed, 3) if executed else 0.0,
+                "max_ms": max_ms,
+                "share": round(total_ms / all_ms, 4),
+            }
+        )
+    rows.sort(key=lambda row: -row[f"{sort}_ms"])
+    return rows[:n]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Print the slowest node types of the jobs profiled in NODE_PROFILE_PATH"
+    )
+    parser.add_argument("path", nargs="?", default=os.environ.get("NODE_PROFILE_PATH", "/runpod-volume/node-profiles"))
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--by", choices=["classes", "nodes"], default="classes")
+    parser.add_argument("--sort", choices=["total", "mean", "max"], default="total")
+    parser.add_argument("--days", type=int, help="Only the last days, by default all that are kept")
+    args = parser.parse_args(argv)
+
+    aggregate = load_aggregate(args.path, args.days)
+    print(f"{aggregate['prompts']} prompts in {args.path}")
+    print(f"{'node' if args.by == 'nodes' else 'class_type':40s} {'runs':>8s} {'cached':>7s} {'mean ms':>10s} {'max ms':>10s} {'total s':>10s} {'share':>6s}")
+    for row in top_nodes(aggregate, args.by, args.top, args.sort):
+        cached = row["cached"] / row["runs"] if row["runs"] else 0
+        print(
+            f"{row['name'][:40]:40s} {row['runs']:8d} {cached:7.0%} {row['mean_ms']:10.1f}"
+            f" {row['max_ms']:10.1f} {row['total_ms'] / 1000:10.1f} {row['share']:6.1%}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import base64
+import io
+import struct
+import time
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Type of the binary websocket messages of ComfyUI that contain a preview image
+PREVIEW_IMAGE = 1
+# Image formats of the preview images, by the type ComfyUI sends along
+PREVIEW_FORMATS = {1: "jpeg", 2: "png"}
+
+
+def decode_preview(message):
+    """
+    Split a binary websocket message of ComfyUI into the format and bytes of its preview image
+
+    Returns:
+        tuple: (format, image bytes), or None if the message is not a preview image
+    """
+    if len(message) < 8:
+        return None
+    event_type, image_type = struct.unpack(">II", message[:8])
+    if event_type != PREVIEW_IMAGE or image_type not in PREVIEW_FORMATS:
+        return None
+    return PREVIEW_FORMATS[image_type], message[8:]
+
+
+def downscale_preview(image_format, blob, max_size):
+    """
+    Shrink a preview image to at most max_size pixels on its longer side
+
+    Returns:
+        str: A data URL of the preview, as JPEG if Pillow is installed, as received otherwise
+    """
+    if Image is None:
+        return f"data:image/{image_format};base64,{base64.b64encode(blob).decode('utf-8')}"
+
+    image = Image.open(io.BytesIO(blob))
+    image.thumbnail((max_size, max_size))
+    output = io.BytesIO()
+    image.convert("RGB").save(output, format="JPEG", quality=80)
+    return f"data:image/jpeg;base64,{base64.b64encode(output.getvalue()).decode('utf-8')}"
+
+
+class ProgressTracker:
+    """
+    Turn the websocket events of a prompt into progress updates for the client
+
+    Every event updates the state, but an update is only handed out every
+    min_interval seconds, so that a fast sampler doesn't flood the stream.
+    Previews are only decoded and downscaled when an update is handed out.
+
+    Args:
+        workflow (dict): The workflow of the prompt, for the class_type of the nodes
+        min_interval (float): Seconds between two updates
+        preview_max_size (int): Longer side of the previews in pixels, 0 leaves them out
+    """
+
+    def __init__(self, workflow, min_interval=0.5, preview_max_size=0):
+        self.workflow = workflow
+        self.min_interval = min_interval
+        self.preview_max_size = preview_max_size
+        self.started = time.monotonic()
+        self.node = None
+        self.step = None
+        self.max_steps = None
+        self.done_nodes = set()
+        self._preview = None
+        self._last_update = None
+        self._changed = False
+
+    def update(self, event_type, data):
+        """
+        Track an event of the prompt, for binary messages the event_type is None and data the message
+
+        Returns:
+            dict: The progress update to send, or None if it is too early for the next one
+        """
+        if event_type is None:
+            if self.preview_max_size:
+                preview = decode_preview(data)
+                if preview is not None:
+                    self._preview = preview
+                    self._changed = True
+        elif event_type == "execution_cached":
+            self.done_nodes.update(data.get("nodes") or [])
+            self._changed = True
+        elif event_type == "executing":
+            if self.node is not None:
+                self.done_nodes.add(self.node)
+            self.node = data.get("node")
+            self.step = None
+            self.max_steps = None
+            self._changed = True
+        elif event_type == "progress":
+            self.node = data.get("node", self.node)
+            self.step = data.get("value")
+            self.max_steps = data.get("max")
+            self._changed = True
+        else:
+            return None
+
+        now = time.monotonic()
+        if self._last_update is not None and now - self._last_update < self.min_interval:
+            return None
+        return self.flush()
+
+    def flush(self):
+        """Return the latest state as an update, or None if nothing changed since the last one."""
+        if not self._changed:
+            return None
+        self._changed = False
+        self._last_update = time.monotonic()
+
+        node = self.workflow.get(self.node) or {}
+        progress = {
+            "status": "progress",
+            "node": self.node,
+            "class_type": node.get("class_type"),
+            "title": (node.get("_meta") or {}).get("title"),
+            "step": self.step,
+            "max_steps": self.max_steps,
+            "nodes_done": len(self.done_nodes),
+            "nodes_total": len(self.workflow),
+            "elapsed_s": round(self._last_update - self.started, 3),
+        }
+        if self._preview is not None:
+            try:
+                progress["preview"] = downscale_preview(*self._preview, self.preview_max_size)
+            except (OSError, ValueError) as e:
+                print(f"runpod-worker-comfy - skipping a broken preview: {str(e)}")
+            self._preview = None
+        return progress
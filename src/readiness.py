@@ -0,0 +1,130 @@
+import threading
+import time
+
+# ComfyUI was not checked yet
+STARTING = "starting"
+# ComfyUI answers
+READY = "ready"
+# The last call to ComfyUI failed, but it answered before
+DEGRADED = "degraded"
+# ComfyUI didn't come up at boot or failed too many calls in a row
+DEAD = "dead"
+
+
+class ComfyReadiness:
+    """
+    Readiness of ComfyUI over the lifetime of the worker
+
+    ComfyUI is probed actively only once, when the first job (or the boot of
+    the worker) asks for it. After that the state is kept up to date by
+    passive signals: every successful call or websocket connection marks
+    ComfyUI as ready, every failed one as degraded, and too many failures in
+    a row as dead. Jobs on a dead ComfyUI only pay for a single quick probe,
+    which also lets the worker recover when ComfyUI comes back.
+
+    Besides, the worker is warm once its warmup workflows loaded the models
+    into ComfyUI, see record_warmup().
+
+    Args:
+        boot_probe (callable): Waits until ComfyUI is up, returns True on success
+        probe (callable): Checks once if ComfyUI is up, returns True on success
+        dead_after_failures (int): Failures in a row after which ComfyUI is considered dead
+        on_recovered (callable, optional): Called when ComfyUI answers again after it was degraded or dead
+    """
+
+    def __init__(self, boot_probe, probe, dead_after_failures=3, on_recovered=None):
+        self.boot_probe = boot_probe
+        self.probe = probe
+        self.dead_after_failures = dead_after_failures
+        self.on_recovered = on_recovered
+        self.state = STARTING
+        self.consecutive_failures = 0
+        self.last_error = None
+        self.changed_at = time.time()
+        # None until the warmup is done, then whether all warmup workflows succeeded
+        self.warm = None
+        # The name, status, elapsed_s and error of every warmup workflow
+        self.warmup = []
+        # Reentrant, as the probes report their own results through record_success()
+        self._lock = threading.RLock()
+
+    def _set_state(self, state):
+        if state != self.state:
+            print(f"runpod-worker-comfy - ComfyUI is {state} (was {self.state})")
+            recovered = state == READY and self.state in (DEGRADED, DEAD)
+            self.state = state
+            self.changed_at = time.time()
+            if recovered and self.on_recovered is not None:
+                self.on_recovered()
+
+    def record_success(self):
+        """A call to ComfyUI succeeded."""
+        # Skip the lock in the common case, this is called for every request
+        if self.state == READY and self.consecutive_failures == 0:
+            return
+        with self._lock:
+            self.consecutive_failures = 0
+            self.last_error = None
+            self._set_state(READY)
+
+    def record_failure(self, error=None):
+        """A call to ComfyUI failed because it could not be reached."""
+        with self._lock:
+            self.consecutive_failures += 1
+            self.last_error = str(error) if error is not None else None
+            # Failures during the boot probe are expected, it decides on its own
+            if self.state == STARTING:
+                return
+            if self.consecutive_failures >= self.dead_after_failures:
+                self._set_state(DEAD)
+            else:
+                self._set_state(DEGRADED)
+
+    def wait_until_ready(self):
+        """
+        Make sure that ComfyUI can take a job
+
+        Returns:
+            bool: True if ComfyUI is ready or degraded, False if it is dead
+        """
+        if self.state in (READY, DEGRADED):
+            return True
+
+        if self.state == STARTING:
+            # Only one job runs the boot probe, the others wait for its result
+            with self._lock:
+                if self.state == STARTING:
+                    ready = self.boot_probe()
+                    self.consecutive_failures = 0 if ready else self.dead_after_failures
+                    self._set_state(READY if ready else DEAD)
+            return self.state != DEAD
+
+        # ComfyUI is dead, give it one more chance without waiting
+        if self.probe():
+            self.record_success()
+            return True
+        return False
+
+    def record_warmup(self, warm, results):
+        """
+        The warmup is done
+
+        Args:
+            warm (bool): Whether all warmup workflows succeeded, a worker that isn't warm is unhealthy
+            results (list): The result of every warmup workflow
+        """
+        with self._lock:
+            self.warm = warm
+            self.warmup = results
+        print(f"runpod-worker-comfy - the worker is {'warm' if warm else 'unhealthy, its warmup failed'}")
+
+    def snapshot(self):
+        """The current state as a dictionary, e.g. for logs or the job output."""
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "last_error": self.last_error,
+            "since": self.changed_at,
+            "warm": self.warm,
+            "warmup": self.warmup,
+        }
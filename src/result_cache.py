@@ -0,0 +1,174 @@
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+# Inputs that hold the seed of a node, a negative seed is drawn by the node itself
+SEED_INPUTS = {"seed", "noise_seed"}
+
+
+def canonical_workflow(workflow, image_hashes=None):
+    """
+    Reduce a workflow to what decides its result
+
+    The _meta of the nodes (titles) is dropped, and input values that name an
+    image of the job are replaced by "sha256:<hash of the image>", so that the
+    same image under another name gives the same workflow.
+
+    Args:
+        workflow (dict): The workflow in the API format of ComfyUI
+        image_hashes (dict, optional): The SHA-256 of the input images of the job, by name
+
+    Returns:
+        dict: The canonical workflow
+    """
+    image_hashes = image_hashes or {}
+    canonical = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            canonical[node_id] = node
+            continue
+        canonical[node_id] = {
+            **{key: value for key, value in node.items() if key not in ("_meta", "inputs")},
+            "inputs": {
+                name: f"sha256:{image_hashes[value]}"
+                if isinstance(value, str) and value in image_hashes
+                else value
+                for name, value in (node.get("inputs") or {}).items()
+            },
+        }
+    return canonical
+
+
+def cache_key(workflow, image_hashes=None):
+    """The SHA-256 of the canonical workflow, with sorted keys."""
+    canonical = canonical_workflow(workflow, image_hashes)
+    return hashlib.sha256(
+        json.dumps(canonical, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def draws_random_seed(workflow, exclude_classes=()):
+    """
+    Whether ComfyUI draws a random value while it runs the workflow
+
+    That is the case for nodes of the given classes and for seeds below 0,
+    which some seed nodes replace by a random one.
+    """
+    for node in workflow.values():
+        if not isinstance(node, dict):
+            continue
+        if node.get("class_type") in exclude_classes:
+            return True
+        for name, value in (node.get("inputs") or {}).items():
+            if name in SEED_INPUTS and isinstance(value, (int, float)) and value < 0:
+                return True
+    return False
+
+
+class LocalCacheIndex:
+    """
+    Cache entries as JSON files on the local disk or the network volume
+
+    Args:
+        root (str): The folder of the index
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, key):
+        return os.path.join(self.root, key[:2], f"{key}.json")
+
+    def read(self, key):
+        """The entry for a key, or None if there is none."""
+        try:
+            with open(self.path(key), "rb") as entry_file:
+                return json.loads(entry_file.read())
+        except FileNotFoundError:
+            return None
+
+    def write(self, key, entry):
+        """Store an entry atomically, so that readers never see half of it."""
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as entry_file:
+                json.dump(entry, entry_file)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+
+class S3CacheIndex:
+    """
+    Cache entries as small JSON objects in a bucket, shared by all workers
+
+    A lookup is a single GET request. The entries are the body of the objects, so
+    that results with many images fit, unlike in the 2 KB of user metadata of S3.
+
+    Args:
+        get_client (callable): Returns the boto3 S3 client
+        bucket (str): The bucket of the index
+        prefix (str): The prefix of the keys of the index
+    """
+
+    def __init__(self, get_client, bucket, prefix="result-cache/"):
+        self.get_client = get_client
+        self.bucket = bucket
+        self.prefix = prefix
+
+    def read(self, key):
+        """The entry for a key, or None if there is none."""
+        # Only imported for a bucket, the local index works without boto3
+        from botocore.exceptions import ClientError
+
+        try:
+            response = self.get_client().get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") in ("404", "NoSuchKey", "NotFound"):
+                return None
+            raise
+        body = response["Body"].read()
+        if body:
+            return json.loads(body)
+        # Earlier workers kept the entry in the metadata of an empty object
+        entry = response.get("Metadata", {}).get("entry")
+        return json.loads(entry) if entry else None
+
+    def write(self, key, entry):
+        """Store an entry."""
+        self.get_client().put_object(
+            Bucket=self.bucket,
+            Key=self.prefix + key,
+            Body=json.dumps(entry, separators=(",", ":")).encode(),
+            ContentType="application/json",
+        )
+
+
+class ResultCache:
+    """
+    Results of earlier jobs by the cache key of their workflow
+
+    Args:
+        index: Where the entries are kept, a LocalCacheIndex or an S3CacheIndex
+        ttl (float): Seconds after which an entry is not used anymore
+    """
+
+    def __init__(self, index, ttl):
+        self.index = index
+        self.ttl = ttl
+
+    def get(self, key):
+        """The result stored for a key, or None if there is none or it is too old."""
+        entry = self.index.read(key)
+        if entry is None or time.time() - entry.get("created_at", 0) > self.ttl:
+            return None
+        return entry["result"]
+
+    def put(self, key, result):
+        """Store the result of a job."""
+        self.index.write(key, {"created_at": round(time.time(), 3), "result": result})
@@ -0,0 +1,292 @@
+import fcntl
+import heapq
+import json
+import os
+import shutil
+import threading
+import time
+import uuid
+
+
+class ResultSpool:
+    """
+    Persistent write-behind spool for output images
+
+    Images are moved into the spool folder together with a small JSON file that
+    describes where they have to go. A background thread uploads them and
+    removes them from the spool, retrying failed uploads with exponential
+    backoff.
+
+    Several workers can share the folder, like on a network volume. Every
+    image is locked by the worker that uploads it, and the lock goes away with
+    the worker. Images whose worker went away are claimed when the spool
+    starts and every rescan_interval seconds after that.
+
+    Args:
+        root (str): The folder of the spool
+        upload (callable): Called with (path, bucket, key, content_type) to upload an image
+        max_attempts (int): Attempts per image before it is moved to the 'failed' subfolder
+        retry_delay (float): Seconds to wait after the first failed attempt, doubled on every attempt
+        rescan_interval (float): Seconds between two looks for images left by other workers
+    """
+
+    def __init__(self, root, upload, max_attempts=5, retry_delay=1.0, rescan_interval=60.0):
+        self.root = root
+        self.upload = upload
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.rescan_interval = rescan_interval
+        self.uploaded_total = 0
+        self.failed_total = 0
+        # Spooled images by entry ID
+        self._entries = {}
+        # The file descriptors that hold the locks of the entries, by entry ID
+        self._locks = {}
+        # Entries that can't be read, so that they are only reported once
+        self._broken = set()
+        # Called once an entry is uploaded, by entry ID. Kept in memory only, so replayed entries have none.
+        self._on_uploaded = {}
+        # (ready_at, sequence, entry ID) of the images waiting for their next attempt
+        self._pending = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def _entry_path(self, entry_id):
+        return os.path.join(self.root, f"{entry_id}.json")
+
+    def _lock_path(self, entry_id):
+        return os.path.join(self.root, f"{entry_id}.lock")
+
+    def _claim(self, entry_id):
+        """
+        Lock an entry for this worker
+
+        The lock has a file of its own, as the entry is replaced on every attempt.
+
+        Returns:
+            int: The file descriptor that holds the lock, or None if another worker has it
+        """
+        lock = os.open(self._lock_path(entry_id), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(lock)
+            return None
+        return lock
+
+    def _release(self, entry_id):
+        """Remove the lock file of an entry that left the spool and unlock it."""
+        lock = self._locks.pop(entry_id)
+        try:
+            os.unlink(self._lock_path(entry_id))
+        except FileNotFoundError:
+            pass
+        os.close(lock)
+
+    def _write_entry(self, entry_id, entry):
+        temp_path = self._entry_path(entry_id) + ".tmp"
+        with open(temp_path, "w") as entry_file:
+            json.dump(entry, entry_file)
+        os.replace(temp_path, self._entry_path(entry_id))
+
+    def _schedule(self, entry_id, ready_at):
+        self._sequence += 1
+        heapq.heappush(self._pending, (ready_at, self._sequence, entry_id))
+        self._condition.notify_all()
+
+    def start(self):
+        """Replay the images left in the spool and start uploading in the background."""
+        with self._condition:
+            if self._thread is not None:
+                return
+            os.makedirs(self.root, exist_ok=True)
+            self._claim_orphans()
+
+            self._thread = threading.Thread(target=self._run, name="result-spool", daemon=True)
+            self._thread.start()
+
+    def _claim_orphans(self):
+        """Claim the images that no worker uploads, like the ones of a worker that went away."""
+        replayed = []
+        try:
+            names = os.listdir(self.root)
+        except OSError as e:
+            # Like a network volume that is briefly gone, the next rescan tries again
+            print(f"runpod-worker-comfy - can't look for images left in the result spool: {str(e)}")
+            return
+        for name in names:
+            if not name.endswith(".json"):
+                continue
+            entry_id = name[: -len(".json")]
+            if entry_id in self._entries or name in self._broken:
+                continue
+            lock = self._claim(entry_id)
+            if lock is None:
+                continue
+            try:
+                with open(self._entry_path(entry_id)) as entry_file:
+                    entry = json.load(entry_file)
+            except FileNotFoundError:
+                # Its worker uploaded it in the meantime
+                self._locks[entry_id] = lock
+                self._release(entry_id)
+                continue
+            except (OSError, ValueError) as e:
+                print(f"runpod-worker-comfy - skipping broken spool entry {name}: {str(e)}")
+                self._broken.add(name)
+                os.close(lock)
+                continue
+            self._locks[entry_id] = lock
+            replayed.append((entry["created_at"], entry_id, entry))
+
+        for _, entry_id, entry in sorted(replayed):
+            self._entries[entry_id] = entry
+            self._schedule(entry_id, 0)
+        if replayed:
+            print(f"runpod-worker-comfy - replaying {len(replayed)} image(s) from the result spool")
+
+    def enqueue(self, image_location, bucket, key, content_type, on_uploaded=None):
+        """
+        Move an image into the spool, it is uploaded in the background
+
+        Args:
+            image_location (str): The path of the image, the file is moved
+            bucket (str): The bucket to upload to
+            key (str): The key of the uploaded image
+            content_type (str): The content type of the uploaded image
+            on_uploaded (callable, optional): Called without arguments on the thread of the spool once
+                                              the image is uploaded, never if its upload fails for good
+        """
+        self.start()
+
+        entry_id = f"{time.time():.6f}-{uuid.uuid4().hex[:8]}"
+        lock = self._claim(entry_id)
+        data_name = entry_id + os.path.splitext(image_location)[1]
+        data_path = os.path.join(self.root, data_name)
+        shutil.move(image_location, data_path)
+
+        entry = {
+            "data": data_name,
+            "bucket": bucket,
+            "key": key,
+            "content_type": content_type,
+            "size": os.path.getsize(data_path),
+            "created_at": time.time(),
+            "attempts": 0,
+        }
+        # The entry is written last, so a crash in between leaves no entry without its image
+        self._write_entry(entry_id, entry)
+
+        with self._condition:
+            self._locks[entry_id] = lock
+            self._entries[entry_id] = entry
+            if on_uploaded is not None:
+                self._on_uploaded[entry_id] = on_uploaded
+            self._schedule(entry_id, 0)
+
+    def _remove(self, entry_id, entry):
+        # The entry goes first, so that other workers don't pick up the image
+        for path in (self._entry_path(entry_id), os.path.join(self.root, entry["data"])):
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+        self._release(entry_id)
+
+    def _give_up(self, entry_id, entry):
+        failed_folder = os.path.join(self.root, "failed")
+        os.makedirs(failed_folder, exist_ok=True)
+        for name in (f"{entry_id}.json", entry["data"]):
+            try:
+                os.replace(os.path.join(self.root, name), os.path.join(failed_folder, name))
+            except FileNotFoundError:
+                pass
+        self._release(entry_id)
+
+    def _run(self):
+        next_rescan = time.time() + self.rescan_interval
+        while True:
+            with self._condition:
+                while not self._pending or self._pending[0][0] > time.time():
+                    now = time.time()
+                    if now >= next_rescan:
+                        self._claim_orphans()
+                        next_rescan = now + self.rescan_interval
+                        continue
+                    ready_at = min(self._pending[0][0], next_rescan) if self._pending else next_rescan
+                    self._condition.wait(ready_at - now)
+                _, _, entry_id = heapq.heappop(self._pending)
+                entry = self._entries[entry_id]
+
+            try:
+                self.upload(
+                    os.path.join(self.root, entry["data"]),
+                    entry["bucket"],
+                    entry["key"],
+                    entry["content_type"],
+                )
+                error = None
+            except Exception as e:
+                error = e
+
+            with self._condition:
+                on_uploaded = self._on_uploaded.pop(entry_id, None) if error is None else None
+                if error is None:
+                    self._remove(entry_id, entry)
+                    del self._entries[entry_id]
+                    self.uploaded_total += 1
+                else:
+                    entry["attempts"] += 1
+                    print(
+                        f"runpod-worker-comfy - uploading {entry['key']} from the result spool failed "
+                        f"(attempt {entry['attempts']}/{self.max_attempts}): {str(error)}"
+                    )
+                    if entry["attempts"] >= self.max_attempts:
+                        self._give_up(entry_id, entry)
+                        del self._entries[entry_id]
+                        self._on_uploaded.pop(entry_id, None)
+                        self.failed_total += 1
+                    else:
+                        self._write_entry(entry_id, entry)
+                        delay = self.retry_delay * 2 ** (entry["attempts"] - 1)
+                        self._schedule(entry_id, time.time() + delay)
+                self._condition.notify_all()
+
+            if on_uploaded is not None:
+                try:
+                    on_uploaded()
+                except Exception as e:
+                    print(f"runpod-worker-comfy - after uploading {entry['key']} from the result spool: {str(e)}")
+
+    def stats(self):
+        """Depth and age of the spool, e.g. for logs and metrics."""
+        with self._condition:
+            entries = list(self._entries.values())
+        oldest = min((entry["created_at"] for entry in entries), default=None)
+        return {
+            "depth": len(entries),
+            "bytes": sum(entry["size"] for entry in entries),
+            "oldest_age_s": round(time.time() - oldest, 3) if oldest is not None else 0.0,
+            "uploaded_total": self.uploaded_total,
+            "failed_total": self.failed_total,
+        }
+
+    def drain(self, timeout=None):
+        """
+        Block until the spool is empty, e.g. before the worker is torn down
+
+        Args:
+            timeout (float, optional): Seconds to wait at most
+
+        Returns:
+            bool: True if the spool is empty
+        """
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._condition:
+            while self._entries:
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
@@ -1,32 +1,352 @@
-import runpod
-from runpod.serverless.utils import rp_upload
-import json
-import urllib.request
-import urllib.parse
-import time
 import os
-import requests
-import base64
-from io import BytesIO
-from typing import Optional
-import uuid
+import time
+from cold_start import ColdStartTimeline
+
+# Created first, so that the imports below are part of the cold-start timeline
+cold_start_timeline = ColdStartTimeline(
+    os.environ.get("COLD_START_MARKS_PATH", "/tmp/cold_start_marks"),
+    os.environ.get("COMFY_LOG_PATH", "/tmp/comfyui.log"),
+)
+with cold_start_timeline.profile_imports():
+    import atexit
+    import asyncio
+    import json
+    import random
+    import signal
+    import sys
+    import base64
+    import binascii
+    import hashlib
+    import posixpath
+    import shutil
+    import tempfile
+    import threading
+    import urllib.parse
+    from concurrent.futures import ThreadPoolExecutor
+    from typing import Optional
+    import uuid
+    import websocket
+    from comfy_http import ComfyHttpClient, ComfyHttpError
+    from comfy_events import ComfyEventRouter
+    from progress import ProgressTracker
+    from readiness import ComfyReadiness, DEAD, DEGRADED, READY
+    from input_store import InputStore, is_sha256
+    from job_deadline import JobDeadline, JobTimeoutError
+    from job_timings import NO_TIMINGS, JobTimings
+    from job_trace import JobTracer
+    from metrics import MetricsRegistry, MetricsSampler, MetricsServer
+    from node_profiler import NodeProfiler, NodeProfileStore
+    from result_cache import (
+        LocalCacheIndex,
+        ResultCache,
+        S3CacheIndex,
+        cache_key,
+        draws_random_seed,
+    )
+    from result_spool import ResultSpool
+    from variant_scheduler import VariantScheduler
+    from warmup import WarmupError, fix_seeds, limit_steps, load_warmup_input, parse_warmup_specs
+    from workflow_bindings import BindingError, WorkflowBindings
+    from workflow_optimizer import optimize_workflow
+    from workflow_templates import TemplateError, WorkflowTemplates
+    from workflow_validator import WorkflowValidator
 
+# runpod and boto3 take seconds to import, runpod is imported once ComfyUI is booting, boto3 on first use
+cold_start_timeline.mark("handler_imported")
 
 # Time to wait between API check attempts in milliseconds
 COMFY_API_AVAILABLE_INTERVAL_MS = 50
-# Maximum number of API check attempts
-COMFY_API_AVAILABLE_MAX_RETRIES = 500
+# Seconds ComfyUI may take to boot with all of its custom nodes, jobs wait that long before it is considered dead
+COMFY_BOOT_TIMEOUT_S = float(os.environ.get("COMFY_BOOT_TIMEOUT_S", 600))
 # Time to wait between poll attempts in milliseconds
 COMFY_POLLING_INTERVAL_MS = int(os.environ.get("COMFY_POLLING_INTERVAL_MS", 250))
 # Maximum number of poll attempts
 COMFY_POLLING_MAX_RETRIES = int(os.environ.get("COMFY_POLLING_MAX_RETRIES", 500))
+# Seconds a job may take before its prompts are cancelled, by default as long as the poll attempts take
+COMFY_JOB_TIMEOUT_S = float(
+    os.environ.get("COMFY_JOB_TIMEOUT_S", COMFY_POLLING_MAX_RETRIES * COMFY_POLLING_INTERVAL_MS / 1000)
+)
+# Seconds an executing prompt may go without progress before it is interrupted, 0 to disable
+COMFY_STALL_TIMEOUT_S = float(os.environ.get("COMFY_STALL_TIMEOUT_S", 120))
+# Seconds between two looks at the status of the running jobs in RunPod, to stop the cancelled ones, 0 to disable
+COMFY_CANCEL_CHECK_INTERVAL_S = float(os.environ.get("COMFY_CANCEL_CHECK_INTERVAL_S", 5))
+# API key of RunPod to read the status of the jobs with, without one cancelled jobs run to the end
+RUNPOD_API_KEY = os.environ.get("RUNPOD_API_KEY", "")
+# The endpoint of the worker, set by RunPod
+RUNPOD_ENDPOINT_ID = os.environ.get("RUNPOD_ENDPOINT_ID", "")
+# Measure the phases of every job, return them as "timings" and log them in one line
+COMFY_JOB_TIMINGS = os.environ.get("COMFY_JOB_TIMINGS", "true").lower() == "true"
+# Folder in which the execution times of the nodes of every prompt are added up per day, empty to disable
+NODE_PROFILE_PATH = os.environ.get("NODE_PROFILE_PATH", "")
+# Days after which the node profiles are removed
+NODE_PROFILE_RETENTION_DAYS = int(os.environ.get("NODE_PROFILE_RETENTION_DAYS", 7))
+# Percentage of the jobs that record a Chrome trace of their phases and nodes, jobs can ask for one with "trace"
+COMFY_TRACE_SAMPLE_PERCENT = float(os.environ.get("COMFY_TRACE_SAMPLE_PERCENT", 0))
+# Where the traces go: "disk" writes them to COMFY_TRACE_PATH, "inline" returns them as "trace"
+COMFY_TRACE_OUTPUT = os.environ.get("COMFY_TRACE_OUTPUT", "disk").lower()
+# Folder of the trace files, one "<job ID>.trace.json" per traced job
+COMFY_TRACE_PATH = os.environ.get("COMFY_TRACE_PATH", "/tmp/comfy-traces")
+# Maximum number of spans a trace keeps, the oldest are dropped first
+COMFY_TRACE_MAX_EVENTS = int(os.environ.get("COMFY_TRACE_MAX_EVENTS", 10000))
+# Port of the Prometheus endpoint /metrics, 0 to disable
+COMFY_METRICS_PORT = int(os.environ.get("COMFY_METRICS_PORT", 0))
+# Folder to which a snapshot of the metrics is appended as a JSON line every interval, empty to disable
+COMFY_METRICS_PATH = os.environ.get("COMFY_METRICS_PATH", "")
+# Seconds between two samples of the gauges of ComfyUI and two snapshots
+COMFY_METRICS_INTERVAL_S = float(os.environ.get("COMFY_METRICS_INTERVAL_S", 15))
+# Days after which the metrics snapshots are removed
+COMFY_METRICS_RETENTION_DAYS = int(os.environ.get("COMFY_METRICS_RETENTION_DAYS", 7))
+# Workflows that run before the worker takes jobs, comma separated template references or job
+# input files like /test_input.json, empty to take jobs right away
+COMFY_WARMUP_WORKFLOWS = parse_warmup_specs(os.environ.get("COMFY_WARMUP_WORKFLOWS", "jasper-color@2"))
+# Seed of every sampler of the warmup workflows
+COMFY_WARMUP_SEED = int(os.environ.get("COMFY_WARMUP_SEED", 1))
+# Steps every sampler of the warmup workflows runs at most, 0 to keep the steps of the workflows
+COMFY_WARMUP_STEPS = int(os.environ.get("COMFY_WARMUP_STEPS", 2))
+# Seconds a warmup workflow may take
+COMFY_WARMUP_TIMEOUT_S = float(os.environ.get("COMFY_WARMUP_TIMEOUT_S", 600))
+# Record the metrics of every job, only when they are served or written somewhere
+COMFY_METRICS = bool(COMFY_METRICS_PORT or COMFY_METRICS_PATH)
 # Host where ComfyUI is running
 COMFY_HOST = "127.0.0.1:8188"
+# How to find out that a prompt is done: "websocket" waits for the execution
+# events of ComfyUI, "polling" asks /history until the outputs show up
+COMFY_COMPLETION_MODE = os.environ.get("COMFY_COMPLETION_MODE", "websocket").lower()
+# Time in seconds without any websocket event before /history is checked once
+COMFY_WEBSOCKET_RECV_TIMEOUT_S = float(
+    os.environ.get("COMFY_WEBSOCKET_RECV_TIMEOUT_S", 10)
+)
+# Seconds to wait for a TCP connection to ComfyUI
+COMFY_HTTP_CONNECT_TIMEOUT_S = float(os.environ.get("COMFY_HTTP_CONNECT_TIMEOUT_S", 5))
+# Seconds to wait for a response from ComfyUI
+COMFY_HTTP_READ_TIMEOUT_S = float(os.environ.get("COMFY_HTTP_READ_TIMEOUT_S", 30))
+# How often idempotent requests to ComfyUI are retried on connection errors
+COMFY_HTTP_MAX_RETRIES = int(os.environ.get("COMFY_HTTP_MAX_RETRIES", 3))
+# How input images get to ComfyUI: "http" uploads them to /upload/image, "filesystem"
+# writes them into COMFY_INPUT_PATH, "auto" uses the filesystem if that folder is writable
+COMFY_INPUT_STAGING = os.environ.get("COMFY_INPUT_STAGING", "auto").lower()
+# The input folder of ComfyUI, used when the worker and ComfyUI share a disk
+COMFY_INPUT_PATH = os.environ.get("COMFY_INPUT_PATH", "/app/ComfyUI/input")
+# Where input images are kept by their hash, so clients can send the hash instead of
+# the image next time. Uses the network volume if there is one, "" disables the store.
+INPUT_STORE_PATH = os.environ.get(
+    "INPUT_STORE_PATH",
+    "/runpod-volume/input_store"
+    if os.path.isdir("/runpod-volume")
+    else os.path.join(tempfile.gettempdir(), "input_store"),
+)
+# Size budget of the input store in MB, the least recently used images are removed first
+INPUT_STORE_MAX_MB = int(os.environ.get("INPUT_STORE_MAX_MB", 2048))
+# How many input images are decoded and uploaded to ComfyUI at the same time
+COMFY_UPLOAD_CONCURRENCY = int(os.environ.get("COMFY_UPLOAD_CONCURRENCY", 4))
+# How many jobs the worker runs at the same time. With more than one, the inputs of the
+# next job are uploaded and its prompt is queued while ComfyUI renders the current one.
+COMFY_MAX_CONCURRENT_JOBS = int(os.environ.get("COMFY_MAX_CONCURRENT_JOBS", 1))
+# Stream progress updates (node, step, previews) while the workflow runs, the
+# output of the job is then the list of all updates with the result as the last item
+COMFY_STREAM_PROGRESS = os.environ.get("COMFY_STREAM_PROGRESS", "false").lower() == "true"
+# Minimum time between two progress updates in milliseconds
+COMFY_PROGRESS_INTERVAL_MS = int(os.environ.get("COMFY_PROGRESS_INTERVAL_MS", 500))
+# Longer side of the preview images in progress updates in pixels, 0 leaves them out.
+# ComfyUI only sends previews when it was started with --preview-method.
+COMFY_PREVIEW_MAX_SIZE = int(os.environ.get("COMFY_PREVIEW_MAX_SIZE", 0))
+# How many output images are uploaded to AWS S3 or encoded as base64 at the same time
+COMFY_OUTPUT_CONCURRENCY = int(os.environ.get("COMFY_OUTPUT_CONCURRENCY", 4))
+# Images larger than this (in MB) are uploaded to AWS S3 in parts
+BUCKET_MULTIPART_THRESHOLD_MB = int(os.environ.get("BUCKET_MULTIPART_THRESHOLD_MB", 8))
+# Size of each part of a multipart upload in MB
+BUCKET_MULTIPART_CHUNKSIZE_MB = int(os.environ.get("BUCKET_MULTIPART_CHUNKSIZE_MB", 8))
+# How many parts of a single image are uploaded at the same time
+BUCKET_MAX_CONCURRENCY = int(os.environ.get("BUCKET_MAX_CONCURRENCY", 4))
+# How many connections to AWS S3 are kept open
+BUCKET_MAX_POOL_CONNECTIONS = int(
+    os.environ.get(
+        "BUCKET_MAX_POOL_CONNECTIONS",
+        max(10, COMFY_OUTPUT_CONCURRENCY * BUCKET_MAX_CONCURRENCY),
+    )
+)
+# Return the presigned URLs right away and upload the output images in the background
+BUCKET_WRITE_BEHIND = os.environ.get("BUCKET_WRITE_BEHIND", "false").lower() == "true"
+# Where output images wait for their upload in write-behind mode. Uses the network volume
+# if there is one, which all workers share, so that the images of a worker that went away
+# are uploaded by the next one.
+RESULT_SPOOL_PATH = os.environ.get(
+    "RESULT_SPOOL_PATH",
+    "/runpod-volume/result_spool"
+    if os.path.isdir("/runpod-volume")
+    else os.path.join(tempfile.gettempdir(), "result_spool"),
+)
+# Attempts per spooled image before it is moved to the 'failed' subfolder of the spool
+RESULT_SPOOL_MAX_ATTEMPTS = int(os.environ.get("RESULT_SPOOL_MAX_ATTEMPTS", 5))
+# Seconds the worker waits for the spool to be uploaded before it shuts down or is refreshed
+RESULT_SPOOL_DRAIN_TIMEOUT_S = float(os.environ.get("RESULT_SPOOL_DRAIN_TIMEOUT_S", 300))
+# Return the result of an earlier job with the same workflow and input images instead of
+# running it again: "local" keeps the index in RESULT_CACHE_PATH, "s3" in RESULT_CACHE_BUCKET
+RESULT_CACHE = os.environ.get("RESULT_CACHE", "off").lower()
+# Folder of the local index of the result cache, on the network volume if there is one
+RESULT_CACHE_PATH = os.environ.get(
+    "RESULT_CACHE_PATH",
+    "/runpod-volume/result_cache"
+    if os.path.isdir("/runpod-volume")
+    else os.path.join(tempfile.gettempdir(), "result_cache"),
+)
+# Bucket of the index of the result cache that all workers share
+RESULT_CACHE_BUCKET = os.environ.get("RESULT_CACHE_BUCKET", "")
+# Seconds a cached result is used, below the 7 days the presigned URLs are valid
+RESULT_CACHE_TTL_S = float(os.environ.get("RESULT_CACHE_TTL_S", 6 * 24 * 3600))
+# Node types that draw random values while ComfyUI runs them, separated by ","
+RESULT_CACHE_EXCLUDE_NODES = {
+    name.strip() for name in os.environ.get("RESULT_CACHE_EXCLUDE_NODES", "").split(",") if name.strip()
+}
+# Folders with workflow templates (<name>/<version>.json), separated by ":". The templates
+# baked into the image come first, the network volume can add more without a rebuild.
+WORKFLOW_TEMPLATE_PATHS = os.environ.get(
+    "WORKFLOW_TEMPLATE_PATHS", "/workflow_templates:/runpod-volume/workflow_templates"
+)
+# Most variants one job may ask for, see run_variants()
+COMFY_MAX_BATCH_SIZE = int(os.environ.get("COMFY_MAX_BATCH_SIZE", 50))
+# Run the variants of a job in the order in which ComfyUI can reuse the most nodes
+COMFY_ORDER_VARIANTS = os.environ.get("COMFY_ORDER_VARIANTS", "true").lower() == "true"
+# Connect switches with a constant selection straight to their selected input and drop
+# the nodes that no output depends on, before the workflow is queued
+COMFY_OPTIMIZE_WORKFLOW = os.environ.get("COMFY_OPTIMIZE_WORKFLOW", "true").lower() == "true"
+# Print the optimized workflow of every job, to check what the optimizer removed
+COMFY_OPTIMIZE_DEBUG = os.environ.get("COMFY_OPTIMIZE_DEBUG", "false").lower() == "true"
+# Check workflows against the node definitions of ComfyUI (/object_info) before they are queued
+COMFY_VALIDATE_WORKFLOW = os.environ.get("COMFY_VALIDATE_WORKFLOW", "true").lower() == "true"
+# Seconds before a workflow that fails the checks may fetch the node definitions again
+OBJECT_INFO_REFRESH_INTERVAL_S = float(os.environ.get("OBJECT_INFO_REFRESH_INTERVAL_S", 60))
+# The custom nodes of ComfyUI, the node definitions are fetched again when they change
+COMFY_CUSTOM_NODES_PATH = os.environ.get("COMFY_CUSTOM_NODES_PATH", "/app/ComfyUI/custom_nodes")
+# Failed calls in a row after which ComfyUI is considered dead
+COMFY_DEAD_AFTER_FAILURES = int(os.environ.get("COMFY_DEAD_AFTER_FAILURES", 3))
 # Enforce a clean state after each job is done
 # see https://docs.runpod.io/docs/handler-additional-controls#refresh-worker
 REFRESH_WORKER = os.environ.get("REFRESH_WORKER", "false").lower() == "true"
 
 
+def wait_for_comfy_boot():
+    """Wait until ComfyUI is up at the boot of the worker, and mark that in the cold-start timeline."""
+    ready = check_server(
+        f"http://{COMFY_HOST}",
+        delay=COMFY_API_AVAILABLE_INTERVAL_MS,
+        timeout_s=COMFY_BOOT_TIMEOUT_S,
+    )
+    cold_start_timeline.mark("comfyui_ready" if ready else "comfyui_dead")
+    return ready
+
+
+# Checked once at boot or when the first job arrives, then kept up to date by the calls to ComfyUI
+comfy_readiness = ComfyReadiness(
+    boot_probe=wait_for_comfy_boot,
+    probe=lambda: check_server(f"http://{COMFY_HOST}", 1, 0),
+    dead_after_failures=COMFY_DEAD_AFTER_FAILURES,
+    # ComfyUI may have restarted with an empty input folder while it was unreachable
+    on_recovered=lambda: staged_inputs.clear(),
+)
+
+input_store = (
+    InputStore(INPUT_STORE_PATH, INPUT_STORE_MAX_MB * 1024 * 1024)
+    if INPUT_STORE_PATH
+    else None
+)
+# The hash of every input image this worker handed to ComfyUI, by name
+staged_inputs = {}
+# The nodes that load an input image from the input folder of ComfyUI, with the input that names it
+IMAGE_LOADER_INPUTS = {"LoadImage": "image", "LoadImageMask": "image"}
+
+# Each template is parsed when the first job uses it
+workflow_templates = WorkflowTemplates(
+    [path for path in WORKFLOW_TEMPLATE_PATHS.split(":") if path]
+)
+
+# Fetches the node definitions at boot or with the first job
+workflow_validator = WorkflowValidator(
+    fetch=lambda: comfy_http_client.get_json(f"http://{COMFY_HOST}/object_info"),
+    fingerprint=lambda: custom_nodes_fingerprint(),
+    refresh_interval=OBJECT_INFO_REFRESH_INTERVAL_S,
+)
+
+# Only results that were uploaded to a bucket are cached
+if RESULT_CACHE == "local":
+    result_cache = ResultCache(LocalCacheIndex(RESULT_CACHE_PATH), RESULT_CACHE_TTL_S)
+elif RESULT_CACHE == "s3":
+    result_cache = ResultCache(
+        S3CacheIndex(lambda: get_boto_client()[0], RESULT_CACHE_BUCKET), RESULT_CACHE_TTL_S
+    )
+else:
+    result_cache = None
+
+# Knows the last workflow this worker queued, to plan the order of the next variants
+variant_scheduler = VariantScheduler()
+
+# Adds up the node timings of every prompt, print them with "python node_profiler.py"
+node_profile_store = (
+    NodeProfileStore(NODE_PROFILE_PATH, NODE_PROFILE_RETENTION_DAYS) if NODE_PROFILE_PATH else None
+)
+
+# Created on first use by get_boto_client()
+_boto_client = None
+_boto_client_lock = threading.Lock()
+
+# Starts uploading in the background when the first image is spooled, or at boot
+result_spool = (
+    ResultSpool(
+        RESULT_SPOOL_PATH,
+        upload=lambda *args: upload_spooled_image(*args),
+        max_attempts=RESULT_SPOOL_MAX_ATTEMPTS,
+    )
+    if BUCKET_WRITE_BEHIND
+    else None
+)
+
+# Shared by all calls to ComfyUI, so that connections are reused between jobs
+comfy_http_client = ComfyHttpClient(
+    connect_timeout=COMFY_HTTP_CONNECT_TIMEOUT_S,
+    read_timeout=COMFY_HTTP_READ_TIMEOUT_S,
+    max_retries=COMFY_HTTP_MAX_RETRIES,
+    pool_size=max(16, COMFY_UPLOAD_CONCURRENCY),
+    on_success=comfy_readiness.record_success,
+    on_failure=comfy_readiness.record_failure,
+)
+
+# Shared by the jobs when the worker runs more than one at a time, connects on first use
+comfy_event_router = ComfyEventRouter(
+    connect=lambda client_id: connect_websocket(client_id),
+    recv_timeout=COMFY_WEBSOCKET_RECV_TIMEOUT_S,
+    on_success=comfy_readiness.record_success,
+    on_failure=comfy_readiness.record_failure,
+)
+
+# Runs the synchronous handler for async_handler, one thread per concurrent job
+_job_executor = ThreadPoolExecutor(max_workers=COMFY_MAX_CONCURRENT_JOBS)
+# How many jobs async_handler is running right now
+_active_jobs = 0
+# Seconds between two looks for a free job slot while the worker runs COMFY_MAX_CONCURRENT_JOBS jobs
+JOB_SLOT_POLL_S = 0.1
+# The config the worker hands to runpod.serverless.start, stream_handler sets its 'refresh_worker'
+worker_config = {}
+# The deadline of every running job by its ID, so that a cancelled job can be stopped
+_job_deadlines = {}
+
+# The metrics of the worker, see record_job_metrics() and sample_metrics()
+metrics = MetricsRegistry()
+jobs_total = metrics.counter("comfy_worker_jobs_total", "Jobs handled by the worker", ("status",))
+job_seconds = metrics.histogram("comfy_worker_job_seconds", "Time from the start to the result of a job", ("status",))
+job_phase_seconds = metrics.histogram(
+    "comfy_worker_job_phase_seconds", "Time a job spent in a phase, see the timings of the job", ("phase",)
+)
+output_images_total = metrics.counter("comfy_worker_output_images_total", "Output images returned by jobs")
+cached_results_total = metrics.counter("comfy_worker_cached_results_total", "Jobs answered from the result cache")
+active_jobs_gauge = metrics.gauge("comfy_worker_active_jobs", "Jobs the worker is running")
+result_spool_depth_gauge = metrics.gauge("comfy_worker_result_spool_depth", "Images waiting in the result spool")
+comfy_up_gauge = metrics.gauge("comfy_up", "1 if ComfyUI answers, 0 if it is starting or dead")
+warm_gauge = metrics.gauge("comfy_worker_warm", "1 once the warmup workflows succeeded")
+comfy_queue_gauge = metrics.gauge("comfy_queue_prompts", "Prompts in the queue of ComfyUI", ("state",))
+comfy_ram_gauge = metrics.gauge("comfy_ram_bytes", "RAM of the machine of ComfyUI", ("kind",))
+comfy_vram_gauge = metrics.gauge("comfy_vram_bytes", "VRAM of every device of ComfyUI", ("device", "kind"))
+
+
 def validate_input(job_input):
     """
     Validates the input for the handler function.
@@ -49,27 +369,253 @@ def validate_input(job_input):
         except json.JSONDecodeError:
             return None, "Invalid JSON format in input"
 
-    # Validate 'workflow' in input
+    # Validate 'workflow' in input, or build it from a template. The parameters
+    # are bound to the inputs of the template or the workflow.
     workflow = job_input.get("workflow")
+    template = job_input.get("template")
+    params = job_input.get("params")
+    if params is not None and not isinstance(params, dict):
+        return None, "'params' must be an object"
+    try:
+        if workflow is None and template is not None:
+            workflow = workflow_templates.expand(template, params)
+        elif isinstance(workflow, dict) and params:
+            workflow = WorkflowBindings(workflow).apply(params)
+    except (TemplateError, BindingError) as e:
+        return None, str(e)
     if workflow is None:
         return None, "Missing 'workflow' parameter"
 
-    # Validate 'images' in input, if provided
+    # Validate 'images' in input, if provided. Images that were sent before
+    # can be referenced by their hash instead of sending them again.
     images = job_input.get("images")
     if images is not None:
         if not isinstance(images, list) or not all(
-            "name" in image and "image" in image for image in images
+            isinstance(image, dict)
+            and "name" in image
+            and ("image" in image or "sha256" in image)
+            for image in images
         ):
             return (
                 None,
-                "'images' must be a list of objects with 'name' and 'image' keys",
+                "'images' must be a list of objects with 'name' and either 'image' or 'sha256' keys",
+            )
+        if not all(
+            "sha256" not in image or is_sha256(image["sha256"]) for image in images
+        ):
+            return None, "'sha256' must be a lowercase hex encoded SHA-256 digest"
+
+    # Validate 'timeout_s', if provided, it replaces COMFY_JOB_TIMEOUT_S for this job
+    validated_data = {"workflow": workflow, "images": images}
+    timeout = job_input.get("timeout_s")
+    if timeout is not None:
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            return None, "'timeout_s' must be a positive number of seconds"
+        validated_data["timeout_s"] = timeout
+
+    # Validate 'profile', if provided, it adds the execution time of every node to the result
+    profile = job_input.get("profile")
+    if profile is not None:
+        if not isinstance(profile, bool):
+            return None, "'profile' must be a boolean"
+        validated_data["profile"] = profile
+
+    # Validate 'trace', if provided, it records a Chrome trace of the job
+    trace = job_input.get("trace")
+    if trace is not None and not isinstance(trace, bool):
+        return None, "'trace' must be a boolean"
+
+    # Validate 'variants', if provided. Every variant is a set of parameters that is
+    # bound on top of 'params', an error only fails its own variant.
+    variants = job_input.get("variants")
+    if variants is None:
+        # Return validated data and no error
+        return validated_data, None
+
+    if not isinstance(variants, list) or not variants or not all(
+        isinstance(variant, dict) for variant in variants
+    ):
+        return None, "'variants' must be a non-empty list of objects"
+    if len(variants) > COMFY_MAX_BATCH_SIZE:
+        return None, f"At most {COMFY_MAX_BATCH_SIZE} variants are allowed per job, got {len(variants)}"
+
+    try:
+        if job_input.get("workflow") is None:
+            bindings = workflow_templates.bindings(template)
+        else:
+            bindings = WorkflowBindings(job_input["workflow"])
+    except (TemplateError, BindingError) as e:
+        return None, str(e)
+
+    base_input = {key: value for key, value in job_input.items() if key != "variants"}
+    validated_variants = []
+    for variant in variants:
+        variant_params = {**(params or {}), **variant}
+        try:
+            validated_variants.append(
+                {
+                    "workflow": bindings.apply(variant_params),
+                    # For result_cache_key(), as if the variant was a job of its own
+                    "input": {**base_input, "params": variant_params},
+                }
             )
+        except BindingError as e:
+            validated_variants.append({"error": str(e)})
+
+    return {**validated_data, "variants": validated_variants}, None
+
+
+def custom_nodes_fingerprint():
+    """
+    The names and modification times of the custom nodes, they change when a custom node is added or updated
+
+    Returns:
+        tuple: The fingerprint, None if the folder is not on this disk
+    """
+    try:
+        return tuple(
+            sorted((entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(COMFY_CUSTOM_NODES_PATH))
+        )
+    except OSError:
+        return None
+
+
+def validate_workflow(workflow):
+    """
+    Check a workflow against the node definitions of ComfyUI, see WorkflowValidator
+
+    Returns:
+        list: Every error that was found, empty if the workflow is valid or can't be checked
+    """
+    try:
+        return workflow_validator.validate(workflow)
+    except (ComfyHttpError, ValueError) as e:
+        # ComfyUI still validates the workflow when it is queued
+        print(f"runpod-worker-comfy - skipping the validation of the workflow: {str(e)}")
+        return []
+
+
+def result_cache_key(job_input, workflow, images):
+    """
+    The key of a job in the result cache, see result_cache.cache_key
+
+    Returns:
+        str: The key, or None if the job must not be cached: the cache is off, the job
+             sets 'cache' to false, or a seed is drawn by the worker or by ComfyUI
+    """
+    if result_cache is None:
+        return None
+    if isinstance(job_input, str):
+        job_input = json.loads(job_input)
+    if job_input.get("cache") is False:
+        return None
+    if job_input.get("workflow") is None and job_input.get("template") is not None:
+        bindings = workflow_templates.bindings(job_input["template"])
+        if bindings.draws_random_seed(job_input.get("params")):
+            return None
+    if draws_random_seed(workflow, RESULT_CACHE_EXCLUDE_NODES):
+        return None
+
+    image_hashes = input_image_hashes(images)
+    if image_hashes is None:
+        return None
+    return cache_key(workflow, image_hashes)
+
+
+def input_image_hashes(images):
+    """
+    The SHA-256 of every input image of a job
+
+    Returns:
+        dict: The hash by image name, or None if an image can't be decoded, the upload reports it
+    """
+    image_hashes = {}
+    for image in images or []:
+        if "sha256" in image:
+            image_hashes[image["name"]] = image["sha256"]
+        else:
+            try:
+                image_hashes[image["name"]] = hashlib.sha256(
+                    base64.b64decode(image["image"])
+                ).hexdigest()
+            except (binascii.Error, ValueError):
+                return None
+    return image_hashes
+
 
-    # Return validated data and no error
-    return {"workflow": workflow, "images": images}, None
+def get_cached_result(key):
+    """The cached result of a job, or None if there is none or the cache can't be read."""
+    try:
+        cached = result_cache.get(key)
+    except (OSError, ValueError, *boto_errors()) as e:
+        print(f"runpod-worker-comfy - can't read the result cache: {str(e)}")
+        return None
+    if cached is None or "message" in cached:
+        return cached
+    # Like process_output_images, the message is the first image
+    return {"message": cached["images"][0]["data"], **cached}
+
+
+def cache_result(key, result):
+    """Keep the result of a job in the result cache, if all of its images are in a bucket, see PendingCacheEntry."""
+    if result.get("status") != "success" or not all(
+        image.get("type") == "s3_url" for image in result["images"]
+    ):
+        return
+    images = [
+        {name: image[name] for name in ("node_id", "filename", "type", "data")}
+        for image in result["images"]
+    ]
+    try:
+        # The message repeats the first image, get_cached_result adds it again
+        result_cache.put(key, {"images": images})
+        print(f"runpod-worker-comfy - cached the result as {key}")
+    except (OSError, ValueError, *boto_errors()) as e:
+        print(f"runpod-worker-comfy - can't write the result cache: {str(e)}")
+
+
+class PendingCacheEntry:
+    """
+    A result that goes into the result cache once all of its images are confirmed in their bucket
+
+    With BUCKET_WRITE_BEHIND the images are uploaded after the job returned, and their
+    upload can still fail, so that the cache would hand out dead links. Images that were
+    only copied to 'simulated_uploaded' are never confirmed.
 
+    Args:
+        key (str): The key of the result, see result_cache_key
+    """
 
-def check_server(url, retries=500, delay=50):
+    def __init__(self, key):
+        self.key = key
+        self._uploaded = 0
+        self._result = None
+        self._lock = threading.Lock()
+
+    def uploaded(self):
+        """Confirm the upload of an image, passed to process_output_images as on_uploaded."""
+        with self._lock:
+            self._uploaded += 1
+            result = self._ready()
+        if result is not None:
+            cache_result(self.key, result)
+
+    def set_result(self, result):
+        """Cache the result of the job now, or once the last of its images is uploaded."""
+        with self._lock:
+            self._result = result
+            result = self._ready()
+        if result is not None:
+            cache_result(self.key, result)
+
+    def _ready(self):
+        if self._result is None or self._uploaded < len(self._result.get("images") or []):
+            return None
+        result, self._result = self._result, None
+        return result
+
+
+def check_server(url, retries=500, delay=50, timeout_s=None):
     """
     Check if a server is reachable via HTTP GET request
 
@@ -77,20 +623,25 @@ def check_server(url, retries=500, delay=50):
     - url (str): The URL to check
     - retries (int, optional): The number of times to attempt connecting to the server. Default is 50
     - delay (int, optional): The time in milliseconds to wait between retries. Default is 500
+    - timeout_s (float, optional): Keep trying for this many seconds instead of a number of retries
 
     Returns:
     bool: True if the server is reachable within the given number of retries, otherwise False
     """
 
-    for i in range(retries):
+    deadline = time.monotonic() + timeout_s if timeout_s is not None else None
+    attempts = 0
+    while attempts < retries if deadline is None else attempts == 0 or time.monotonic() < deadline:
+        attempts += 1
         try:
-            response = requests.get(url)
+            # The loop does the retrying, so every attempt is a single request
+            response = comfy_http_client.get(url, retries=0)
 
             # If the response status code is 200, the server is up and running
-            if response.status_code == 200:
+            if response.status == 200:
                 print(f"runpod-worker-comfy - API is reachable")
                 return True
-        except requests.RequestException as e:
+        except ComfyHttpError as e:
             # If an exception occurs, the server may not be ready
             pass
 
@@ -98,47 +649,273 @@ def check_server(url, retries=500, delay=50):
         time.sleep(delay / 1000)
 
     print(
-        f"runpod-worker-comfy - Failed to connect to server at {url} after {retries} attempts."
+        f"runpod-worker-comfy - Failed to connect to server at {url} after {attempts} attempts."
     )
     return False
 
 
-def upload_images(images):
+def use_filesystem_staging():
+    """Check if input images should be written directly into the input folder of ComfyUI."""
+    if COMFY_INPUT_STAGING == "filesystem":
+        return True
+    if COMFY_INPUT_STAGING == "auto":
+        return os.path.isdir(COMFY_INPUT_PATH) and os.access(COMFY_INPUT_PATH, os.W_OK)
+    return False
+
+
+def write_input_image(name, blob):
+    """
+    Write an image into the input folder of ComfyUI.
+
+    The image is written to a temporary file next to its destination first and then
+    renamed, so ComfyUI never sees a half-written image.
+
+    Args:
+        name (str): The name of the image, as used in the workflow
+        blob (bytes): The decoded image
+
+    Returns:
+        str: The path of the written image
+    """
+    input_path = os.path.realpath(COMFY_INPUT_PATH)
+    image_path = os.path.realpath(os.path.join(input_path, name))
+    if os.path.commonpath([input_path, image_path]) != input_path or image_path == input_path:
+        raise ValueError(f"'{name}' is not a valid image name")
+
+    image_dir = os.path.dirname(image_path)
+    os.makedirs(image_dir, exist_ok=True)
+    with tempfile.NamedTemporaryFile(
+        dir=image_dir, prefix=".upload-", suffix=".tmp", delete=False
+    ) as temp_file:
+        try:
+            temp_file.write(blob)
+        except BaseException:
+            os.unlink(temp_file.name)
+            raise
+    os.replace(temp_file.name, image_path)
+    return image_path
+
+
+def upload_input_image(image):
+    """
+    Decode a single base64 encoded image and hand it to ComfyUI.
+
+    The image is written directly into the input folder of ComfyUI when possible
+    (see COMFY_INPUT_STAGING), otherwise it is uploaded using the /upload/image endpoint.
+    Images sent with their bytes are added to the input store, images sent
+    only with their 'sha256' are read from it.
+
+    Args:
+        image (dict): A dictionary containing the 'name' of the image and either the 'image' as a base64 encoded string or its 'sha256'.
+
+    Returns:
+        tuple: A tuple of (message, error), where exactly one of them is None.
+    """
+    name = image["name"]
+    sha256 = image.get("sha256")
+    if "image" in image:
+        try:
+            blob = base64.b64decode(image["image"])
+        except (binascii.Error, ValueError) as e:
+            return None, f"Error decoding {name}: {str(e)}"
+
+        if input_store is not None:
+            try:
+                stored_sha256 = input_store.put(blob)
+            except OSError as e:
+                print(f"runpod-worker-comfy - could not store {name}: {str(e)}")
+            else:
+                if sha256 is not None and sha256 != stored_sha256:
+                    return None, f"Error decoding {name}: the image doesn't match its 'sha256'"
+                sha256 = stored_sha256
+    else:
+        blob = None
+
+    if sha256 is None and COMFY_MAX_CONCURRENT_JOBS > 1:
+        sha256 = hashlib.sha256(blob).hexdigest()
+    name = staged_image_name(name, sha256)
+
+    # ComfyUI still has this image from an earlier job
+    if sha256 is not None and staged_inputs.get(name) == sha256 and comfy_has_input_image(name):
+        return f"Successfully uploaded {name}", None
+
+    if blob is None:
+        blob = input_store.get(sha256) if input_store is not None else None
+        if blob is None:
+            return None, f"Error uploading {name}: {sha256} is not in the input store"
+
+    message, error = stage_input_image(name, blob)
+    if error is None and sha256 is not None:
+        staged_inputs[name] = sha256
+    return message, error
+
+
+def comfy_has_input_image(name):
+    """
+    Check if the input folder of ComfyUI still has an image, which can be gone after ComfyUI restarted
+
+    Args:
+        name (str): The name of the image in the input folder
+
+    Returns:
+        bool: True if ComfyUI can load the image
+    """
+    if use_filesystem_staging():
+        return os.path.exists(os.path.join(COMFY_INPUT_PATH, name))
+    folder, filename = posixpath.split(name)
+    query = urllib.parse.urlencode({"filename": filename, "subfolder": folder, "type": "input"})
+    try:
+        # HEAD, so that ComfyUI doesn't send the image
+        response = comfy_http_client.request("HEAD", f"http://{COMFY_HOST}/view?{query}")
+    except ComfyHttpError:
+        return False
+    return response.status == 200
+
+
+def staged_image_name(name, sha256):
+    """
+    The name under which an input image is handed to ComfyUI
+
+    When several jobs run at once, two of them can send different images with the same
+    name while the prompt of one of them is already queued. Then every image gets a name
+    of its own, its name prefixed with the start of its SHA-256, see use_staged_image_names.
+
+    Args:
+        name (str): The name of the image in the job
+        sha256 (str): The hash of the image
+
+    Returns:
+        str: The name of the image in the input folder of ComfyUI
+    """
+    if COMFY_MAX_CONCURRENT_JOBS == 1:
+        return name
+    folder, base_name = posixpath.split(name)
+    return posixpath.join(folder, f"{sha256[:16]}-{base_name}")
+
+
+def use_staged_image_names(workflow, images):
+    """
+    Let the nodes of a workflow that load an input image use the name it was staged under
+
+    Only the image input of the nodes in IMAGE_LOADER_INPUTS is renamed, other inputs, like
+    prompts, may just happen to be the name of an image.
+
+    Args:
+        workflow (dict): The workflow, it isn't changed
+        images (list): The uploaded 'images' of the job input
+
+    Returns:
+        dict: The workflow, only the nodes that load an input image are copied
+    """
+    if COMFY_MAX_CONCURRENT_JOBS == 1 or not images:
+        return workflow
+    names = {
+        name: staged_image_name(name, sha256)
+        for name, sha256 in (input_image_hashes(images) or {}).items()
+    }
+    workflow = dict(workflow)
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict) or node.get("class_type") not in IMAGE_LOADER_INPUTS:
+            continue
+        inputs = node.get("inputs")
+        input_name = IMAGE_LOADER_INPUTS[node["class_type"]]
+        if not isinstance(inputs, dict) or not isinstance(inputs.get(input_name), str):
+            continue
+        if inputs[input_name] in names:
+            workflow[node_id] = {**node, "inputs": {**inputs, input_name: names[inputs[input_name]]}}
+    return workflow
+
+
+def stage_input_image(name, blob):
+    """
+    Hand a decoded image to ComfyUI, see upload_input_image.
+
+    Returns:
+        tuple: A tuple of (message, error), where exactly one of them is None.
+    """
+    # Skip HTTP when ComfyUI reads its inputs from the same disk
+    if use_filesystem_staging():
+        try:
+            write_input_image(name, blob)
+            return f"Successfully uploaded {name}", None
+        except ValueError as e:
+            return None, f"Error uploading {name}: {str(e)}"
+        except OSError as e:
+            print(
+                f"runpod-worker-comfy - writing {name} to {COMFY_INPUT_PATH} failed, uploading it instead: {str(e)}"
+            )
+
+    # Prepare the form data
+    fields = {
+        "image": (name, blob, "image/png"),
+        "overwrite": "true",
+    }
+
+    # POST request to upload the image, which can be retried as it overwrites the image
+    try:
+        response = comfy_http_client.post(
+            f"http://{COMFY_HOST}/upload/image", fields=fields, idempotent=True
+        )
+    except ComfyHttpError as e:
+        return None, f"Error uploading {name}: {str(e)}"
+
+    if response.status != 200:
+        return None, f"Error uploading {name}: {response.data.decode('utf-8', 'replace')}"
+    return f"Successfully uploaded {name}", None
+
+
+def find_missing_inputs(images):
     """
-    Upload a list of base64 encoded images to the ComfyUI server using the /upload/image endpoint.
+    Find the images that were sent only with their hash, but are not in the input store
+
+    Args:
+        images (list): The validated 'images' of the job input
+
+    Returns:
+        list: A list of {'name', 'sha256'} dictionaries, one per missing image
+    """
+    return [
+        {"name": image["name"], "sha256": image["sha256"]}
+        for image in images or []
+        if "image" not in image
+        and (input_store is None or not input_store.has(image["sha256"]))
+    ]
+
+
+def upload_images(images, tracer=None):
+    """
+    Upload a list of base64 encoded images to the ComfyUI server, see upload_input_image.
+
+    Up to COMFY_UPLOAD_CONCURRENCY images are decoded and uploaded at the same time.
 
     Args:
         images (list): A list of dictionaries, each containing the 'name' of the image and the 'image' as a base64 encoded string.
-        server_address (str): The address of the ComfyUI server.
+        tracer (JobTracer, optional): Records the upload of every image as a span
 
     Returns:
-        list: A list of responses from the server for each image upload.
+        dict: The status of the upload, with one message per image (in the order of the images) in 'details'.
     """
     if not images:
         return {"status": "success", "message": "No images to upload", "details": []}
 
-    responses = []
-    upload_errors = []
-
     print(f"runpod-worker-comfy - image(s) upload")
 
-    for image in images:
-        name = image["name"]
-        image_data = image["image"]
-        blob = base64.b64decode(image_data)
+    upload = upload_input_image
+    if tracer is not None:
 
-        # Prepare the form data
-        files = {
-            "image": (name, BytesIO(blob), "image/png"),
-            "overwrite": (None, "true"),
-        }
+        def upload(image):
+            with tracer.span("upload_input_image", image=image.get("name")):
+                return upload_input_image(image)
 
-        # POST request to upload the image
-        response = requests.post(f"http://{COMFY_HOST}/upload/image", files=files)
-        if response.status_code != 200:
-            upload_errors.append(f"Error uploading {name}: {response.text}")
-        else:
-            responses.append(f"Successfully uploaded {name}")
+    concurrency = max(1, min(COMFY_UPLOAD_CONCURRENCY, len(images)))
+    if concurrency == 1:
+        results = [upload(image) for image in images]
+    else:
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(upload, images))
+
+    responses = [message for message, error in results if error is None]
+    upload_errors = [error for message, error in results if error is not None]
 
     if upload_errors:
         print(f"runpod-worker-comfy - image(s) upload with errors")
@@ -156,22 +933,25 @@ def upload_images(images):
     }
 
 
-def queue_workflow(workflow):
+def queue_workflow(workflow, client_id=None):
     """
     Queue a workflow to be processed by ComfyUI
 
     Args:
         workflow (dict): A dictionary containing the workflow to be processed
+        client_id (str, optional): The ID of the websocket client that should receive the execution events
 
     Returns:
         dict: The JSON response from ComfyUI after processing the workflow
     """
 
     # The top level element "prompt" is required by ComfyUI
-    data = json.dumps({"prompt": workflow}).encode("utf-8")
+    payload = {"prompt": workflow}
+    if client_id is not None:
+        payload["client_id"] = client_id
 
-    req = urllib.request.Request(f"http://{COMFY_HOST}/prompt", data=data)
-    return json.loads(urllib.request.urlopen(req).read())
+    # Not retried, as this could queue the workflow twice
+    return comfy_http_client.post_json(f"http://{COMFY_HOST}/prompt", payload)
 
 
 def get_history(prompt_id):
@@ -184,8 +964,187 @@ def get_history(prompt_id):
     Returns:
         dict: The history of the prompt, containing all the processing steps and results
     """
-    with urllib.request.urlopen(f"http://{COMFY_HOST}/history/{prompt_id}") as response:
-        return json.loads(response.read())
+    return comfy_http_client.get_json(f"http://{COMFY_HOST}/history/{prompt_id}")
+
+
+def is_history_complete(history, prompt_id):
+    """Check if the history of a prompt contains its outputs."""
+    return prompt_id in history and bool(history[prompt_id].get("outputs"))
+
+
+def wait_for_history_polling(prompt_id, deadline=None, timings=None):
+    """
+    Poll the history of a prompt until its outputs are available
+
+    Args:
+        prompt_id (str): The ID of the prompt to wait for
+        deadline (JobDeadline, optional): The deadline of the job, by default COMFY_JOB_TIMEOUT_S from now
+        timings (JobTimings, optional): Where the time spent fetching the history is added up
+
+    Returns:
+        dict: The history of the prompt
+
+    Raises:
+        JobTimeoutError: If the deadline passed or the job was cancelled
+    """
+    deadline = deadline or JobDeadline(COMFY_JOB_TIMEOUT_S)
+    timings = timings or NO_TIMINGS
+    while True:
+        with timings.phase("history"):
+            history = get_history(prompt_id)
+
+        # Exit the loop if we have found the history
+        if is_history_complete(history, prompt_id):
+            return history
+
+        # Wait before trying again, but not past the deadline
+        deadline.check()
+        time.sleep(deadline.next_check(COMFY_POLLING_INTERVAL_MS / 1000))
+
+
+class ComfyExecutionError(Exception):
+    """Raised when ComfyUI reports that the execution of a prompt failed."""
+
+
+class JobFailedError(Exception):
+    """Raised by stream_handler when a job failed, so that the runpod SDK reports the job as failed."""
+
+
+def connect_websocket(client_id):
+    """Connect to the websocket of ComfyUI to receive the execution events of a client."""
+    ws = websocket.WebSocket()
+    ws.connect(
+        f"ws://{COMFY_HOST}/ws?clientId={client_id}",
+        timeout=COMFY_WEBSOCKET_RECV_TIMEOUT_S,
+    )
+    return ws
+
+
+def open_websocket(client_id):
+    """
+    Connect to the websocket of ComfyUI to receive the execution events of a client
+
+    Args:
+        client_id (str): The ID that is also sent along when queueing the workflow
+
+    Returns:
+        websocket.WebSocket: The connected websocket, or None if the connection failed
+    """
+    try:
+        ws = connect_websocket(client_id)
+        comfy_readiness.record_success()
+        return ws
+    except (websocket.WebSocketException, OSError) as e:
+        print(f"runpod-worker-comfy - websocket connection failed: {str(e)}")
+        comfy_readiness.record_failure(e)
+        return None
+
+
+def wait_for_history_websocket(ws, prompt_id, on_event=None, deadline=None, timings=None):
+    """
+    Wait for the execution events of a prompt and fetch its history once it is done
+
+    The history is only requested when ComfyUI reports that the prompt is done,
+    or when no event arrived for COMFY_WEBSOCKET_RECV_TIMEOUT_S seconds. Every
+    event of the prompt counts as progress for the watchdog of the deadline.
+
+    Args:
+        ws (websocket.WebSocket): A websocket connected with the client_id used to queue the prompt,
+            or the EventSubscription of the prompt
+        prompt_id (str): The ID of the prompt to wait for
+        on_event (callable, optional): Called with the type and data of every event of the prompt,
+            and with None and the message for binary messages
+        deadline (JobDeadline, optional): The deadline of the job, by default COMFY_JOB_TIMEOUT_S from now
+        timings (JobTimings, optional): Where the time spent fetching the history is added up
+
+    Returns:
+        dict: The history of the prompt
+
+    Raises:
+        ComfyExecutionError: If ComfyUI reports an error or an interruption for the prompt
+        JobTimeoutError: If the deadline passed, the prompt stalled or the job was cancelled
+        websocket.WebSocketException, OSError: If the websocket connection drops
+    """
+    deadline = deadline or JobDeadline(COMFY_JOB_TIMEOUT_S, COMFY_STALL_TIMEOUT_S)
+    timings = timings or NO_TIMINGS
+
+    while True:
+        deadline.check()
+        ws.settimeout(deadline.next_check(COMFY_WEBSOCKET_RECV_TIMEOUT_S))
+        try:
+            message = ws.recv()
+        except websocket.WebSocketTimeoutException:
+            # Make sure that we didn't miss the end of the execution
+            with timings.phase("history"):
+                history = get_history(prompt_id)
+            if is_history_complete(history, prompt_id):
+                return history
+            continue
+
+        # Binary messages are preview images
+        if not isinstance(message, str):
+            if deadline.last_progress is not None:
+                deadline.progress()
+            if on_event is not None:
+                on_event(None, message)
+            continue
+
+        event = json.loads(message)
+        data = event.get("data") or {}
+        if data.get("prompt_id") != prompt_id:
+            continue
+
+        # The first event of a prompt is "execution_start", the watchdog starts with it
+        deadline.progress()
+        event_type = event.get("type")
+        if on_event is not None:
+            on_event(event_type, data)
+        if event_type in ("execution_error", "execution_interrupted"):
+            raise ComfyExecutionError(
+                f"{event_type} in node {data.get('node_id')} ({data.get('node_type')}): "
+                f"{data.get('exception_message', 'interrupted')}"
+            )
+
+        # ComfyUI writes the history after "execution_success" and before the
+        # final "executing" event without a node
+        if event_type == "execution_success":
+            with timings.phase("history"):
+                history = get_history(prompt_id)
+            if is_history_complete(history, prompt_id):
+                return history
+        elif event_type == "executing" and data.get("node") is None:
+            with timings.phase("history"):
+                history = get_history(prompt_id)
+            if prompt_id in history:
+                return history
+
+
+def cancel_prompts(prompt_ids):
+    """
+    Free the GPU from prompts that are not needed anymore
+
+    Prompts that are still waiting are deleted from the queue of ComfyUI, the
+    running one is interrupted. Only prompts of the given IDs are touched, so
+    the prompts of other jobs keep running.
+
+    Args:
+        prompt_ids (list): The IDs of the prompts to cancel
+    """
+    if not prompt_ids:
+        return
+    try:
+        queue = comfy_http_client.get_json(f"http://{COMFY_HOST}/queue")
+        running = {item[1] for item in queue.get("queue_running", []) if len(item) > 1}
+        waiting = [prompt_id for prompt_id in prompt_ids if prompt_id not in running]
+        if waiting:
+            comfy_http_client.post_json(f"http://{COMFY_HOST}/queue", {"delete": waiting})
+        for prompt_id in prompt_ids:
+            if prompt_id in running:
+                # ComfyUI before v0.3.27 ignores the prompt_id and interrupts whatever runs
+                comfy_http_client.post_json(f"http://{COMFY_HOST}/interrupt", {"prompt_id": prompt_id})
+        print(f"runpod-worker-comfy - cancelled prompt(s) {', '.join(prompt_ids)}")
+    except ComfyHttpError as e:
+        print(f"runpod-worker-comfy - can't cancel prompt(s) {', '.join(prompt_ids)}: {str(e)}")
 
 
 def base64_encode(img_path):
@@ -218,50 +1177,252 @@ def parse_filename(filename):
         }
     return None
 
-def process_output_images(outputs, job_id):
-    """Modified to pass filename information to upload_image"""
-    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "app/ComfyUI/output")
-    
-    for node_id, node_output in outputs.items():
-        if "images" in node_output:
-            for image in node_output["images"]:
-                output_images = os.path.join(image["subfolder"], image["filename"])
-                filename_info = parse_filename(image["filename"])
-
-    print(f"runpod-worker-comfy - image generation is done")
-    local_image_path = f"{COMFY_OUTPUT_PATH}/{output_images}"
-    print(f"runpod-worker-comfy - {local_image_path}")
-
-    if os.path.exists(local_image_path):
+def collect_output_images(outputs):
+    """
+    Collect every image of every output node, in the order of the nodes.
+
+    Preview images are skipped, as ComfyUI only keeps them in its temp folder.
+
+    Args:
+        outputs (dict): The outputs of the prompt from its history
+
+    Returns:
+        list: A list of dictionaries with the 'node_id', 'filename' and 'subfolder' of each image
+    """
+    return [
+        {
+            "node_id": node_id,
+            "filename": image["filename"],
+            "subfolder": image.get("subfolder", ""),
+        }
+        for node_id, node_output in outputs.items()
+        for image in node_output.get("images", [])
+        if image.get("type", "output") != "temp"
+    ]
+
+
+def process_output_image(job_id, output_image, result_index, output_path, timings=None, on_uploaded=None):
+    """
+    Upload a single output image to AWS S3 or encode it as base64, see upload_image for on_uploaded.
+
+    Returns:
+        dict: The 'node_id' and 'filename' of the image, with either its 'type' and 'data' or an 'error'
+    """
+    timings = timings or NO_TIMINGS
+    local_image_path = os.path.join(
+        output_path, output_image["subfolder"], output_image["filename"]
+    )
+    result = {"node_id": output_image["node_id"], "filename": output_image["filename"]}
+
+    with timings.phase("read_output"):
+        exists = os.path.exists(local_image_path)
+    if not exists:
+        print(f"runpod-worker-comfy - the image does not exist in the output folder: {local_image_path}")
+        result["error"] = f"the image does not exist in the specified output folder: {local_image_path}"
+        return result
+
+    try:
         if os.environ.get("BUCKET_ENDPOINT_URL", False):
-            image = upload_image(job_id, local_image_path, filename_info=filename_info)
-            print("runpod-worker-comfy - the image was generated and uploaded to AWS S3")
+            result["type"] = "s3_url"
+            result["data"] = upload_image(
+                job_id,
+                local_image_path,
+                result_index=result_index,
+                filename_info=parse_filename(output_image["filename"]),
+                timings=timings,
+                on_uploaded=on_uploaded,
+            )
         else:
-            image = base64_encode(local_image_path)
-            print("runpod-worker-comfy - the image was generated and converted to base64")
+            result["type"] = "base64"
+            with timings.phase("read_output"):
+                with open(local_image_path, "rb") as image_file:
+                    image = image_file.read()
+            with timings.phase("encode"):
+                result["data"] = base64.b64encode(image).decode("utf-8")
+    except Exception as e:
+        print(f"runpod-worker-comfy - processing {local_image_path} failed: {str(e)}")
+        result.pop("type", None)
+        result["error"] = f"Error processing {output_image['filename']}: {str(e)}"
+
+    return result
+
 
+def process_output_images(outputs, job_id, timings=None, on_uploaded=None):
+    """
+    Upload every output image to AWS S3 or encode it as base64.
+
+    Up to COMFY_OUTPUT_CONCURRENCY images are processed at the same time.
+
+    Args:
+        outputs (dict): The outputs of the prompt from its history
+        job_id (str): The ID of the job, used for the S3 key if the filename can't be parsed
+        timings (JobTimings, optional): Where the time spent on every image is added up
+        on_uploaded (callable, optional): Called once per image that is confirmed in its bucket, see upload_image
+
+    Returns:
+        dict: The 'status', the first image as 'message' and every image with its
+              'node_id' and 'filename' in 'images'
+    """
+    COMFY_OUTPUT_PATH = os.environ.get("COMFY_OUTPUT_PATH", "app/ComfyUI/output")
+
+    output_images = collect_output_images(outputs)
+    print(f"runpod-worker-comfy - image generation is done, {len(output_images)} image(s)")
+
+    if not output_images:
         return {
-            "status": "success",
-            "message": image,
+            "status": "error",
+            "message": "the workflow did not produce any images",
+            "images": [],
         }
+
+    concurrency = max(1, min(COMFY_OUTPUT_CONCURRENCY, len(output_images)))
+    arguments = [
+        (job_id, output_image, index, COMFY_OUTPUT_PATH, timings, on_uploaded)
+        for index, output_image in enumerate(output_images)
+    ]
+    if concurrency == 1:
+        results = [process_output_image(*args) for args in arguments]
     else:
-        print("runpod-worker-comfy - the image does not exist in the output folder")
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            results = list(executor.map(lambda args: process_output_image(*args), arguments))
+
+    errors = [result["error"] for result in results if "error" in result]
+    if errors:
         return {
             "status": "error",
-            "message": f"the image does not exist in the specified output folder: {local_image_path}",
+            "message": errors[0] if len(errors) == 1 else f"{len(errors)} images failed: {'; '.join(errors)}",
+            "images": results,
         }
 
+    print(f"runpod-worker-comfy - the image(s) were generated and processed")
+    return {
+        "status": "success",
+        # The first image, for clients that expect a single one
+        "message": results[0]["data"],
+        "images": results,
+    }
+
+
+def boto_errors():
+    """The exceptions of boto3 that a call to S3 can raise, boto3 is only imported when they are needed."""
+    from botocore.exceptions import BotoCoreError, ClientError
+
+    return (BotoCoreError, ClientError)
+
+
+def get_boto_client():
+    """
+    Return the boto3 client and transfer config for the AWS S3 bucket, creating them on first use.
+
+    The client is shared by all jobs of the worker, so its connections to S3 are
+    reused. Its connection pool is large enough for COMFY_OUTPUT_CONCURRENCY
+    uploads, each with BUCKET_MAX_CONCURRENCY parts in flight.
+
+    Returns:
+        tuple: (boto_client, transfer_config), the client is None if the bucket is not configured
+    """
+    global _boto_client
+
+    if _boto_client is not None:
+        return _boto_client
+
+    with _boto_client_lock:
+        if _boto_client is None:
+            import boto3
+            from boto3.s3.transfer import TransferConfig
+            from botocore.config import Config as BotoConfig
+            from runpod.serverless.utils import rp_upload
+
+            endpoint_url = os.environ.get("BUCKET_ENDPOINT_URL", None)
+            access_key_id = os.environ.get("BUCKET_ACCESS_KEY_ID", None)
+            secret_access_key = os.environ.get("BUCKET_SECRET_ACCESS_KEY", None)
+
+            transfer_config = TransferConfig(
+                multipart_threshold=BUCKET_MULTIPART_THRESHOLD_MB * 1024 * 1024,
+                multipart_chunksize=BUCKET_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+                max_concurrency=BUCKET_MAX_CONCURRENCY,
+                use_threads=True,
+            )
+
+            boto_client = None
+            if endpoint_url and access_key_id and secret_access_key:
+                boto_client = boto3.session.Session().client(
+                    "s3",
+                    endpoint_url=endpoint_url,
+                    aws_access_key_id=access_key_id,
+                    aws_secret_access_key=secret_access_key,
+                    # With the region known, presigning needs no request to S3
+                    region_name=rp_upload.extract_region_from_url(endpoint_url),
+                    config=BotoConfig(
+                        signature_version="s3v4",
+                        retries={"max_attempts": 3, "mode": "standard"},
+                        max_pool_connections=BUCKET_MAX_POOL_CONNECTIONS,
+                        tcp_keepalive=True,
+                    ),
+                )
+
+            _boto_client = (boto_client, transfer_config)
+
+    return _boto_client
+
+
+def get_s3_key(job_id, image_location, result_index=0, filename_info=None):
+    """Determine the S3 key of an image based on the TEST_TOKEN / TEST_COLOR flags and its filename info."""
+    if filename_info:
+        test_token = os.environ.get("TEST_TOKEN", "false").lower() == "true"
+        test_color = os.environ.get("TEST_COLOR", "false").lower() == "true"
+
+        if test_token:
+            return f"{filename_info['vase_type']}/{filename_info['token']}/{filename_info['complete_filename']}"
+        if test_color:
+            return f"{filename_info['vase_type']}/{filename_info['color1']}/{filename_info['color2']}/{filename_info['complete_filename']}"
+        return filename_info['complete_filename']
+
+    # Fallback to original behavior if filename parsing fails
+    s3_key = job_id.replace('sync-', '')
+    if result_index:
+        # Every further image of the job gets its own key
+        s3_key = f"{s3_key}_{result_index}"
+    file_extension = os.path.splitext(image_location)[1]
+    return f"{s3_key}{file_extension}"
+
+
 def upload_image(
     job_id,
     image_location,
     result_index=0,
     results_list=None,
     bucket_name: Optional[str] = None,
-    filename_info=None
+    filename_info=None,
+    timings=None,
+    on_uploaded=None,
 ):
-    """Modified to implement conditional folder structure"""
-    boto_client, _ = rp_upload.get_boto_client()
-    
+    """
+    Upload an image to AWS S3 and return a presigned URL to it.
+
+    The image is streamed from disk by the managed transfer of boto3, which
+    switches to a multipart upload for images above BUCKET_MULTIPART_THRESHOLD_MB.
+    With BUCKET_WRITE_BEHIND, the image is moved into the result spool instead
+    and the URL is returned before the upload is done.
+
+    Args:
+        job_id (str): The ID of the job
+        image_location (str): The path of the image
+        result_index (int, optional): The position of the image in the output of the job
+        results_list (list, optional): A list in which the URL is also stored at result_index
+        bucket_name (str, optional): The bucket, by default named after the current date
+        filename_info (dict, optional): The parsed filename, see parse_filename
+        timings (JobTimings, optional): Where the time spent presigning and uploading is added up
+        on_uploaded (callable, optional): Called without arguments once the image is in the bucket, with
+                                          BUCKET_WRITE_BEHIND later on the thread of the result spool
+
+    Returns:
+        str: The presigned URL, or the path of the copy when no bucket is configured
+    """
+    timings = timings or NO_TIMINGS
+    s3_key = get_s3_key(job_id, image_location, result_index, filename_info)
+    boto_client, transfer_config = get_boto_client()
+
     if boto_client is None:
         # Save the output to a file
         print("No bucket endpoint set, saving to disk folder 'simulated_uploaded'")
@@ -270,11 +1431,10 @@ def upload_image(
             "https://github.com/runpod/runpod-python/blob/main/docs/serverless/utils/rp_upload.md"
         )  # pylint: disable=line-too-long
 
-        os.makedirs("simulated_uploaded", exist_ok=True)
-        sim_upload_location = f"simulated_uploaded/{image_name}{file_extension}"
-
-        with open(sim_upload_location, "wb") as file_output:
-            file_output.write(output)
+        sim_upload_location = os.path.join("simulated_uploaded", s3_key)
+        with timings.phase("upload"):
+            os.makedirs(os.path.dirname(sim_upload_location), exist_ok=True)
+            shutil.copyfile(image_location, sim_upload_location)
 
         if results_list is not None:
             results_list[result_index] = sim_upload_location
@@ -282,121 +1442,1039 @@ def upload_image(
         return sim_upload_location
 
     bucket = bucket_name if bucket_name else time.strftime("%d-%m-%y")
-    
-    # Determine the S3 key based on flags and filename info
-    if filename_info:
-        test_token = os.environ.get("TEST_TOKEN", "false").lower() == "true"
-        test_color = os.environ.get("TEST_COLOR", "false").lower() == "true"
-        
-        if test_token:
-            s3_key = f"{filename_info['vase_type']}/{filename_info['token']}/{filename_info['complete_filename']}"
-        elif test_color:
-            s3_key = f"{filename_info['vase_type']}/{filename_info['color1']}/{filename_info['color2']}/{filename_info['complete_filename']}"
+    content_type = "image/" + os.path.splitext(image_location)[1].lstrip(".")
+
+    # Presigning happens locally, so the URL can be handed out before the upload is done
+    with timings.phase("presign"):
+        presigned_url = boto_client.generate_presigned_url(
+            "get_object",
+            Params={"Bucket": f"{bucket}", "Key": s3_key},
+            ExpiresIn=604800,
+        )
+
+    with timings.phase("upload"):
+        if result_spool is not None:
+            result_spool.enqueue(image_location, bucket, s3_key, content_type, on_uploaded)
         else:
-            s3_key = filename_info['complete_filename']
-    else:
-        # Fallback to original behavior if filename parsing fails
-        s3_key = job_id.replace('sync-', '')
-        file_extension = os.path.splitext(image_location)[1]
-        s3_key = f"{s3_key}{file_extension}"
+            boto_client.upload_file(
+                image_location,
+                bucket,
+                s3_key,
+                ExtraArgs={"ContentType": content_type},
+                Config=transfer_config,
+            )
+            if on_uploaded is not None:
+                on_uploaded()
 
-    with open(image_location, "rb") as input_file:
-        output = input_file.read()
+    if results_list is not None:
+        results_list[result_index] = presigned_url
 
-    content_type = "image/" + os.path.splitext(image_location)[1].lstrip(".")
-    
-    boto_client.put_object(
-        Bucket=f"{bucket}",
-        Key=s3_key,
-        Body=output,
-        ContentType=content_type,
+    return presigned_url
+
+
+def upload_spooled_image(image_location, bucket, s3_key, content_type):
+    """Upload an image from the result spool to AWS S3, called by the spool in the background."""
+    boto_client, transfer_config = get_boto_client()
+    boto_client.upload_file(
+        image_location,
+        bucket,
+        s3_key,
+        ExtraArgs={"ContentType": content_type},
+        Config=transfer_config,
     )
 
-    # Generate presigned URL using the same key structure
-    presigned_url = boto_client.generate_presigned_url(
-        "get_object",
-        Params={"Bucket": f"{bucket}", "Key": s3_key},
-        ExpiresIn=604800,
+
+def drain_result_spool():
+    """
+    Wait until every spooled image is uploaded, so that none is lost when the worker goes away.
+
+    Returns:
+        bool: True if the spool is empty, False if RESULT_SPOOL_DRAIN_TIMEOUT_S passed first
+    """
+    if result_spool is None:
+        return True
+
+    stats = result_spool.stats()
+    if stats["depth"]:
+        print(
+            f"runpod-worker-comfy - waiting for {stats['depth']} spooled image(s) "
+            f"({stats['bytes'] / 1024 / 1024:.1f} MB) to be uploaded"
+        )
+    drained = result_spool.drain(RESULT_SPOOL_DRAIN_TIMEOUT_S)
+    if not drained:
+        print(
+            f"runpod-worker-comfy - result spool not drained after {RESULT_SPOOL_DRAIN_TIMEOUT_S}s, "
+            f"{result_spool.stats()['depth']} image(s) stay in {result_spool.root}"
+        )
+    return drained
+
+
+def prepare_workflow(workflow):
+    """
+    Optimize a workflow and check it against the node definitions of ComfyUI
+
+    Returns:
+        tuple: (workflow, error), the error is a result for the client or None
+    """
+    if COMFY_OPTIMIZE_WORKFLOW and isinstance(workflow, dict):
+        optimized = optimize_workflow(workflow, workflow_validator.output_classes())
+        print(
+            f"runpod-worker-comfy - optimized workflow from {len(workflow)} to {len(optimized)} nodes"
+        )
+        if COMFY_OPTIMIZE_DEBUG:
+            print(f"runpod-worker-comfy - optimized workflow: {json.dumps(optimized)}")
+        workflow = optimized
+
+    # Fail the job before its images are uploaded and it waits in the queue of ComfyUI
+    if COMFY_VALIDATE_WORKFLOW:
+        validation_errors = validate_workflow(workflow)
+        if validation_errors:
+            return workflow, {
+                "error": f"The workflow is not valid: {validation_errors[0]}",
+                "validation_errors": validation_errors,
+            }
+    return workflow, None
+
+
+def subscribe_to_events():
+    """
+    Listen for the execution events of the next prompt, call this before queueing it
+
+    Returns:
+        tuple: (client_id, ws), queue the prompt with the client_id. The ws is None in
+               polling mode, and must be bound to the prompt when it is an EventSubscription.
+    """
+    client_id = str(uuid.uuid4())
+    ws = None
+    if COMFY_COMPLETION_MODE == "websocket" and COMFY_MAX_CONCURRENT_JOBS > 1:
+        # Concurrent jobs share one connection, which routes the events by prompt_id
+        client_id = comfy_event_router.client_id
+        ws = comfy_event_router.subscribe(timeout=COMFY_HTTP_CONNECT_TIMEOUT_S)
+    elif COMFY_COMPLETION_MODE == "websocket":
+        ws = open_websocket(client_id)
+    return client_id, ws
+
+
+def wait_for_prompt(ws, prompt_id, on_event=None, deadline=None, timings=None):
+    """
+    Wait until ComfyUI is done with a prompt, through the websocket if there is one
+
+    When the deadline of the job passes or the job is cancelled, all prompts
+    of the job that are not done are cancelled, when the prompt stalls only
+    this one.
+
+    Returns:
+        tuple: (history, error), where exactly one of them is None
+    """
+    print(f"runpod-worker-comfy - wait until image generation is complete")
+    deadline = deadline or JobDeadline(COMFY_JOB_TIMEOUT_S, COMFY_STALL_TIMEOUT_S)
+    try:
+        if ws is not None:
+            try:
+                return wait_for_history_websocket(ws, prompt_id, on_event, deadline, timings), None
+            except (websocket.WebSocketException, OSError) as e:
+                # Fall back to polling when the websocket drops
+                print(
+                    f"runpod-worker-comfy - websocket dropped, falling back to polling: {str(e)}"
+                )
+                comfy_readiness.record_failure(e)
+        return wait_for_history_polling(prompt_id, deadline, timings), None
+    except JobTimeoutError as e:
+        stop = deadline.pending() if deadline.cancelled or not deadline.time_left() else [prompt_id]
+        print(f"runpod-worker-comfy - {str(e)}, cancelling the prompt(s) of the job")
+        cancel_prompts(stop)
+        for stopped in stop:
+            deadline.done(stopped)
+        return None, str(e)
+    except ComfyExecutionError as e:
+        if deadline.cancelled:
+            return None, "The job was cancelled"
+        return None, f"Error during image generation: {str(e)}"
+    except Exception as e:
+        return None, f"Error waiting for image generation: {str(e)}"
+    finally:
+        deadline.done(prompt_id)
+
+
+def track_progress(workflow, prompt_id, on_progress, **extra):
+    """An on_event callback for wait_for_prompt() that hands the updates of a ProgressTracker to on_progress."""
+    if on_progress is None:
+        return None
+    tracker = ProgressTracker(workflow, COMFY_PROGRESS_INTERVAL_MS / 1000, COMFY_PREVIEW_MAX_SIZE)
+
+    def on_event(event_type, data):
+        progress = tracker.update(event_type, data)
+        if progress is not None:
+            on_progress({"prompt_id": prompt_id, **extra, **progress})
+
+    return on_event
+
+
+def cached_nodes(history, prompt_id):
+    """The nodes of a prompt whose outputs ComfyUI took from its cache, from the "execution_cached" message of its history."""
+    nodes = set()
+    for message in ((history.get(prompt_id) or {}).get("status") or {}).get("messages") or []:
+        if isinstance(message, list) and len(message) == 2 and message[0] == "execution_cached":
+            nodes.update(message[1].get("nodes") or [])
+    return nodes
+
+
+def start_profile(workflow, profile, tracer=None):
+    """
+    A NodeProfiler for a prompt, if the job asked for its profile, is traced or the profiles are stored
+
+    Returns:
+        NodeProfiler: The profiler, or None if the node timings are not needed
+    """
+    if not profile and tracer is None and node_profile_store is None:
+        return None
+    return NodeProfiler(workflow)
+
+
+def trace_profile(profiler, tracer, **args):
+    """Add the nodes of a prompt to the trace of the job, if it is traced."""
+    if tracer is not None and profiler is not None:
+        tracer.add_profile(profiler, **args)
+
+
+def record_profile(profiler):
+    """Add the node timings of a prompt to the node_profile_store, if there is one."""
+    if node_profile_store is None or profiler is None:
+        return
+    try:
+        node_profile_store.record(profiler)
+    except (OSError, ValueError) as e:
+        print(f"runpod-worker-comfy - can't record the node profile: {str(e)}")
+
+
+def log_result_spool():
+    """Log the state of the result spool, and empty it when the worker is refreshed after the job."""
+    if result_spool is None:
+        return
+    stats = result_spool.stats()
+    print(
+        f"runpod-worker-comfy - result spool: {stats['depth']} image(s), "
+        f"{stats['bytes'] / 1024 / 1024:.1f} MB, oldest {stats['oldest_age_s']}s"
     )
+    if REFRESH_WORKER:
+        # The worker is torn down after this job, so its spool has to be empty
+        drain_result_spool()
 
-    if results_list is not None:
-        results_list[result_index] = presigned_url
 
-    return presigned_url
+def run_variants(job, variants, images, on_progress=None, deadline=None, timings=None, profile=False):
+    """
+    Run every variant of a job, see validate_input
 
+    The input images are uploaded once, then all variants are queued back to
+    back, so that ComfyUI starts the next one as soon as the current one is
+    done. Their results are collected in the order ComfyUI runs them.
+
+    Args:
+        job (dict): The job, its ID is used for the S3 keys of the variants
+        variants (list): The validated variants, each with its 'workflow' and 'input' or an 'error'
+        images (list): The validated 'images' of the job input
+        on_progress (callable, optional): Called with the progress updates and with the result
+            of every variant as soon as it is done
+        deadline (JobDeadline, optional): The deadline of the whole batch, by default
+            COMFY_JOB_TIMEOUT_S per variant from now
+        timings (JobTimings, optional): Where the time spent in every phase is added up, over all variants
+        profile (bool): Add the execution time of every node to the result of every variant
 
-def handler(job):
+    Returns:
+        dict: The result of every variant in 'variants', in the order of the input
+    """
+    started = time.monotonic()
+    deadline = deadline or JobDeadline(COMFY_JOB_TIMEOUT_S * len(variants), COMFY_STALL_TIMEOUT_S)
+    timings = timings or NO_TIMINGS
+    results = [None] * len(variants)
+
+    def finish(index, result):
+        results[index] = {"index": index, **result}
+        if on_progress is not None:
+            on_progress({"status": "variant", "variant": results[index]})
+
+    runnable = []
+    for index, variant in enumerate(variants):
+        if "error" in variant:
+            finish(index, {"status": "error", "error": variant["error"]})
+            continue
+        with timings.phase("prepare"):
+            workflow, error = prepare_workflow(variant["workflow"])
+        if error is not None:
+            finish(index, {"status": "error", **error})
+            continue
+        with timings.phase("cache"):
+            key = result_cache_key(variant["input"], workflow, images)
+            cached = get_cached_result(key) if key is not None else None
+        if cached is not None:
+            finish(index, {"status": "success", **cached, "cached": True})
+            continue
+        # Planned with the names ComfyUI sees, as the order depends on the nodes it has cached
+        runnable.append((index, use_staged_image_names(workflow, images), key))
+
+    # Neighbours that share nodes run one after the other, so that ComfyUI computes them once
+    expected = {}
+    if runnable:
+        order, expected_ratios, invalidated = variant_scheduler.plan(
+            [workflow for _, workflow, _ in runnable], reorder=COMFY_ORDER_VARIANTS
+        )
+        expected = {
+            runnable[position][0]: {
+                "expected": expected_ratios[position],
+                "invalidated_nodes": invalidated[position],
+            }
+            for position in range(len(runnable))
+        }
+        runnable = [runnable[position] for position in order]
+
+    if runnable:
+        with timings.phase("upload_inputs"):
+            missing_inputs = find_missing_inputs(images)
+        if missing_inputs:
+            return {
+                "error": "Some input images are not in the input store, send them again with 'image'",
+                "missing_inputs": missing_inputs,
+            }
+        with timings.phase("upload_inputs"):
+            upload_result = upload_images(images, timings.tracer)
+        if upload_result["status"] == "error":
+            return upload_result
+        try:
+            deadline.check()
+        except JobTimeoutError as e:
+            return {"error": str(e)}
+
+    # One connection for the whole batch, or one subscription per variant on the shared one
+    shared = COMFY_MAX_CONCURRENT_JOBS == 1 or COMFY_COMPLETION_MODE != "websocket"
+    with timings.phase("queue"):
+        client_id, ws = subscribe_to_events() if shared and runnable else (None, None)
+    queued = []
+    try:
+        for index, workflow, key in runnable:
+            # A failed subscription must not close the one of the variant before
+            events = None
+            try:
+                with timings.phase("queue"):
+                    variant_client_id, events = (client_id, ws) if shared else subscribe_to_events()
+                    prompt_id = queue_workflow(workflow, variant_client_id)["prompt_id"]
+            except Exception as e:
+                if not shared and events is not None:
+                    events.close()
+                finish(index, {"status": "error", "error": f"Error queuing workflow: {str(e)}"})
+                continue
+            if not shared and events is not None:
+                events.bind(prompt_id)
+            deadline.track(prompt_id)
+            queued.append((index, workflow, key, prompt_id, events, time.monotonic()))
+            variant_scheduler.record(workflow)
+        print(f"runpod-worker-comfy - queued {len(queued)} of {len(variants)} variants")
+
+        previous_done = started
+        while queued:
+            index, workflow, key, prompt_id, events, queued_at = queued.pop(0)
+            on_progress_event = track_progress(workflow, prompt_id, on_progress, variant=index)
+            profiler = start_profile(workflow, profile, timings.tracer)
+            if profiler is not None:
+                on_progress_event = profiler.wrap(on_progress_event)
+            cached = set()
+
+            def on_event(event_type, data):
+                if event_type == "execution_cached":
+                    cached.update(data.get("nodes") or [])
+                if on_progress_event is not None:
+                    on_progress_event(event_type, data)
+
+            try:
+                with timings.phase("wait"):
+                    history, error = wait_for_prompt(events, prompt_id, on_event, deadline, timings)
+            finally:
+                if not shared and events is not None:
+                    events.close()
+            trace_profile(profiler, timings.tracer, variant=index)
+            done = time.monotonic()
+            variant_timings = {
+                "queued_s": round(queued_at - started, 3),
+                # While the variants before this one were rendered, it waited in the queue
+                "render_s": round(done - max(queued_at, previous_done), 3),
+                "elapsed_s": round(done - started, 3),
+            }
+            previous_done = done
+            cache = expected[index]
+            if error is not None:
+                finish(index, {"status": "error", "error": error, "timings": variant_timings, "cache": cache})
+                continue
+
+            cached |= cached_nodes(history, prompt_id)
+            cache["observed"] = round(len(cached & set(workflow)) / len(workflow), 3) if workflow else 0.0
+
+            pending_cache = PendingCacheEntry(key) if key is not None else None
+            with timings.phase("outputs"):
+                images_result = process_output_images(
+                    history[prompt_id].get("outputs") or {},
+                    f"{job['id']}_{index}",
+                    timings,
+                    pending_cache.uploaded if pending_cache is not None else None,
+                )
+            if pending_cache is not None:
+                with timings.phase("cache"):
+                    pending_cache.set_result(images_result)
+            record_profile(profiler)
+            if profile:
+                images_result["profile"] = profiler.profile()
+            finish(index, {**images_result, "timings": variant_timings, "cache": cache})
+    finally:
+        if ws is not None:
+            ws.close()
+        for _, _, _, _, events, _ in queued:
+            if not shared and events is not None:
+                events.close()
+
+    failed = sum(1 for result in results if result["status"] != "success")
+    print(f"runpod-worker-comfy - {len(variants) - failed} of {len(variants)} variants succeeded")
+    cache_hit_ratio = {}
+    for name in ("expected", "observed"):
+        ratios = [result["cache"][name] for result in results if name in result.get("cache", {})]
+        if ratios:
+            cache_hit_ratio[name] = round(sum(ratios) / len(ratios), 3)
+    if cache_hit_ratio:
+        print(f"runpod-worker-comfy - cache hit ratio of the variants: {cache_hit_ratio}")
+    log_result_spool()
+    if failed == len(results):
+        return {
+            "error": f"All {len(results)} variants failed, the first with: "
+            f"{results[0].get('error') or results[0].get('message')}",
+            "variants": results,
+            "refresh_worker": REFRESH_WORKER,
+        }
+    return {
+        "status": "success" if not failed else "partial",
+        "variants": results,
+        "cache_hit_ratio": cache_hit_ratio,
+        "refresh_worker": REFRESH_WORKER,
+    }
+
+
+def handler(job, on_progress=None):
     """
     The main function that handles a job of generating an image.
 
     This function validates the input, sends a prompt to ComfyUI for processing,
-    polls ComfyUI for result, and retrieves generated images.
+    waits for the result via the websocket of ComfyUI (or polls for it), and
+    retrieves generated images.
 
     Args:
         job (dict): A dictionary containing job details and input parameters.
+        on_progress (callable, optional): Called with the progress updates of a ProgressTracker
+            while the workflow runs, only in websocket mode.
 
     Returns:
         dict: A dictionary containing either an error message or a success status with generated images.
     """
+    cold_start_timeline.mark("first_job", once=True)
+    tracer = start_trace(job)
+    # Traces and metrics need the phases also when the timings are disabled
+    timings = JobTimings(COMFY_JOB_TIMINGS or COMFY_METRICS or tracer is not None, tracer)
+    result = run_job(job, timings, on_progress)
+    if tracer is not None:
+        tracer.complete("job", timings.started, time.perf_counter())
+        finish_trace(tracer, result)
+    if COMFY_METRICS:
+        record_job_metrics(result, timings)
+    # The first job of the worker tells how long its cold start took
+    if not cold_start_timeline.reported:
+        cold_start_timeline.mark("first_job_done", once=True)
+        cold_start = cold_start_timeline.report_once()
+        if cold_start is not None:
+            # None without a warmup
+            cold_start["warm"] = comfy_readiness.warm
+            result["cold_start"] = cold_start
+            print(f"runpod-worker-comfy - cold start " + json.dumps(cold_start, separators=(",", ":")))
+    if COMFY_JOB_TIMINGS:
+        result["timings"] = timings.as_dict()
+        # One line per job, to find the slow phases in the logs
+        print(
+            f"runpod-worker-comfy - job timings "
+            + json.dumps(
+                {"job_id": job["id"], "status": result.get("status", "error"), **result["timings"]},
+                separators=(",", ":"),
+            )
+        )
+    return result
+
+
+def record_job_metrics(result, timings):
+    """Add a finished job to the metrics, this takes no lock."""
+    status = result.get("status", "error")
+    jobs_total.inc(1, status)
+    job_seconds.observe(time.perf_counter() - timings.started, status)
+    for name, seconds in list(timings.phases.items()):
+        job_phase_seconds.observe(seconds, name)
+    if result.get("cached"):
+        cached_results_total.inc()
+    images = len(result.get("images") or [])
+    images += sum(len(variant.get("images") or []) for variant in result.get("variants") or [])
+    if images:
+        output_images_total.inc(images)
+
+
+def sample_metrics():
+    """
+    Set the gauges of the worker, and those of ComfyUI from /queue and /system_stats
+
+    ComfyUI is only asked while it is up, without retries, so that sampling
+    doesn't delay the boot probe or make a dead ComfyUI look busy.
+
+    Raises:
+        ComfyHttpError: If ComfyUI can't be reached
+    """
+    active_jobs_gauge.set(_active_jobs)
+    if result_spool is not None:
+        result_spool_depth_gauge.set(result_spool.stats()["depth"])
+    up = comfy_readiness.state in (READY, DEGRADED)
+    comfy_up_gauge.set(1 if up else 0)
+    warm_gauge.set(1 if comfy_readiness.warm else 0)
+    if not up:
+        return
+
+    queue = comfy_http_client.get_json(f"http://{COMFY_HOST}/queue", retries=0)
+    comfy_queue_gauge.set(len(queue.get("queue_running", [])), "running")
+    comfy_queue_gauge.set(len(queue.get("queue_pending", [])), "pending")
+    stats = comfy_http_client.get_json(f"http://{COMFY_HOST}/system_stats", retries=0)
+    system = stats.get("system", {})
+    for kind in ("total", "free"):
+        if f"ram_{kind}" in system:
+            comfy_ram_gauge.set(system[f"ram_{kind}"], kind)
+    for device in stats.get("devices", []):
+        name = f"{device.get('type', 'device')}:{device.get('index', 0)}"
+        for kind in ("vram_total", "vram_free", "torch_vram_total", "torch_vram_free"):
+            if kind in device:
+                comfy_vram_gauge.set(device[kind], name, kind)
+
+
+def worker_health():
+    """
+    The readiness of ComfyUI and the result of the warmup, served on /health
+
+    Returns:
+        dict: The snapshot of comfy_readiness, "healthy" unless ComfyUI is dead or the warmup failed
+    """
+    snapshot = comfy_readiness.snapshot()
+    return {"healthy": snapshot["state"] != DEAD and snapshot["warm"] is not False, **snapshot}
+
+
+def start_metrics():
+    """Serve the metrics on COMFY_METRICS_PORT and sample them into COMFY_METRICS_PATH, as configured."""
+    if not COMFY_METRICS:
+        return
+    if COMFY_METRICS_PORT:
+        try:
+            MetricsServer(metrics, COMFY_METRICS_PORT, health=worker_health).start()
+            print(f"runpod-worker-comfy - serving the metrics on port {COMFY_METRICS_PORT}")
+        except OSError as e:
+            print(f"runpod-worker-comfy - can't serve the metrics on port {COMFY_METRICS_PORT}: {str(e)}")
+    MetricsSampler(
+        metrics,
+        sample_metrics,
+        COMFY_METRICS_INTERVAL_S,
+        COMFY_METRICS_PATH or None,
+        COMFY_METRICS_RETENTION_DAYS,
+    ).start()
+
+
+def start_trace(job):
+    """
+    A JobTracer for a job, if it asked for a trace or was sampled by COMFY_TRACE_SAMPLE_PERCENT
+
+    Returns:
+        JobTracer: The tracer, or None if the job is not traced
+    """
+    job_input = job.get("input")
+    requested = isinstance(job_input, dict) and job_input.get("trace") is True
+    if not requested and random.random() * 100 >= COMFY_TRACE_SAMPLE_PERCENT:
+        return None
+    return JobTracer(job["id"], COMFY_TRACE_MAX_EVENTS)
+
+
+def finish_trace(tracer, result):
+    """Return the trace of a job as its "trace", or write it to COMFY_TRACE_PATH and return its "trace_path"."""
+    if COMFY_TRACE_OUTPUT == "inline":
+        result["trace"] = tracer.export()
+        return
+    try:
+        result["trace_path"] = tracer.write(COMFY_TRACE_PATH)
+        print(f"runpod-worker-comfy - wrote the trace of the job to {result['trace_path']}")
+    except (OSError, ValueError) as e:
+        print(f"runpod-worker-comfy - can't write the trace of the job: {str(e)}")
+
+
+def run_job(job, timings, on_progress=None):
+    """
+    Validate the input of a job and run its workflow or its variants, see handler
+
+    Args:
+        job (dict): The job
+        timings (JobTimings): Where the time spent in every phase of the job is added up
+        on_progress (callable, optional): Called with the progress updates while the workflow runs
+
+    Returns:
+        dict: The result of the job, without its timings
+    """
     job_input = job["input"]
 
     # Make sure that the input is valid
-    validated_data, error_message = validate_input(job_input)
+    with timings.phase("validate"):
+        validated_data, error_message = validate_input(job_input)
     if error_message:
         return {"error": error_message}
 
     # Extract validated data
     workflow = validated_data["workflow"]
     images = validated_data.get("images")
+    variants = validated_data.get("variants")
+    profile = validated_data.get("profile", False)
+
+    # A batch gets the default time limit for each of its variants
+    timeout = validated_data.get("timeout_s", COMFY_JOB_TIMEOUT_S * len(variants or [None]))
+    deadline = JobDeadline(timeout, COMFY_STALL_TIMEOUT_S)
+
+    # Make sure that the ComfyUI API is available, this only waits for it on the first job
+    with timings.phase("server_check"):
+        ready = comfy_readiness.wait_until_ready()
+    if not ready:
+        # A restarted worker gets a fresh ComfyUI
+        return {
+            "error": f"ComfyUI is not reachable at {COMFY_HOST} (state: {DEAD}): {comfy_readiness.last_error}",
+            "refresh_worker": True,
+        }
+    if comfy_readiness.warm is False:
+        # The job would fail on the same models, a refreshed worker warms up again
+        failed = [result["error"] for result in comfy_readiness.warmup if result["status"] == "error"]
+        reason = failed[0] if failed else "ComfyUI was not reachable"
+        return {"error": f"The worker is unhealthy, its warmup failed: {reason}", "refresh_worker": True}
 
-    # Make sure that the ComfyUI API is available
-    check_server(
-        f"http://{COMFY_HOST}",
-        COMFY_API_AVAILABLE_MAX_RETRIES,
-        COMFY_API_AVAILABLE_INTERVAL_MS,
-    )
+    _job_deadlines[job["id"]] = deadline
+    try:
+        # Jobs with several variants run all of them in one go
+        if variants is not None:
+            return run_variants(job, variants, images, on_progress, deadline, timings, profile)
+        return run_workflow(job, workflow, images, deadline, on_progress, timings, profile)
+    finally:
+        _job_deadlines.pop(job["id"], None)
+
+
+def run_workflow(job, workflow, images, deadline, on_progress=None, timings=None, profile=False):
+    """
+    Run the workflow of a job and return its images, see handler
+
+    Args:
+        job (dict): The job, its input is used for the result cache and its ID for the S3 keys
+        workflow (dict): The validated workflow
+        images (list): The validated 'images' of the job input
+        deadline (JobDeadline): The deadline of the job
+        on_progress (callable, optional): Called with the progress updates while the workflow runs
+        timings (JobTimings, optional): Where the time spent in every phase is added up
+        profile (bool): Add the execution time of every node to the result
+
+    Returns:
+        dict: The result of the job
+    """
+    timings = timings or NO_TIMINGS
+    job_input = job["input"]
+    with timings.phase("prepare"):
+        workflow, error = prepare_workflow(workflow)
+    if error is not None:
+        return error
+
+    # The same workflow with the same images gives the same result
+    with timings.phase("cache"):
+        key = result_cache_key(job_input, workflow, images)
+        cached = get_cached_result(key) if key is not None else None
+    if cached is not None:
+        print(f"runpod-worker-comfy - returning the cached result {key}")
+        return {"status": "success", **cached, "cached": True, "refresh_worker": REFRESH_WORKER}
+
+    # Ask the client for the bytes of images that were sent by hash only, but are unknown
+    with timings.phase("upload_inputs"):
+        missing_inputs = find_missing_inputs(images)
+    if missing_inputs:
+        return {
+            "error": "Some input images are not in the input store, send them again with 'image'",
+            "missing_inputs": missing_inputs,
+        }
 
     # Upload images if they exist
-    upload_result = upload_images(images)
+    with timings.phase("upload_inputs"):
+        upload_result = upload_images(images, timings.tracer)
 
     if upload_result["status"] == "error":
         return upload_result
+    workflow = use_staged_image_names(workflow, images)
 
-    # Queue the workflow
+    # Don't queue what would be cancelled right away
     try:
-        queued_workflow = queue_workflow(workflow)
-        prompt_id = queued_workflow["prompt_id"]
-        print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
-    except Exception as e:
-        return {"error": f"Error queuing workflow: {str(e)}"}
+        deadline.check()
+    except JobTimeoutError as e:
+        return {"error": str(e)}
+
+    # Listen for the execution events before queueing, so that none are missed
+    with timings.phase("queue"):
+        client_id, ws = subscribe_to_events()
 
-    # Poll for completion
-    print(f"runpod-worker-comfy - wait until image generation is complete")
-    retries = 0
     try:
-        while retries < COMFY_POLLING_MAX_RETRIES:
-            history = get_history(prompt_id)
+        # Queue the workflow
+        try:
+            with timings.phase("queue"):
+                queued_workflow = queue_workflow(workflow, client_id)
+            prompt_id = queued_workflow["prompt_id"]
+            print(f"runpod-worker-comfy - queued workflow with ID {prompt_id}")
+        except Exception as e:
+            return {"error": f"Error queuing workflow: {str(e)}"}
+        variant_scheduler.record(workflow)
+        deadline.track(prompt_id)
+
+        if ws is not None and COMFY_MAX_CONCURRENT_JOBS > 1:
+            ws.bind(prompt_id)
+
+        on_event = track_progress(workflow, prompt_id, on_progress)
+        profiler = start_profile(workflow, profile, timings.tracer)
+        if profiler is not None:
+            on_event = profiler.wrap(on_event)
+        with timings.phase("wait"):
+            history, error = wait_for_prompt(ws, prompt_id, on_event, deadline, timings)
+        trace_profile(profiler, timings.tracer)
+        if error is not None:
+            return {"error": error}
+    finally:
+        if ws is not None:
+            ws.close()
+
+    # Get the generated images and return them as URLs in an AWS bucket or as base64
+    pending_cache = PendingCacheEntry(key) if key is not None else None
+    with timings.phase("outputs"):
+        images_result = process_output_images(
+            history[prompt_id].get("outputs") or {},
+            job["id"],
+            timings,
+            pending_cache.uploaded if pending_cache is not None else None,
+        )
+
+    result = {**images_result, "refresh_worker": REFRESH_WORKER}
+    if pending_cache is not None:
+        with timings.phase("cache"):
+            pending_cache.set_result(result)
+    record_profile(profiler)
+    if profile:
+        result["profile"] = profiler.profile()
+
+    log_result_spool()
+    return result
+
+
+def cancel_job(job_id):
+    """
+    Stop a job that was cancelled on the side of RunPod
+
+    Its prompts are cancelled like when its deadline passes, and the handler
+    returns as soon as it notices.
+
+    Args:
+        job_id (str): The ID of the job
+    """
+    deadline = _job_deadlines.get(job_id)
+    if deadline is None:
+        return
+    print(f"runpod-worker-comfy - job {job_id} was cancelled")
+    deadline.cancel()
+    cancel_prompts(deadline.pending())
+
+
+def check_cancelled_jobs(client):
+    """
+    Stop the running jobs whose status in RunPod is CANCELLED
+
+    Args:
+        client (runpod.endpoint.runner.RunPodClient): The client to ask RunPod for the status with
+    """
+    from runpod.endpoint.runner import Job
+
+    for job_id in list(_job_deadlines):
+        try:
+            status = Job(RUNPOD_ENDPOINT_ID, job_id, client).status()
+        except Exception as e:
+            print(f"runpod-worker-comfy - can't get the status of job {job_id}: {str(e)}")
+            continue
+        if status == "CANCELLED":
+            cancel_job(job_id)
+
+
+def watch_cancelled_jobs(stop=None):
+    """
+    Look for cancelled jobs every COMFY_CANCEL_CHECK_INTERVAL_S seconds, see check_cancelled_jobs()
+
+    runpod 1.3.6 doesn't tell the handler when a job is cancelled, so the worker asks RunPod.
+
+    Args:
+        stop (threading.Event): Set to stop looking, by default the worker looks as long as it runs
+    """
+    import runpod
+    from runpod.endpoint.runner import RunPodClient
 
-            # Exit the loop if we have found the history
-            if prompt_id in history and history[prompt_id].get("outputs"):
+    runpod.api_key = RUNPOD_API_KEY
+    client = RunPodClient()
+    stop = stop or threading.Event()
+    while not stop.wait(COMFY_CANCEL_CHECK_INTERVAL_S):
+        check_cancelled_jobs(client)
+
+
+def start_cancel_watch():
+    """Look for cancelled jobs on a thread of its own, if the worker can ask RunPod for their status."""
+    if not (COMFY_CANCEL_CHECK_INTERVAL_S and RUNPOD_API_KEY and RUNPOD_ENDPOINT_ID):
+        print("runpod-worker-comfy - cancelled jobs run to the end, RUNPOD_API_KEY or RUNPOD_ENDPOINT_ID is not set")
+        return
+    threading.Thread(target=watch_cancelled_jobs, name="cancel-watch", daemon=True).start()
+
+
+async def async_handler(job):
+    """
+    Run the handler on a thread of its own, so that the worker can take up to COMFY_MAX_CONCURRENT_JOBS jobs at once.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Returns:
+        dict: The result of handler()
+    """
+    global _active_jobs
+
+    loop = asyncio.get_running_loop()
+    _active_jobs += 1
+    try:
+        return await loop.run_in_executor(_job_executor, handler, job)
+    finally:
+        _active_jobs -= 1
+
+
+async def stream_handler(job):
+    """
+    Run the handler on a thread of its own and yield its progress updates, followed by its result.
+
+    Args:
+        job (dict): A dictionary containing job details and input parameters.
+
+    Yields:
+        dict: The progress updates, see ProgressTracker, and finally the result of handler()
+    """
+    global _active_jobs
+
+    loop = asyncio.get_running_loop()
+    updates = asyncio.Queue()
+
+    def on_progress(progress):
+        loop.call_soon_threadsafe(updates.put_nowait, progress)
+
+    _active_jobs += 1
+    try:
+        result = loop.run_in_executor(_job_executor, handler, job, on_progress)
+        while True:
+            next_update = asyncio.ensure_future(updates.get())
+            await asyncio.wait({result, next_update}, return_when=asyncio.FIRST_COMPLETED)
+            if not next_update.done():
+                next_update.cancel()
                 break
-            else:
-                # Wait before trying again
-                time.sleep(COMFY_POLLING_INTERVAL_MS / 1000)
-                retries += 1
+            yield next_update.result()
+
+        while not updates.empty():
+            yield updates.get_nowait()
+        result = await result
+        # runpod 1.3.6 drops 'refresh_worker' and 'error' from the items of a stream. It only
+        # refreshes the worker after a job when its config says so, and only fails a job that raises.
+        if result.pop("refresh_worker", False):
+            worker_config["refresh_worker"] = True
+        if "error" in result:
+            raise JobFailedError(result["error"])
+        yield result
+    finally:
+        _active_jobs -= 1
+
+
+def boot_comfy():
+    """
+    Wait for ComfyUI once at boot, load its node definitions and run the warmup workflows
+
+    This way the first job doesn't have to, see warm_up().
+    """
+    ready = comfy_readiness.wait_until_ready()
+    if ready and COMFY_VALIDATE_WORKFLOW:
+        try:
+            workflow_validator.load()
+            cold_start_timeline.mark("node_definitions_loaded")
+        except (ComfyHttpError, ValueError) as e:
+            print(f"runpod-worker-comfy - can't load the node definitions: {str(e)}")
+    if COMFY_WARMUP_WORKFLOWS:
+        if ready:
+            warm_up()
         else:
-            return {"error": "Max retries reached while waiting for image generation"}
-    except Exception as e:
-        return {"error": f"Error waiting for image generation: {str(e)}"}
+            comfy_readiness.record_warmup(False, [])
 
-    # Get the generated image and return it as URL in an AWS bucket or as base64
-    images_result = process_output_images(history[prompt_id].get("outputs"), job["id"])
 
-    result = {**images_result, "refresh_worker": REFRESH_WORKER}
+def warm_up():
+    """
+    Run the COMFY_WARMUP_WORKFLOWS one after the other, so that their models are loaded before the first job
 
-    return result
+    Returns:
+        bool: True if all of them succeeded, the result is also recorded in comfy_readiness
+    """
+    results = []
+    for spec in COMFY_WARMUP_WORKFLOWS:
+        start = time.monotonic()
+        error = run_warmup(spec)
+        result = {
+            "workflow": spec,
+            "status": "error" if error else "success",
+            "elapsed_s": round(time.monotonic() - start, 3),
+        }
+        if error:
+            result["error"] = error
+        results.append(result)
+        print(f"runpod-worker-comfy - warmup {json.dumps(result)}")
+    warm = all(result["status"] == "success" for result in results)
+    cold_start_timeline.mark("warm" if warm else "warmup_failed")
+    comfy_readiness.record_warmup(warm, results)
+    return warm
+
+
+def run_warmup(spec):
+    """
+    Run a warmup workflow with a fixed seed and COMFY_WARMUP_STEPS steps, and wait until it is done
+
+    Args:
+        spec (str): A template reference or a job input file, see load_warmup_input
+
+    Returns:
+        str: The error, or None if the workflow succeeded
+    """
+    try:
+        job_input = load_warmup_input(spec)
+        template = job_input.get("template")
+        if template is not None and job_input.get("workflow") is None:
+            # The fixed seed instead of the random one of the template
+            seeds = {
+                target: COMFY_WARMUP_SEED
+                for target, func, _ in workflow_templates.bindings(template).rules
+                if func == "random_seed"
+            }
+            job_input = {**job_input, "params": {**seeds, **(job_input.get("params") or {})}}
+    except (WarmupError, TemplateError) as e:
+        return str(e)
+
+    validated_data, error_message = validate_input(job_input)
+    if error_message:
+        return error_message
+    workflow = fix_seeds(validated_data["workflow"], COMFY_WARMUP_SEED)
+    if COMFY_WARMUP_STEPS:
+        workflow = limit_steps(workflow, COMFY_WARMUP_STEPS)
+    workflow, error = prepare_workflow(workflow)
+    if error is not None:
+        return error["error"]
+    upload_result = upload_images(validated_data.get("images"))
+    if upload_result["status"] == "error":
+        return upload_result["message"]
+    workflow = use_staged_image_names(workflow, validated_data.get("images"))
+
+    deadline = JobDeadline(COMFY_WARMUP_TIMEOUT_S, COMFY_STALL_TIMEOUT_S)
+    client_id, ws = subscribe_to_events()
+    try:
+        try:
+            prompt_id = queue_workflow(workflow, client_id)["prompt_id"]
+        except Exception as e:
+            return f"Error queuing workflow: {str(e)}"
+        deadline.track(prompt_id)
+        if ws is not None and COMFY_MAX_CONCURRENT_JOBS > 1:
+            ws.bind(prompt_id)
+        _, error = wait_for_prompt(ws, prompt_id, None, deadline)
+    finally:
+        if ws is not None:
+            ws.close()
+    # The first job that shares nodes with the warmup finds them in the cache of ComfyUI
+    variant_scheduler.record(workflow)
+    return error
+
+
+def is_worker_busy():
+    """Check if the worker runs as many jobs as it can, lets the runpod SDK ask for jobs less often."""
+    return _active_jobs >= COMFY_MAX_CONCURRENT_JOBS
+
+
+def limit_concurrent_jobs():
+    """
+    Let the runpod SDK take a job only while the worker holds fewer than COMFY_MAX_CONCURRENT_JOBS
+
+    runpod 1.3.6 has no concurrency_modifier, and with a concurrency_controller it still
+    asks for a job at least once a second. So its get_job waits for a free slot first. A
+    slot is held from the moment the SDK takes a job until it sent the result.
+
+    Returns:
+        callable: The get_job of the SDK before it was wrapped
+    """
+    from runpod.serverless.modules import rp_scale
+    from runpod.serverless.modules.worker_state import Jobs
+
+    get_job = rp_scale.get_job
+    jobs = Jobs()
+
+    async def get_job_when_free(session, *args, **kwargs):
+        while len(jobs.jobs) >= COMFY_MAX_CONCURRENT_JOBS:
+            await asyncio.sleep(JOB_SLOT_POLL_S)
+        return await get_job(session, *args, **kwargs)
+
+    rp_scale.get_job = get_job_when_free
+    return get_job
 
 
 # Start the handler only if this script is run directly
 if __name__ == "__main__":
-    runpod.serverless.start({"handler": handler})
+    if result_spool is not None:
+        # Upload what a previous run of the worker left in the spool
+        result_spool.start()
+        # Don't let the worker go away while images are still waiting for their upload
+        atexit.register(drain_result_spool)
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    start_metrics()
+
+    # Wait for ComfyUI in the background. Without a warmup, jobs are taken right away and wait in run_job until it is up
+    boot = threading.Thread(target=boot_comfy, name="comfyui-boot", daemon=True)
+    boot.start()
+
+    # Only needed to take jobs, so it is imported while ComfyUI boots
+    with cold_start_timeline.profile_imports():
+        import runpod
+
+    if COMFY_WARMUP_WORKFLOWS:
+        # With a warmup, jobs are only taken once the models are loaded
+        boot.join()
+        if not comfy_readiness.warm:
+            # Exit instead of failing the jobs, so that RunPod replaces the worker
+            print(
+                "runpod-worker-comfy - not taking jobs, the warmup failed "
+                + json.dumps(comfy_readiness.snapshot(), separators=(",", ":"))
+            )
+            sys.exit(1)
+
+    start_cancel_watch()
+
+    # Async, so that the worker can take more jobs while the handler waits for ComfyUI
+    config = worker_config
+    config["handler"] = async_handler
+    if COMFY_STREAM_PROGRESS:
+        # The updates are sent to /stream, /run and /runsync return all of them
+        config.update(handler=stream_handler, return_aggregate_stream=True)
+
+    if COMFY_MAX_CONCURRENT_JOBS > 1:
+        if COMFY_COMPLETION_MODE == "websocket":
+            comfy_event_router.start()
+        config["concurrency_controller"] = is_worker_busy
+        limit_concurrent_jobs()
+
+    cold_start_timeline.mark("taking_jobs")
+    runpod.serverless.start(config)
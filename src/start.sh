@@ -1,11 +1,24 @@
 #!/usr/bin/env bash
 
+# Timestamps of the boot phases, the handler reports them with the first job
+COLD_START_MARKS_PATH="${COLD_START_MARKS_PATH:-/tmp/cold_start_marks}"
+# The log of ComfyUI, the handler reads the import times of the custom nodes from it
+COMFY_LOG_PATH="${COMFY_LOG_PATH:-/tmp/comfyui.log}"
+export COLD_START_MARKS_PATH COMFY_LOG_PATH
+
+mark() {
+    echo "${EPOCHREALTIME:-$(date +%s.%N)} $1" >> "$COLD_START_MARKS_PATH"
+}
+: > "$COLD_START_MARKS_PATH"
+mark container_start
+
 # Use libtcmalloc for better memory management
 TCMALLOC="$(ldconfig -p | grep -Po "libtcmalloc.so.\d" | head -n 1)"
 export LD_PRELOAD="${TCMALLOC}"
 
 if [ -d "/runpod-volume/inputs" ]; then
     cp -r /runpod-volume/inputs/* /app/ComfyUI/input/
+    mark inputs_copied
 else
     echo "Source directory /runpod-volume/inputs does not exist."
 fi
@@ -17,14 +30,18 @@ if [ "$RUN_AS_SERVER" == "true" ]; then
 # Serve the API and don't shut down the container
 elif [ "$SERVE_API_LOCALLY" == "true" ]; then
     echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 app/ComfyUI/main.py --disable-auto-launch --disable-metadata --highvram --disable-smart-memory --listen &
+    mark comfyui_start
+    python3 -u app/ComfyUI/main.py --disable-auto-launch --disable-metadata --highvram --disable-smart-memory --listen 2>&1 | tee "$COMFY_LOG_PATH" &
 
     echo "runpod-worker-comfy: Starting RunPod Handler"
+    mark handler_start
     python3 -u /rp_handler.py --rp_serve_api --rp_api_host=0.0.0.0
 else
     echo "runpod-worker-comfy: Starting ComfyUI"
-    python3 app/ComfyUI/main.py --disable-auto-launch --disable-metadata --highvram --disable-smart-memory &
+    mark comfyui_start
+    python3 -u app/ComfyUI/main.py --disable-auto-launch --disable-metadata --highvram --disable-smart-memory 2>&1 | tee "$COMFY_LOG_PATH" &
 
     echo "runpod-worker-comfy: Starting RunPod Handler"
+    mark handler_start
     python3 -u /rp_handler.py
 fi
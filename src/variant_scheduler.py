@@ -0,0 +1,100 @@
+import hashlib
+import json
+
+
+def node_signatures(workflow):
+    """
+    The cache signature of every node of a workflow
+
+    Like the cache of ComfyUI, the signature of a node covers its class_type,
+    its values and the signatures of the nodes it is linked to, but not its
+    ID. ComfyUI reuses the output of a node when a node with the same
+    signature was part of the previous prompt.
+
+    Args:
+        workflow (dict): The workflow in the API format of ComfyUI
+
+    Returns:
+        dict: The signature of every node, by node ID
+    """
+    signatures = {}
+
+    def signature(node_id):
+        if node_id not in signatures:
+            # Graphs are acyclic, the marker only keeps a broken one from recursing forever
+            signatures[node_id] = None
+            node = workflow.get(node_id)
+            if not isinstance(node, dict):
+                return None
+            inputs = []
+            for name, value in sorted((node.get("inputs") or {}).items()):
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                    value = ["link", signature(value[0]), value[1]]
+                inputs.append([name, value])
+            signatures[node_id] = hashlib.sha1(
+                json.dumps([node.get("class_type"), inputs], sort_keys=True, default=str).encode("utf-8")
+            ).hexdigest()
+        return signatures[node_id]
+
+    for node_id in workflow:
+        signature(node_id)
+    return signatures
+
+
+class VariantScheduler:
+    """
+    Orders the variants of a batch so that ComfyUI recomputes as few nodes as possible
+
+    ComfyUI only keeps the outputs of the previous prompt, so the cost of
+    running a variant after another one is the number of its nodes that the
+    other one doesn't share, like the text encoders of a new token or the
+    branches of another vase. The variants are chained greedily, always
+    continuing with the one that is cheapest after the current one, which
+    groups them by the parameters that invalidate the most nodes first.
+
+    The scheduler remembers the signatures of the last prompt the worker
+    queued, so that the first variant of a batch can continue from there.
+    """
+
+    def __init__(self):
+        self.last = None
+
+    def record(self, workflow):
+        """Remember the last workflow that was queued."""
+        self.last = frozenset(node_signatures(workflow).values())
+
+    def plan(self, workflows, reorder=True):
+        """
+        Order workflows to maximize the reuse of nodes between neighbours
+
+        Args:
+            workflows (list): The workflows of the variants
+            reorder (bool): False keeps the order of the workflows and only computes the ratios
+
+        Returns:
+            tuple: (order, expected, invalidated): the indices of the workflows in the order
+                   they should run, the expected share of cached nodes of every workflow, and
+                   the number of nodes of every workflow that not all variants share
+        """
+        signatures = [frozenset(node_signatures(workflow).values()) for workflow in workflows]
+        shared = frozenset.intersection(*signatures) if signatures else frozenset()
+        invalidated = [len(nodes - shared) for nodes in signatures]
+
+        order = []
+        expected = [0.0] * len(workflows)
+        remaining = list(range(len(workflows)))
+        previous = self.last or frozenset()
+        while remaining:
+            # Fewest nodes to compute after the previous one, ties keep the order of the input
+            best = (
+                min(remaining, key=lambda index: len(signatures[index] - previous))
+                if reorder
+                else remaining[0]
+            )
+            remaining.remove(best)
+            order.append(best)
+            nodes = signatures[best]
+            expected[best] = round(len(nodes & previous) / len(nodes), 3) if nodes else 0.0
+            previous = nodes
+
+        return order, expected, invalidated
@@ -0,0 +1,94 @@
+import json
+
+# Inputs of the samplers that pick the noise, set to the fixed seed of the warmup
+SEED_INPUTS = ("seed", "noise_seed")
+
+
+class WarmupError(ValueError):
+    """Raised when a warmup workflow can't be loaded."""
+
+
+def parse_warmup_specs(value):
+    """The warmup workflows of a comma separated list, like "jasper-color@2,/test_input.json"."""
+    return [spec.strip() for spec in (value or "").split(",") if spec.strip()]
+
+
+def load_warmup_input(spec):
+    """
+    The job input of a warmup workflow
+
+    Args:
+        spec (str): The path of a JSON file with a job input, like test_input.json, or the
+                    reference of a workflow template, like "jasper-color@2"
+
+    Returns:
+        dict: The job input, with its 'workflow' or its 'template'
+
+    Raises:
+        WarmupError: If the file can't be read or holds no job input
+    """
+    if not spec.endswith(".json"):
+        return {"template": spec}
+    try:
+        with open(spec, "rb") as input_file:
+            data = json.loads(input_file.read())
+    except (OSError, ValueError) as e:
+        raise WarmupError(f"Can't read the warmup workflow {spec}: {str(e)}")
+    # Files like test_input.json hold a whole job
+    if isinstance(data, dict) and isinstance(data.get("input"), dict):
+        data = data["input"]
+    if not isinstance(data, dict) or ("workflow" not in data and "template" not in data):
+        raise WarmupError(f"The warmup workflow {spec} has no 'workflow' or 'template'")
+    return data
+
+
+def _set_inputs(workflow, values_by_node):
+    """A copy of the workflow with new values for some inputs, only the changed nodes are copied."""
+    if not values_by_node:
+        return workflow
+    workflow = dict(workflow)
+    for node_id, values in values_by_node.items():
+        node = workflow[node_id]
+        workflow[node_id] = {**node, "inputs": {**node["inputs"], **values}}
+    return workflow
+
+
+def fix_seeds(workflow, seed):
+    """
+    Give every sampler of a workflow the same seed, so that a warmup always renders the same
+
+    Seeds that are linked from another node, like the GlobalSeed of the Jasper
+    workflows, are left to their parameters.
+    """
+    changes = {}
+    for node_id, node in workflow.items():
+        inputs = (node.get("inputs") or {}) if isinstance(node, dict) else {}
+        values = {
+            name: seed
+            for name in SEED_INPUTS
+            if isinstance(inputs.get(name), int) and not isinstance(inputs.get(name), bool)
+        }
+        if values:
+            changes[node_id] = values
+    return _set_inputs(workflow, changes)
+
+
+def limit_steps(workflow, steps):
+    """
+    Let every sampler of a workflow run at most a few steps, which is enough to load its models
+
+    Samplers that start at or after the new number of steps, like the refiners of
+    the Jasper workflows, start at its last step instead (steps - 1), so they still run one step.
+    """
+    changes = {}
+    for node_id, node in workflow.items():
+        inputs = (node.get("inputs") or {}) if isinstance(node, dict) else {}
+        current = inputs.get("steps")
+        if not isinstance(current, int) or isinstance(current, bool) or current <= steps:
+            continue
+        values = {"steps": steps}
+        start = inputs.get("start_at_step")
+        if isinstance(start, int) and not isinstance(start, bool) and start >= steps:
+            values["start_at_step"] = steps - 1
+        changes[node_id] = values
+    return _set_inputs(workflow, changes)
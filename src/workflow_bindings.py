@@ -0,0 +1,187 @@
+import random
+import re
+import sys
+
+# Rules like "random_seed()", "str(GlobalSeed)" or just "GlobalSeed"
+RULE_PATTERN = re.compile(
+    r"^\s*(?:(?P<func>str|int|float|random_seed)\((?P<arg>[^()]*)\)|(?P<name>[^()]+?))\s*$"
+)
+# The conversions that rules can apply
+RULE_FUNCTIONS = {"str": str, "int": int, "float": float, None: lambda value: value}
+# Highest seed that random_seed() draws, the same as the load test scripts use
+MAX_SEED = sys.maxsize
+
+
+class BindingError(ValueError):
+    """Raised when parameters don't match the bindings of a workflow or can't be converted."""
+
+
+def coerce(value, current, name):
+    """
+    Convert a parameter to the type of the value it replaces
+
+    Args:
+        value: The new value
+        current: The value in the workflow
+        name (str): The binding, for the error message
+
+    Returns:
+        The converted value
+
+    Raises:
+        BindingError: If the value can't be converted
+    """
+    try:
+        if isinstance(current, bool):
+            if isinstance(value, str) and value.lower() in ("true", "false"):
+                return value.lower() == "true"
+            if isinstance(value, bool) or value in (0, 1):
+                return bool(value)
+        elif isinstance(current, int):
+            if isinstance(value, float) and value.is_integer():
+                return int(value)
+            if isinstance(value, (int, str)) and not isinstance(value, bool):
+                return int(value)
+        elif isinstance(current, float):
+            if isinstance(value, (int, float, str)) and not isinstance(value, bool):
+                return float(value)
+        elif isinstance(current, str):
+            if isinstance(value, (str, int, float)) and not isinstance(value, bool):
+                return str(value)
+        else:
+            return value
+    except ValueError:
+        pass
+    raise BindingError(
+        f"'{name}' must be of type {type(current).__name__}, got {type(value).__name__} {value!r}"
+    )
+
+
+class WorkflowBindings:
+    """
+    Index of the inputs of a workflow that parameters can be bound to
+
+    Every input that holds a value (not a link to another node) gets the
+    bindings "<node id>.<input>" and "<title>.<input>", where the title is the
+    _meta.title of the node. Nodes with a single such input, like the
+    INTConstant and Badman_String nodes that hold the parameters of the Jasper
+    workflows, can also be bound by their ID or title alone. A title that
+    several nodes share binds all of them.
+
+    The index is built once, after that apply() only touches the inputs it
+    changes. Rules fill in inputs that the parameters leave out, like
+    {"GlobalSeed": "random_seed()", "GlobalSeedString": "str(GlobalSeed)"}.
+
+    Args:
+        workflow (dict): The workflow in the API format of ComfyUI, it is never modified
+        rules (dict, optional): Rules by binding, applied in order after the parameters
+    """
+
+    def __init__(self, workflow, rules=None):
+        self.workflow = workflow
+        # [(node ID, input name)] by binding
+        self.index = {}
+        for node_id, node in workflow.items():
+            if not isinstance(node, dict):
+                continue
+            inputs = [
+                name
+                for name, value in (node.get("inputs") or {}).items()
+                if not isinstance(value, list)
+            ]
+            title = (node.get("_meta") or {}).get("title")
+            for prefix in (node_id, title) if title else (node_id,):
+                for name in inputs:
+                    self.index.setdefault(f"{prefix}.{name}", []).append((node_id, name))
+                if len(inputs) == 1:
+                    self.index.setdefault(prefix, []).append((node_id, inputs[0]))
+
+        self.rules = []
+        for target, rule in (rules or {}).items():
+            match = RULE_PATTERN.match(rule) if isinstance(rule, str) else None
+            if match is None:
+                raise BindingError(f"Invalid rule for '{target}': {rule!r}")
+            func, source = match["func"], (match["arg"] or match["name"] or "").strip()
+            for name in (target, source) if func != "random_seed" else (target,):
+                if name not in self.index:
+                    raise BindingError(f"The rule for '{target}' refers to the unknown binding '{name}'")
+            self.rules.append((target, func, source))
+
+    @staticmethod
+    def flatten(params):
+        """Turn objects of values by input name into one value per binding, like {"552.value": 2}."""
+        values = {}
+        for key, value in (params or {}).items():
+            if isinstance(value, dict):
+                values.update((f"{key}.{name}", inner) for name, inner in value.items())
+            else:
+                values[key] = value
+        return values
+
+    def draws_random_seed(self, params=None):
+        """Whether apply() draws a random seed for these parameters, so that the workflow differs every time."""
+        given = {
+            node_input for name in self.flatten(params) for node_input in self.index.get(name, ())
+        }
+        return any(
+            func == "random_seed" and not given.issuperset(self.index[target])
+            for target, func, _ in self.rules
+        )
+
+    def apply(self, params=None):
+        """
+        Return a copy of the workflow with the parameters and rules applied
+
+        Only the nodes that get new values are copied, all other nodes are
+        shared with the indexed workflow.
+
+        Args:
+            params (dict): Values by binding, or objects of values by input name
+                keyed by node ID or title, like {"GlobalSeed": 1, "552": {"value": 2}}
+
+        Returns:
+            dict: The new workflow
+
+        Raises:
+            BindingError: If a parameter matches no binding or has the wrong type
+        """
+        values = self.flatten(params)
+
+        unknown = [name for name in values if name not in self.index]
+        if unknown:
+            raise BindingError(
+                f"The workflow has no binding {', '.join(map(repr, unknown))}"
+            )
+
+        # The new value of every input, so that rules see it however it was bound
+        assigned = {}
+
+        def assign(binding, value):
+            for node_id, name in self.index[binding]:
+                current = self.workflow[node_id]["inputs"][name]
+                assigned[(node_id, name)] = coerce(value, current, binding)
+
+        for binding, value in values.items():
+            assign(binding, value)
+
+        for target, func, source in self.rules:
+            if all(node_input in assigned for node_input in self.index[target]):
+                continue
+            if func == "random_seed":
+                assign(target, random.randint(0, MAX_SEED))
+                continue
+            node_id, name = self.index[source][0]
+            value = assigned.get((node_id, name), self.workflow[node_id]["inputs"][name])
+            try:
+                value = RULE_FUNCTIONS[func](value)
+            except ValueError:
+                raise BindingError(f"The rule for '{target}' can't convert {value!r}")
+            assign(target, value)
+
+        workflow = dict(self.workflow)
+        for (node_id, name), value in assigned.items():
+            if workflow[node_id] is self.workflow[node_id]:
+                node = workflow[node_id]
+                workflow[node_id] = {**node, "inputs": dict(node["inputs"])}
+            workflow[node_id]["inputs"][name] = value
+        return workflow
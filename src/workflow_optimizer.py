@@ -0,0 +1,132 @@
+# Nodes whose only output is a constant, and how it follows from their inputs
+CONSTANT_NODES = {
+    "INTConstant": lambda inputs: inputs["value"],
+    "Badman_String": lambda inputs: inputs["value"],
+    "BadmanStringToInteger": lambda inputs: int(inputs["value"]),
+}
+# Switch nodes, and which of their inputs each output passes through for a selection
+SWITCH_NODES = {
+    # Outputs: the selected input, its label and the selection
+    "ImpactSwitch": lambda select: {0: f"input{select}"},
+    # Outputs: the selected images and mask, images1 is the only required input
+    "ImageMaskSwitch": lambda select: {
+        0: "images1" if select == 1 else f"images{select}_opt",
+        1: f"mask{select}_opt",
+    },
+}
+
+# Marks a value that is only known once ComfyUI runs the workflow
+_UNKNOWN = object()
+
+
+def is_link(value):
+    """Whether an input is a link [node_id, output_index] to another node."""
+    return isinstance(value, list) and len(value) == 2 and isinstance(value[1], int)
+
+
+class _Folder:
+    """Evaluates the constants of a workflow and follows its switches, memoizing both."""
+
+    def __init__(self, workflow):
+        self.workflow = workflow
+        self.constants = {}
+        self.links = {}
+
+    def constant(self, value):
+        """The value of an input, or _UNKNOWN if it depends on something that isn't constant."""
+        if not is_link(value):
+            return value
+        node_id, output_index = value
+        if output_index != 0:
+            return _UNKNOWN
+        if node_id not in self.constants:
+            # Graphs are acyclic, the marker only keeps a broken one from recursing forever
+            self.constants[node_id] = _UNKNOWN
+            node = self.workflow.get(node_id)
+            evaluate = CONSTANT_NODES.get(node.get("class_type")) if isinstance(node, dict) else None
+            if evaluate is not None:
+                inputs = {name: self.constant(v) for name, v in (node.get("inputs") or {}).items()}
+                if _UNKNOWN not in inputs.values():
+                    try:
+                        self.constants[node_id] = evaluate(inputs)
+                    except (KeyError, TypeError, ValueError):
+                        pass
+        return self.constants[node_id]
+
+    def resolve(self, link):
+        """Follow a link through switches with a constant selection, to the node that really provides the value."""
+        key = tuple(link)
+        if key not in self.links:
+            self.links[key] = link
+            node = self.workflow.get(link[0])
+            select_outputs = SWITCH_NODES.get(node.get("class_type")) if isinstance(node, dict) else None
+            if select_outputs is not None:
+                inputs = node.get("inputs") or {}
+                select = self.constant(inputs.get("select", _UNKNOWN))
+                if isinstance(select, int) and not isinstance(select, bool):
+                    selected = inputs.get(select_outputs(select).get(link[1]))
+                    # An unconnected input passes None through, that has to stay a switch
+                    if is_link(selected):
+                        self.links[key] = self.resolve(selected)
+        return self.links[key]
+
+
+def optimize_workflow(workflow, output_classes=None):
+    """
+    Fold the constant selections of switch nodes and drop the nodes no output depends on
+
+    Links to the outputs of a switch whose selection is constant, like an
+    ImpactSwitch driven by an INTConstant, are connected straight to the
+    selected input. The switch and the branches it didn't select are then
+    left without consumers and are dropped, so that ComfyUI neither validates
+    them nor loads their images. Everything else is kept as it is.
+
+    Args:
+        workflow (dict): The workflow in the API format of ComfyUI, it is never modified
+        output_classes (set, optional): The class_type of the output nodes. Without it,
+            every node that no other node uses counts as an output.
+
+    Returns:
+        dict: The optimized workflow, nodes that didn't change are shared with the given one
+    """
+    folder = _Folder(workflow)
+    used = {
+        value[0]
+        for node in workflow.values()
+        if isinstance(node, dict)
+        for value in (node.get("inputs") or {}).values()
+        if is_link(value)
+    }
+
+    rewired = {}
+    for node_id, node in workflow.items():
+        if not isinstance(node, dict):
+            rewired[node_id] = node
+            continue
+        inputs = node.get("inputs") or {}
+        new_inputs = {
+            name: folder.resolve(value) if is_link(value) else value
+            for name, value in inputs.items()
+        }
+        changed = any(new_inputs[name] != inputs[name] for name in inputs)
+        rewired[node_id] = {**node, "inputs": new_inputs} if changed else node
+
+    if output_classes is None:
+        pending = [node_id for node_id in workflow if node_id not in used]
+    else:
+        pending = [
+            node_id
+            for node_id, node in workflow.items()
+            if isinstance(node, dict) and node.get("class_type") in output_classes
+        ]
+    keep = set(pending)
+    while pending:
+        node = rewired.get(pending.pop())
+        if not isinstance(node, dict):
+            continue
+        for value in (node.get("inputs") or {}).values():
+            if is_link(value) and value[0] not in keep:
+                keep.add(value[0])
+                pending.append(value[0])
+
+    return {node_id: node for node_id, node in rewired.items() if node_id in keep}
@@ -0,0 +1,155 @@
+import os
+import re
+import threading
+
+from comfy_http import json_loads
+from workflow_bindings import WorkflowBindings
+
+# Names and versions of templates, they are used as folder and file names
+TEMPLATE_NAME_PATTERN = re.compile(r"^[A-Za-z0-9_][A-Za-z0-9_.-]*$")
+
+
+class TemplateError(Exception):
+    """Raised when a template doesn't exist or can't be read."""
+
+
+def parse_template_ref(ref):
+    """
+    Split a template reference like "jasper-color@2" into its name and version
+
+    Returns:
+        tuple: (name, version), the version is None if the reference has none
+
+    Raises:
+        TemplateError: If the name or the version is not valid
+    """
+    if not isinstance(ref, str):
+        raise TemplateError("'template' must be a string like 'name' or 'name@version'")
+    name, _, version = ref.partition("@")
+    for part in (name, version) if version else (name,):
+        if not TEMPLATE_NAME_PATTERN.match(part):
+            raise TemplateError(f"Invalid template reference '{ref}'")
+    return name, version or None
+
+
+def version_key(version):
+    """Sort key for versions, so that "10" comes after "9" and "1.10" after "1.9"."""
+    return tuple(
+        (0, int(part), "") if part.isdigit() else (1, 0, part)
+        for part in re.split(r"[.\-_]", version)
+    )
+
+
+class WorkflowTemplates:
+    """
+    Registry of named and versioned workflows that jobs can refer to
+
+    Every template is a workflow in the API format of ComfyUI, stored as
+    <root>/<name>/<version>.json, optionally with the rules for its bindings
+    in <version>.rules.json next to it. A template is read, parsed and indexed
+    once per worker, the first time a job uses it. Jobs only send the name of
+    the template and the values that are different, see WorkflowBindings.
+
+    Args:
+        roots (list): Folders with templates, a template in an earlier folder hides the same one in a later folder
+    """
+
+    def __init__(self, roots):
+        self.roots = roots
+        self._paths = None
+        self._bindings = {}
+        self._lock = threading.Lock()
+
+    def _scan(self):
+        """Find the templates in all roots, as {name: {version: path}}."""
+        paths = {}
+        for root in reversed(self.roots):
+            if not os.path.isdir(root):
+                continue
+            for folder in os.scandir(root):
+                if not folder.is_dir() or not TEMPLATE_NAME_PATTERN.match(folder.name):
+                    continue
+                for entry in os.scandir(folder.path):
+                    version, extension = os.path.splitext(entry.name)
+                    if (
+                        extension == ".json"
+                        and TEMPLATE_NAME_PATTERN.match(version)
+                        and not version.endswith(".rules")
+                    ):
+                        paths.setdefault(folder.name, {})[version] = entry.path
+        return paths
+
+    def available(self):
+        """The available templates, as {name: [versions, oldest first]}."""
+        with self._lock:
+            if self._paths is None:
+                self._paths = self._scan()
+            return {
+                name: sorted(versions, key=version_key) for name, versions in self._paths.items()
+            }
+
+    def resolve(self, ref):
+        """
+        Find the file of a template, the latest version if the reference has none
+
+        Returns:
+            tuple: (name, version, path)
+
+        Raises:
+            TemplateError: If there is no such template
+        """
+        name, version = parse_template_ref(ref)
+        with self._lock:
+            for rescan in (False, True):
+                # Templates may have been added to the network volume since the last scan
+                if self._paths is None or rescan:
+                    self._paths = self._scan()
+                versions = self._paths.get(name, {})
+                if version is None and versions:
+                    latest = max(versions, key=version_key)
+                    return name, latest, versions[latest]
+                if version in versions:
+                    return name, version, versions[version]
+
+        raise TemplateError(f"Unknown template '{ref}'")
+
+    def bindings(self, ref):
+        """
+        Return the indexed workflow of a template, it is shared and must not be modified
+
+        Raises:
+            TemplateError: If there is no such template, or it or its rules are not valid
+        """
+        name, version, path = self.resolve(ref)
+        bindings = self._bindings.get((name, version))
+        if bindings is None:
+            rules_path = os.path.join(os.path.dirname(path), f"{version}.rules.json")
+            try:
+                with open(path, "rb") as template_file:
+                    workflow = json_loads(template_file.read())
+                rules = None
+                if os.path.exists(rules_path):
+                    with open(rules_path, "rb") as rules_file:
+                        rules = json_loads(rules_file.read())
+                if not isinstance(workflow, dict) or not isinstance(rules, (dict, type(None))):
+                    raise ValueError("expected a JSON object")
+                bindings = WorkflowBindings(workflow, rules)
+            except (OSError, ValueError) as e:
+                raise TemplateError(f"Template '{name}@{version}' can't be read: {str(e)}")
+            self._bindings[(name, version)] = bindings
+            print(f"runpod-worker-comfy - loaded template {name}@{version} from {path}")
+        return bindings
+
+    def get(self, ref):
+        """Return the workflow of a template, it is shared and must not be modified."""
+        return self.bindings(ref).workflow
+
+    def expand(self, ref, params=None):
+        """
+        Build the workflow of a job from a template and its parameters, see WorkflowBindings.apply
+
+        Raises:
+            TemplateError: If there is no such template
+            BindingError: If the parameters don't fit the template
+        """
+        return self.bindings(ref).apply(params)
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+
+# Output types that links of any type can connect to, and the other way round
+ANY_TYPE = "*"
+
+
+def workflow_hash(workflow):
+    """SHA-256 of a workflow that doesn't depend on the order of its keys."""
+    return hashlib.sha256(
+        json.dumps(workflow, sort_keys=True, separators=(",", ":")).encode("utf-8")
+    ).hexdigest()
+
+
+def input_choices(spec):
+    """The allowed values of an input spec from /object_info, or None if it is not a list of choices."""
+    if not isinstance(spec, list) or not spec:
+        return None
+    if isinstance(spec[0], list):
+        return spec[0]
+    # Newer versions of ComfyUI: ["COMBO", {"options": [...]}]
+    if spec[0] == "COMBO" and len(spec) > 1 and isinstance(spec[1], dict):
+        return spec[1].get("options")
+    return None
+
+
+def types_match(output_type, input_type):
+    """Whether an output of output_type can be linked to an input of input_type, like ComfyUI checks it."""
+    if not isinstance(output_type, str) or not isinstance(input_type, str):
+        return True
+    if ANY_TYPE in (output_type, input_type):
+        return True
+    return bool(set(output_type.split(",")) & set(input_type.split(",")))
+
+
+class WorkflowValidator:
+    """
+    Checks workflows against the node definitions of ComfyUI before they are queued
+
+    The definitions come from /object_info, which is fetched once and kept
+    until the fingerprint of the custom nodes changes. A workflow that fails
+    the checks while the definitions are older than refresh_interval is
+    checked again against fresh ones, as models or nodes may have been added
+    since. The results are kept by the hash of the workflow, so that a
+    workflow that was checked before costs a single hash.
+
+    Like ComfyUI, only the nodes that an output node depends on are checked:
+    their node type, their required inputs, the choices of their enum inputs
+    (which include the model files ComfyUI found on disk), and the type of
+    their links. Image inputs that accept uploads are left to the upload,
+    as jobs bring their own images.
+
+    Args:
+        fetch (callable): Returns the parsed response of /object_info
+        fingerprint (callable, optional): Returns a value that changes when the custom nodes change
+        refresh_interval (float): Seconds before failed workflows may fetch the definitions again
+        cache_size (int): How many results are kept
+    """
+
+    def __init__(self, fetch, fingerprint=None, refresh_interval=60.0, cache_size=1024):
+        self.fetch = fetch
+        self.fingerprint = fingerprint or (lambda: None)
+        self.refresh_interval = refresh_interval
+        self.cache_size = cache_size
+        self.object_info = None
+        self.fetched_at = None
+        self._fingerprint = None
+        self._results = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, force=False):
+        """
+        Fetch the node definitions, unless they are known and the custom nodes didn't change
+
+        Returns:
+            dict: The node definitions by class_type
+        """
+        fingerprint = self.fingerprint()
+        with self._lock:
+            if force or self.object_info is None or fingerprint != self._fingerprint:
+                start = time.perf_counter()
+                self.object_info = self.fetch()
+                self.fetched_at = time.monotonic()
+                self._fingerprint = fingerprint
+                self._results.clear()
+                print(
+                    f"runpod-worker-comfy - loaded {len(self.object_info)} node definitions "
+                    f"in {(time.perf_counter() - start) * 1000:.0f}ms"
+                )
+            return self.object_info
+
+    def output_classes(self):
+        """The class_type of all output nodes, or None if the definitions were not loaded yet."""
+        object_info = self.object_info
+        if object_info is None:
+            return None
+        return {name for name, info in object_info.items() if info.get("output_node")}
+
+    def validate(self, workflow):
+        """
+        Check a workflow against the node definitions
+
+        Returns:
+            list: Every error that was found, empty if the workflow is valid
+        """
+        object_info = self.load()
+        key = workflow_hash(workflow)
+        with self._lock:
+            errors = self._results.get(key)
+            if errors is not None:
+                self._results.move_to_end(key)
+                return errors
+
+        errors = self.check(workflow, object_info)
+        if errors and time.monotonic() - self.fetched_at > self.refresh_interval:
+            errors = self.check(workflow, self.load(force=True))
+
+        with self._lock:
+            self._results[key] = errors
+            while len(self._results) > self.cache_size:
+                self._results.popitem(last=False)
+        return errors
+
+    @staticmethod
+    def check(workflow, object_info):
+        """Check a workflow against the given node definitions, see validate()."""
+        errors = []
+        if not isinstance(workflow, dict):
+            return ["The workflow must be an object of nodes by ID"]
+
+        def name(node_id):
+            node = workflow[node_id]
+            title = (node.get("_meta") or {}).get("title") or node.get("class_type")
+            return f"Node {node_id} ({title})"
+
+        pending = [
+            node_id
+            for node_id, node in workflow.items()
+            if isinstance(node, dict)
+            and (object_info.get(node.get("class_type")) or {}).get("output_node")
+        ]
+        if not pending:
+            return ["The workflow has no output nodes"]
+
+        seen = set(pending)
+        while pending:
+            node_id = pending.pop()
+            node = workflow[node_id]
+            info = object_info.get(node.get("class_type"))
+            if info is None:
+                errors.append(f"{name(node_id)}: unknown node type '{node.get('class_type')}'")
+                continue
+
+            inputs = node.get("inputs") or {}
+            declared = info.get("input") or {}
+            required = declared.get("required") or {}
+            specs = {**(declared.get("optional") or {}), **required}
+            for input_name in required:
+                if input_name not in inputs:
+                    errors.append(f"{name(node_id)}: required input '{input_name}' is missing")
+
+            for input_name, value in inputs.items():
+                spec = specs.get(input_name)
+                if isinstance(value, list) and len(value) == 2 and isinstance(value[1], int):
+                    source_id, output_index = value
+                    source = workflow.get(source_id)
+                    if not isinstance(source, dict):
+                        errors.append(
+                            f"{name(node_id)}: input '{input_name}' links to node {source_id}, "
+                            f"which is not in the workflow"
+                        )
+                        continue
+                    if source_id not in seen:
+                        seen.add(source_id)
+                        pending.append(source_id)
+                    outputs = (object_info.get(source.get("class_type")) or {}).get("output")
+                    if outputs is None or spec is None:
+                        continue
+                    if not 0 <= output_index < len(outputs):
+                        errors.append(
+                            f"{name(node_id)}: input '{input_name}' links to output {output_index} "
+                            f"of {name(source_id)}, which has {len(outputs)} outputs"
+                        )
+                    elif not types_match(outputs[output_index], spec[0] if spec else None):
+                        errors.append(
+                            f"{name(node_id)}: input '{input_name}' expects {spec[0]}, "
+                            f"but {name(source_id)} returns {outputs[output_index]}"
+                        )
+                    continue
+
+                choices = input_choices(spec)
+                options = spec[1] if spec and len(spec) > 1 and isinstance(spec[1], dict) else {}
+                if choices is not None and not options.get("image_upload") and value not in choices:
+                    shown = ", ".join(map(repr, choices[:10])) + (", ..." if len(choices) > 10 else "")
+                    errors.append(
+                        f"{name(node_id)}: '{value}' is not a valid value for '{input_name}', "
+                        f"expected one of {shown}"
+                    )
+        return errors
@@ -1,6 +1,7 @@
 import json
 import requests
 import random
+import os
 import sys
 from PIL import Image
 import io
@@ -8,6 +9,13 @@ import time
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from itertools import product
 
+# The worker uses the same binding engine for the 'params' of a job
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+from workflow_bindings import WorkflowBindings
+
+# One seed per request, shared by GlobalSeed and GlobalSeedString
+SEED_RULES = {"GlobalSeed": "random_seed()", "GlobalSeedString": "str(GlobalSeed)"}
+
 # List of color codes (keeping your original colors)
 colors = [
     '3350979',    # INDIGO
@@ -32,29 +40,16 @@ colors = [
     '15321022'    # MISTY_ROSE
 ]
 
-def set_params(workflow, colorDetail, colorBody, token, whatVase, isCreative, isLAB):
-    # Your existing set_params function remains unchanged
-    for node in workflow:
-        seed = random.randint(0, sys.maxsize)
-        if node == '552':
-            workflow[node]['inputs']['value'] = whatVase
-        if node == '618':
-            workflow[node]['inputs']['value'] = isCreative
-        if node == '624':
-            workflow[node]['inputs']['value'] = isLAB
-
-        if '_meta' in workflow[node]:
-            if workflow[node]['_meta']['title'] == 'ColorInputDetails':
-                workflow[node]['inputs']['value'] = colorDetail
-            if workflow[node]['_meta']['title'] == 'ColorInputBody':
-                workflow[node]['inputs']['value'] = colorBody
-            if workflow[node]['_meta']['title'] == 'PromptTokenInput':
-                workflow[node]['inputs']['value'] = token
-            if workflow[node]['_meta']['title'] == 'GlobalSeed':
-                workflow[node]['inputs']['value'] = seed
-            if workflow[node]['_meta']['title'] == 'GlobalSeedString':
-                workflow[node]['inputs']['value'] = str(seed)
-    return workflow
+def set_params(bindings, colorDetail, colorBody, token, whatVase, isCreative, isLAB):
+    # GlobalSeed and GlobalSeedString are filled in by SEED_RULES
+    return bindings.apply({
+        '552': whatVase,
+        '618': isCreative,
+        '624': isLAB,
+        'ColorInputDetails': colorDetail,
+        'ColorInputBody': colorBody,
+        'PromptTokenInput': token,
+    })
 
 def send_request(workflow, api_url, api_key, testWF):
     # Your existing send_request function remains unchanged
@@ -90,11 +85,10 @@ def load_tokens_from_csv(csv_path):
 
 def prepare_and_send_request(args):
     # Your existing prepare_and_send_request function remains unchanged
-    (i, original_workflow, api_url, api_key, token, colorDetail, colorBody, 
+    (i, bindings, api_url, api_key, token, colorDetail, colorBody, 
      whatVase, isCreative, isLAB, testWF, combination_id) = args
     
-    workflow = json.loads(json.dumps(original_workflow))
-    workflow = set_params(workflow, colorDetail, colorBody, token, whatVase, isCreative, isLAB)
+    workflow = set_params(bindings, colorDetail, colorBody, token, whatVase, isCreative, isLAB)
 
     start = time.time()
     response = send_request(workflow, api_url, api_key, testWF)
@@ -107,7 +101,7 @@ def prepare_and_send_request(args):
 def main(input_json_path, api_url, api_key, csv_path, isLAB, testWF, requests_per_combination, specific_vase=None, specific_creative=None, exclude_vase=None):
     # Load workflow and tokens
     with open(input_json_path, "r") as f:
-        original_workflow = json.load(f)
+        bindings = WorkflowBindings(json.load(f), SEED_RULES)
 
     tokens = load_tokens_from_csv(csv_path)
     if not tokens:
@@ -169,7 +163,7 @@ def main(input_json_path, api_url, api_key, csv_path, isLAB, testWF, requests_pe
             for req_num in range(requests_per_combination):
                 token = random.choice(tokens)
                 args = (
-                    len(futures), original_workflow, api_url, api_key, 
+                    len(futures), bindings, api_url, api_key, 
                     token, color_detail, color_body, vase, creative, 
                     isLAB, testWF, combination_id
                 )
@@ -0,0 +1,99 @@
+import builtins
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import cold_start.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import cold_start
+
+COMFY_LOG = """\
+Total VRAM 24564 MB, total RAM 64282 MB
+
+Import times for custom nodes:
+   0.0 seconds: /app/ComfyUI/custom_nodes/websocket_image_save.py
+   0.4 seconds (IMPORT FAILED): /app/ComfyUI/custom_nodes/ComfyUI_IPAdapter_plus
+   2.5 seconds: /app/ComfyUI/custom_nodes/ComfyUI-Impact-Pack
+
+Starting server
+"""
+
+
+class TestColdStartTimeline(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.marks_path = os.path.join(self.root, "marks")
+        self.log_path = os.path.join(self.root, "comfyui.log")
+
+    def test_marks_are_relative_to_the_start_of_the_container(self):
+        with open(self.marks_path, "w") as marks_file:
+            marks_file.write("100.0 container_start\n101.5 comfyui_start\nbroken line\n")
+        with patch.object(cold_start, "process_start_time", return_value=None):
+            timeline = cold_start.ColdStartTimeline(self.marks_path)
+        with patch.object(cold_start.time, "time", return_value=103.0):
+            timeline.mark("first_job")
+            timeline.mark("first_job", once=True)
+
+        report = timeline.report()
+
+        self.assertEqual(
+            report["since_container_start_ms"],
+            {"container_start": 0.0, "comfyui_start": 1500.0, "first_job": 3000.0},
+        )
+
+    def test_without_marks_the_first_process_is_the_start(self):
+        with patch.object(cold_start, "process_start_time", side_effect=[50.0, 48.0]):
+            timeline = cold_start.ColdStartTimeline(os.path.join(self.root, "missing"))
+            report = timeline.report()
+
+        self.assertEqual(report["since_container_start_ms"], {"container_start": 0.0, "handler_process": 2000.0})
+
+    def test_imports_are_timed_by_their_top_level_module(self):
+        timeline = cold_start.ColdStartTimeline()
+        clock = iter([1.0, 1.25])
+        with patch.object(cold_start.time, "perf_counter", side_effect=lambda: next(clock)):
+            timeline.start_import_profile()
+            try:
+                import json.decoder  # noqa: F401
+            finally:
+                timeline.stop_import_profile()
+
+        self.assertEqual(timeline.report()["imports_ms"], {"json": 250.0})
+
+    def test_a_failed_import_ends_the_import_profile(self):
+        timeline = cold_start.ColdStartTimeline()
+        original = builtins.__import__
+
+        with self.assertRaises(ImportError):
+            with timeline.profile_imports():
+                import module_that_does_not_exist  # noqa: F401
+
+        self.assertIs(builtins.__import__, original)
+
+    def test_custom_node_import_times_from_the_log_of_comfyui(self):
+        with open(self.log_path, "w") as log_file:
+            log_file.write(COMFY_LOG)
+
+        self.assertEqual(
+            cold_start.custom_node_import_times(self.log_path),
+            {
+                "ComfyUI-Impact-Pack": 2500.0,
+                "ComfyUI_IPAdapter_plus (failed)": 400.0,
+                "websocket_image_save.py": 0.0,
+            },
+        )
+        self.assertEqual(cold_start.custom_node_import_times(os.path.join(self.root, "missing")), {})
+
+    def test_report_once(self):
+        timeline = cold_start.ColdStartTimeline()
+
+        self.assertIsNotNone(timeline.report_once())
+        self.assertIsNone(timeline.report_once())
+
+
+if __name__ == "__main__":
+    unittest.main()
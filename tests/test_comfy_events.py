@@ -0,0 +1,100 @@
+import unittest
+import json
+import os
+import queue
+import sys
+
+import websocket
+
+# Make sure that "src" is known and can be used to import comfy_events.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import comfy_events
+
+
+class FakeWebSocket:
+    """Returns the messages put into it from recv(), like a websocket of ComfyUI."""
+
+    def __init__(self):
+        self.messages = queue.Queue()
+        self.closed = False
+
+    def send_event(self, event_type, data):
+        self.messages.put(json.dumps({"type": event_type, "data": data}))
+
+    def recv(self):
+        message = self.messages.get(timeout=5)
+        if isinstance(message, Exception):
+            raise message
+        return message
+
+    def close(self):
+        self.closed = True
+
+
+class TestComfyEventRouter(unittest.TestCase):
+    def setUp(self):
+        self.sockets = []
+
+    def connect(self, client_id):
+        ws = FakeWebSocket()
+        self.sockets.append(ws)
+        return ws
+
+    def test_events_are_routed_by_prompt_id(self):
+        router = comfy_events.ComfyEventRouter(self.connect, recv_timeout=1)
+        first = router.subscribe()
+        second = router.subscribe()
+        ws = self.sockets[0]
+
+        # The events of the first prompt arrive before the job knows its prompt_id
+        ws.send_event("execution_start", {"prompt_id": "a"})
+        ws.send_event("executing", {"node": "3", "prompt_id": "a"})
+        ws.messages.put(b"preview")
+        ws.send_event("status", {"status": {}})
+        first.bind("a")
+        second.bind("b")
+        ws.send_event("executing", {"node": "9", "prompt_id": "b"})
+        ws.send_event("executing", {"node": None, "prompt_id": "a"})
+
+        self.assertEqual(json.loads(first.recv())["type"], "execution_start")
+        self.assertEqual(json.loads(first.recv())["data"]["node"], "3")
+        self.assertEqual(first.recv(), b"preview")
+        self.assertIsNone(json.loads(first.recv())["data"]["node"])
+        self.assertEqual(json.loads(second.recv())["data"]["prompt_id"], "b")
+
+    def test_recv_times_out(self):
+        router = comfy_events.ComfyEventRouter(self.connect, recv_timeout=0.01)
+        subscription = router.subscribe()
+        subscription.bind("a")
+
+        with self.assertRaises(websocket.WebSocketTimeoutException):
+            subscription.recv()
+
+    def test_dropped_connection_fails_subscriptions_and_reconnects(self):
+        failures = []
+        router = comfy_events.ComfyEventRouter(
+            self.connect, recv_timeout=1, reconnect_delay=0.01, on_failure=failures.append
+        )
+        subscription = router.subscribe()
+        subscription.bind("a")
+
+        self.sockets[0].messages.put(websocket.WebSocketConnectionClosedException("closed"))
+
+        with self.assertRaises(websocket.WebSocketConnectionClosedException):
+            subscription.recv()
+        self.assertIsNotNone(router.subscribe())
+        self.assertEqual(len(self.sockets), 2)
+        self.assertTrue(self.sockets[0].closed)
+        self.assertEqual(len(failures), 1)
+
+    def test_subscribe_without_connection(self):
+        def refuse(client_id):
+            raise ConnectionRefusedError("refused")
+
+        router = comfy_events.ComfyEventRouter(refuse, reconnect_delay=0.01)
+
+        self.assertIsNone(router.subscribe(timeout=0.05))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+import unittest
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import input_store.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import input_store
+
+
+class TestInputStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_put_and_get(self):
+        store = input_store.InputStore(self.root, 1024)
+
+        sha256 = store.put(b"image")
+
+        self.assertEqual(sha256, hashlib.sha256(b"image").hexdigest())
+        self.assertTrue(store.has(sha256))
+        self.assertEqual(store.get(sha256), b"image")
+        self.assertIsNone(store.get("0" * 64))
+        self.assertFalse(store.has("0" * 64))
+
+    def test_least_recently_used_images_are_evicted(self):
+        store = input_store.InputStore(self.root, 25)
+        first = store.put(b"a" * 10)
+        second = store.put(b"b" * 10)
+
+        # Using the first image makes the second one the least recently used
+        store.get(first)
+        third = store.put(b"c" * 10)
+
+        self.assertTrue(store.has(first))
+        self.assertFalse(store.has(second))
+        self.assertTrue(store.has(third))
+
+    def test_image_larger_than_budget_is_kept(self):
+        store = input_store.InputStore(self.root, 5)
+
+        sha256 = store.put(b"a" * 10)
+
+        self.assertEqual(store.get(sha256), b"a" * 10)
+
+    def test_index_is_restored_from_disk(self):
+        first = input_store.InputStore(self.root, 1024).put(b"image")
+
+        store = input_store.InputStore(self.root, 1024)
+
+        self.assertTrue(store.has(first))
+        store.put(b"x" * 1020)
+        self.assertFalse(store.has(first))
+
+    def test_is_sha256(self):
+        self.assertTrue(input_store.is_sha256("a" * 64))
+        self.assertFalse(input_store.is_sha256("A" * 64))
+        self.assertFalse(input_store.is_sha256("a" * 63))
+        self.assertFalse(input_store.is_sha256(None))
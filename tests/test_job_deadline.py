@@ -0,0 +1,58 @@
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import job_deadline.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import job_deadline
+
+
+class TestJobDeadline(unittest.TestCase):
+    def at(self, now):
+        return patch.object(job_deadline.time, "monotonic", return_value=now)
+
+    def test_times_out_at_the_deadline(self):
+        with self.at(100):
+            deadline = job_deadline.JobDeadline(30)
+        with self.at(129):
+            deadline.check()
+            self.assertEqual(deadline.next_check(10), 1)
+        with self.at(130), self.assertRaises(job_deadline.JobTimeoutError) as context:
+            deadline.check()
+
+        self.assertIn("timed out after 30s", str(context.exception))
+
+    def test_watchdog_starts_with_the_first_progress(self):
+        with self.at(100):
+            deadline = job_deadline.JobDeadline(300, stall_timeout=20)
+        # Waiting in the queue is no stall
+        with self.at(150):
+            deadline.check()
+            deadline.progress()
+        with self.at(165):
+            self.assertEqual(deadline.next_check(10), 5)
+        with self.at(170), self.assertRaises(job_deadline.JobTimeoutError) as context:
+            deadline.check()
+
+        self.assertIn("no progress for 20s", str(context.exception))
+        deadline.done("prompt")
+        with self.at(170):
+            deadline.check()
+
+    def test_cancel(self):
+        deadline = job_deadline.JobDeadline(300)
+        deadline.track("a")
+        deadline.track("b")
+        deadline.done("a")
+
+        deadline.cancel()
+
+        self.assertEqual(deadline.pending(), ["b"])
+        with self.assertRaises(job_deadline.JobTimeoutError) as context:
+            deadline.check()
+        self.assertIn("cancelled", str(context.exception))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import threading
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import job_timings.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import job_timings
+
+
+class TestJobTimings(unittest.TestCase):
+    def test_phases_add_up_in_the_order_they_first_ran(self):
+        clock = iter([0.0, 1.0, 1.5, 2.0, 2.25, 3.0, 3.75, 10.0])
+        with patch.object(job_timings.time, "perf_counter", side_effect=lambda: next(clock)):
+            timings = job_timings.JobTimings()
+            with timings.phase("upload"):
+                pass
+            with timings.phase("wait"):
+                pass
+            with timings.phase("upload"):
+                pass
+
+            self.assertEqual(
+                timings.as_dict(), {"upload_ms": 1250.0, "wait_ms": 250.0, "total_ms": 10000.0}
+            )
+
+    def test_phases_on_several_threads(self):
+        timings = job_timings.JobTimings()
+
+        def work():
+            for _ in range(1000):
+                timings.add("encode", 0.001)
+
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertAlmostEqual(timings.as_dict()["encode_ms"], 4000.0)
+
+    def test_disabled(self):
+        timings = job_timings.JobTimings(enabled=False)
+
+        with timings.phase("validate"):
+            pass
+
+        self.assertEqual(list(timings.as_dict()), ["total_ms"])
+        with job_timings.NO_TIMINGS.phase("validate"):
+            pass
+        self.assertEqual(job_timings.NO_TIMINGS.phases, {})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,97 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import job_trace.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import job_trace
+from job_timings import JobTimings
+from node_profiler import NodeProfiler
+
+
+class TestJobTracer(unittest.TestCase):
+    def spans(self, trace):
+        return [event for event in trace["traceEvents"] if event["ph"] == "X"]
+
+    def test_spans_are_exported_in_microseconds_since_the_start(self):
+        clock = iter([10.0, 10.5, 10.75])
+        with patch.object(job_trace.time, "perf_counter", side_effect=lambda: next(clock)):
+            tracer = job_trace.JobTracer("job")
+            with tracer.span("upload", image="a.png"):
+                pass
+
+        (span,) = self.spans(tracer.export())
+
+        self.assertEqual(span["name"], "upload")
+        self.assertEqual(span["ts"], 500000.0)
+        self.assertEqual(span["dur"], 250000.0)
+        self.assertEqual(span["tid"], threading.get_ident())
+        self.assertEqual(span["args"], {"image": "a.png"})
+
+    def test_every_thread_gets_a_named_track(self):
+        tracer = job_trace.JobTracer("job")
+        thread = threading.Thread(target=lambda: tracer.complete("encode", 1.0, 2.0), name="outputs")
+        thread.start()
+        thread.join()
+        tracer.complete("wait", 1.0, 2.0)
+
+        trace = tracer.export()
+        names = {
+            event["tid"]: event["args"]["name"]
+            for event in trace["traceEvents"]
+            if event["name"] == "thread_name"
+        }
+
+        self.assertEqual({names[span["tid"]] for span in self.spans(trace)}, {"outputs", "MainThread"})
+
+    def test_ring_buffer_keeps_the_last_spans(self):
+        tracer = job_trace.JobTracer("job", max_events=2)
+        for name in ("a", "b", "c"):
+            tracer.complete(name, 1.0, 2.0)
+
+        trace = tracer.export()
+
+        self.assertEqual([span["name"] for span in self.spans(trace)], ["b", "c"])
+        self.assertEqual(trace["otherData"]["dropped_events"], 1)
+
+    def test_nodes_of_comfyui_are_on_their_own_track(self):
+        tracer = job_trace.JobTracer("job")
+        profiler = NodeProfiler({"3": {"inputs": {}, "class_type": "KSampler"}})
+        profiler.runs = [("3", tracer.monotonic_origin + 1.0, tracer.monotonic_origin + 3.0)]
+
+        tracer.add_profile(profiler, variant=2)
+        (span,) = self.spans(tracer.export())
+
+        self.assertEqual(span["name"], "KSampler")
+        self.assertEqual(span["tid"], job_trace.COMFYUI_TRACK)
+        self.assertEqual((span["ts"], span["dur"]), (1000000.0, 2000000.0))
+        self.assertEqual(span["args"], {"node": "3", "variant": 2})
+
+    def test_phases_of_job_timings_are_traced(self):
+        tracer = job_trace.JobTracer("job")
+        timings = JobTimings(tracer=tracer)
+        with timings.phase("queue"):
+            pass
+
+        self.assertEqual([span["name"] for span in self.spans(tracer.export())], ["queue"])
+
+    def test_write_saves_the_trace_as_json(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        tracer = job_trace.JobTracer("job")
+        tracer.complete("wait", 1.0, 2.0)
+
+        path = tracer.write(os.path.join(root, "traces"))
+
+        self.assertEqual(os.path.basename(path), "job.trace.json")
+        with open(path) as trace_file:
+            self.assertEqual(json.load(trace_file), tracer.export())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,142 @@
+import json
+import shutil
+import tempfile
+import threading
+import unittest
+import os
+import sys
+import urllib.error
+import urllib.request
+
+# Make sure that "src" is known and can be used to import metrics.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter_adds_up_the_values_of_all_threads(self):
+        counter = metrics.Counter("jobs_total", "Jobs", ("status",))
+
+        def count():
+            for _ in range(1000):
+                counter.inc(1, "success")
+
+        threads = [threading.Thread(target=count) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        counter.inc(2, "error")
+
+        self.assertEqual(counter.samples(), [("", ("error",), 2), ("", ("success",), 8000)])
+        # The shards of the threads that ended are folded into one
+        self.assertEqual(len(counter._shards._shards), 1)
+        self.assertEqual(counter.samples()[1][2], 8000)
+
+    def test_histogram_counts_cumulative_buckets(self):
+        histogram = metrics.Histogram("phase_seconds", "Phases", ("phase",), buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 3):
+            histogram.observe(value, "wait")
+
+        self.assertEqual(
+            histogram.samples(),
+            [
+                ("_bucket", ("wait", "0.1"), 2),
+                ("_bucket", ("wait", "1"), 3),
+                ("_bucket", ("wait", "+Inf"), 4),
+                ("_sum", ("wait",), 3.65),
+                ("_count", ("wait",), 4),
+            ],
+        )
+
+    def test_render_prometheus_text(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter("jobs_total", "Jobs handled", ("status",)).inc(3, "success")
+        registry.gauge("queue", "Prompts in the queue").set(2)
+        registry.histogram("job_seconds", "Jobs", buckets=(1,)).observe(0.5)
+
+        self.assertEqual(
+            registry.render(),
+            "# HELP jobs_total Jobs handled\n"
+            "# TYPE jobs_total counter\n"
+            'jobs_total{status="success"} 3\n'
+            "# HELP queue Prompts in the queue\n"
+            "# TYPE queue gauge\n"
+            "queue 2\n"
+            "# HELP job_seconds Jobs\n"
+            "# TYPE job_seconds histogram\n"
+            'job_seconds_bucket{le="1"} 1\n'
+            'job_seconds_bucket{le="+Inf"} 1\n'
+            "job_seconds_sum 0.5\n"
+            "job_seconds_count 1\n",
+        )
+
+    def test_snapshot_has_the_labels_and_values(self):
+        registry = metrics.MetricsRegistry()
+        registry.gauge("vram", "VRAM", ("device", "kind")).set(1024, "cuda:0", "vram_free")
+        registry.histogram("job_seconds", "Jobs", buckets=(1,)).observe(2)
+
+        self.assertEqual(
+            registry.snapshot(),
+            {
+                "vram": [[{"device": "cuda:0", "kind": "vram_free"}, 1024]],
+                "job_seconds": [[{}, {"counts": [0, 1], "sum": 2, "count": 1}]],
+            },
+        )
+
+    def test_server_serves_the_metrics(self):
+        registry = metrics.MetricsRegistry()
+        registry.counter("jobs_total", "Jobs").inc()
+        server = metrics.MetricsServer(registry, 0, host="127.0.0.1")
+        server.start()
+        self.addCleanup(server.stop)
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/metrics") as response:
+            body = response.read().decode()
+
+        self.assertIn("jobs_total 1\n", body)
+
+    def test_server_serves_the_health(self):
+        health = {"healthy": True, "warm": None}
+        server = metrics.MetricsServer(metrics.MetricsRegistry(), 0, host="127.0.0.1", health=lambda: health)
+        server.start()
+        self.addCleanup(server.stop)
+
+        with urllib.request.urlopen(f"http://127.0.0.1:{server.port}/health") as response:
+            self.assertEqual(json.loads(response.read()), {"healthy": True, "warm": None})
+
+        health = {"healthy": False, "warm": False}
+        with self.assertRaises(urllib.error.HTTPError) as raised:
+            urllib.request.urlopen(f"http://127.0.0.1:{server.port}/health")
+        self.assertEqual(raised.exception.code, 503)
+        self.assertEqual(json.loads(raised.exception.read()), {"healthy": False, "warm": False})
+        raised.exception.close()
+
+    def test_sampler_appends_a_snapshot_per_run(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        registry = metrics.MetricsRegistry()
+        gauge = registry.gauge("queue", "Prompts in the queue")
+        sampler = metrics.MetricsSampler(registry, lambda: gauge.set(5), root=root, worker_id="test")
+
+        sampler.run_once()
+        sampler.run_once()
+
+        (name,) = os.listdir(root)
+        self.assertTrue(name.endswith("-test.jsonl"))
+        with open(os.path.join(root, name)) as snapshot_file:
+            lines = [json.loads(line) for line in snapshot_file]
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]["metrics"], {"queue": [[{}, 5]]})
+
+    def test_sampler_survives_failed_samples(self):
+        def sample():
+            raise OSError("ComfyUI is gone")
+
+        sampler = metrics.MetricsSampler(metrics.MetricsRegistry(), sample)
+
+        sampler.run_once()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,121 @@
+import contextlib
+import io
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import node_profiler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import node_profiler
+
+WORKFLOW = {
+    "4": {"inputs": {"ckpt_name": "sdxl.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+    "6": {"inputs": {"text": "vase", "clip": ["4", 1]}, "class_type": "CLIPTextEncode"},
+    "3": {"inputs": {"model": ["4", 0], "positive": ["6", 0]}, "class_type": "KSampler"},
+    "9": {"inputs": {"images": ["3", 0]}, "class_type": "SaveImage"},
+}
+
+
+def run_prompt(profiler, events):
+    """Feed (time, event_type, data) events to a profiler."""
+    for now, event_type, data in events:
+        with patch.object(node_profiler.time, "monotonic", return_value=now):
+            profiler.update(event_type, data)
+    return profiler
+
+
+PROMPT = [
+    (10.0, "execution_start", {"prompt_id": "1"}),
+    (10.0, "execution_cached", {"nodes": ["4"], "prompt_id": "1"}),
+    (10.0, "executing", {"node": "6", "prompt_id": "1"}),
+    (10.5, "executing", {"node": "3", "prompt_id": "1"}),
+    (11.0, "progress", {"value": 1, "max": 2, "node": "3", "prompt_id": "1"}),
+    (14.5, "executing", {"node": "9", "prompt_id": "1"}),
+    (14.75, "executed", {"node": "9", "output": {}, "prompt_id": "1"}),
+    (15.0, "execution_success", {"prompt_id": "1"}),
+]
+
+
+class TestNodeProfiler(unittest.TestCase):
+    def test_profile_from_events(self):
+        profiler = run_prompt(node_profiler.NodeProfiler(WORKFLOW), PROMPT)
+
+        self.assertEqual(
+            profiler.profile(),
+            {
+                "total_ms": 5000.0,
+                "nodes": [
+                    ["6", "CLIPTextEncode", 0.0, 500.0],
+                    ["3", "KSampler", 500.0, 4000.0],
+                    ["9", "SaveImage", 4500.0, 250.0],
+                ],
+                "classes": [["KSampler", 1, 4000.0], ["CLIPTextEncode", 1, 500.0], ["SaveImage", 1, 250.0]],
+                "cached": 1,
+            },
+        )
+
+    def test_wrap_passes_the_events_on(self):
+        profiler = node_profiler.NodeProfiler(WORKFLOW)
+        events = []
+
+        on_event = profiler.wrap(lambda *event: events.append(event))
+        on_event("executing", {"node": "6", "prompt_id": "1"})
+        on_event(None, b"preview")
+
+        self.assertEqual([event_type for event_type, _ in events], ["executing", None])
+        self.assertEqual(profiler.current[0], "6")
+
+
+class TestNodeProfileStore(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+
+    def test_adds_up_the_prompts_of_all_workers(self):
+        for worker_id in ("a", "b"):
+            store = node_profiler.NodeProfileStore(self.root, worker_id=worker_id)
+            store.record(run_prompt(node_profiler.NodeProfiler(WORKFLOW), PROMPT))
+        store.record(run_prompt(node_profiler.NodeProfiler(WORKFLOW), PROMPT))
+
+        aggregate = node_profiler.load_aggregate(self.root)
+
+        self.assertEqual(aggregate["prompts"], 3)
+        self.assertEqual(aggregate["classes"]["KSampler"], [3, 0, 12000.0, 4000.0])
+        self.assertEqual(aggregate["classes"]["CheckpointLoaderSimple"], [3, 3, 0.0, 0.0])
+        top = node_profiler.top_nodes(aggregate, n=2)
+        self.assertEqual([row["name"] for row in top], ["KSampler", "CLIPTextEncode"])
+        self.assertEqual(top[0]["mean_ms"], 4000.0)
+        self.assertEqual(top[0]["share"], round(4000 / 4750, 4))
+        self.assertEqual(node_profiler.top_nodes(aggregate, by="nodes", n=1)[0]["name"], "KSampler#3")
+
+    def test_removes_old_files(self):
+        old = os.path.join(self.root, "2020-01-01-a.json")
+        with open(old, "w") as old_file:
+            old_file.write("{}")
+        os.utime(old, (0, 0))
+
+        store = node_profiler.NodeProfileStore(self.root, retention_days=7, worker_id="a")
+        store.record(run_prompt(node_profiler.NodeProfiler(WORKFLOW), PROMPT))
+
+        self.assertFalse(os.path.exists(old))
+        self.assertEqual(len(os.listdir(self.root)), 1)
+
+    def test_cli_prints_the_slowest_classes(self):
+        store = node_profiler.NodeProfileStore(self.root, worker_id="a")
+        store.record(run_prompt(node_profiler.NodeProfiler(WORKFLOW), PROMPT))
+        output = io.StringIO()
+
+        with contextlib.redirect_stdout(output):
+            node_profiler.main([self.root, "--top", "1"])
+
+        lines = output.getvalue().splitlines()
+        self.assertEqual(lines[0], f"1 prompts in {self.root}")
+        self.assertEqual(len(lines), 3)
+        self.assertTrue(lines[2].startswith("KSampler "))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,68 @@
+import unittest
+import os
+import struct
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import progress.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import progress
+
+WORKFLOW = {
+    "3": {"class_type": "KSamplerAdvanced", "_meta": {"title": "First Pass"}},
+    "9": {"class_type": "SaveImage"},
+}
+
+
+class TestProgressTracker(unittest.TestCase):
+    def test_reports_node_and_steps(self):
+        tracker = progress.ProgressTracker(WORKFLOW, min_interval=0)
+
+        tracker.update("execution_cached", {"nodes": ["1"]})
+        tracker.update("executing", {"node": "3"})
+        update = tracker.update("progress", {"node": "3", "value": 4, "max": 20})
+
+        self.assertEqual(update["node"], "3")
+        self.assertEqual(update["class_type"], "KSamplerAdvanced")
+        self.assertEqual(update["title"], "First Pass")
+        self.assertEqual((update["step"], update["max_steps"]), (4, 20))
+        self.assertEqual((update["nodes_done"], update["nodes_total"]), (1, 2))
+
+    def test_updates_are_rate_limited(self):
+        tracker = progress.ProgressTracker(WORKFLOW, min_interval=60)
+
+        first = tracker.update("progress", {"node": "3", "value": 1, "max": 20})
+        second = tracker.update("progress", {"node": "3", "value": 2, "max": 20})
+
+        self.assertEqual(first["step"], 1)
+        self.assertIsNone(second)
+        # The latest state is kept for the next update
+        self.assertEqual(tracker.flush()["step"], 2)
+        self.assertIsNone(tracker.flush())
+
+    def test_ignores_other_events(self):
+        tracker = progress.ProgressTracker(WORKFLOW, min_interval=0)
+
+        self.assertIsNone(tracker.update("execution_start", {}))
+
+    @patch.object(progress, "Image", None)
+    def test_previews_are_attached_when_enabled(self):
+        message = struct.pack(">II", progress.PREVIEW_IMAGE, 2) + b"png bytes"
+
+        without = progress.ProgressTracker(WORKFLOW, min_interval=0)
+        self.assertIsNone(without.update(None, message))
+
+        tracker = progress.ProgressTracker(WORKFLOW, min_interval=0, preview_max_size=256)
+        update = tracker.update(None, message)
+        self.assertTrue(update["preview"].startswith("data:image/png;base64,"))
+
+    def test_decode_preview(self):
+        self.assertEqual(
+            progress.decode_preview(struct.pack(">II", 1, 1) + b"jpeg"), ("jpeg", b"jpeg")
+        )
+        self.assertIsNone(progress.decode_preview(struct.pack(">II", 3, 1) + b"text"))
+        self.assertIsNone(progress.decode_preview(b"short"))
+
+
+if __name__ == "__main__":
+    unittest.main()
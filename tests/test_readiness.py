@@ -0,0 +1,88 @@
+import unittest
+from unittest.mock import Mock
+import sys
+import os
+
+# Make sure that "src" is known and can be used to import readiness.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import readiness
+
+
+class TestComfyReadiness(unittest.TestCase):
+    def make_readiness(self, boot_result=True, probe_result=True):
+        return readiness.ComfyReadiness(
+            boot_probe=Mock(return_value=boot_result),
+            probe=Mock(return_value=probe_result),
+            dead_after_failures=3,
+        )
+
+    def test_boot_probe_runs_only_once(self):
+        comfy = self.make_readiness()
+
+        self.assertTrue(comfy.wait_until_ready())
+        self.assertTrue(comfy.wait_until_ready())
+
+        self.assertEqual(comfy.state, readiness.READY)
+        comfy.boot_probe.assert_called_once()
+        comfy.probe.assert_not_called()
+
+    def test_warmup_is_part_of_the_snapshot(self):
+        comfy = self.make_readiness()
+        self.assertIsNone(comfy.snapshot()["warm"])
+
+        comfy.record_warmup(False, [{"workflow": "jasper-color@2", "status": "error"}])
+
+        self.assertFalse(comfy.warm)
+        self.assertEqual(comfy.snapshot()["warmup"], [{"workflow": "jasper-color@2", "status": "error"}])
+
+    def test_failed_boot_probe_marks_comfy_dead(self):
+        comfy = self.make_readiness(boot_result=False, probe_result=False)
+
+        self.assertFalse(comfy.wait_until_ready())
+        self.assertEqual(comfy.state, readiness.DEAD)
+
+        # Later jobs only pay for a single quick probe
+        self.assertFalse(comfy.wait_until_ready())
+        comfy.boot_probe.assert_called_once()
+        comfy.probe.assert_called_once()
+
+    def test_recovery_is_reported(self):
+        comfy = self.make_readiness(boot_result=False, probe_result=True)
+        comfy.on_recovered = Mock()
+
+        self.assertFalse(comfy.wait_until_ready())
+        comfy.on_recovered.assert_not_called()
+
+        self.assertTrue(comfy.wait_until_ready())
+        comfy.on_recovered.assert_called_once()
+
+    def test_failures_degrade_and_kill_comfy(self):
+        comfy = self.make_readiness()
+        comfy.wait_until_ready()
+
+        comfy.record_failure(ConnectionError("refused"))
+        self.assertEqual(comfy.state, readiness.DEGRADED)
+        self.assertTrue(comfy.wait_until_ready())
+
+        comfy.record_failure(ConnectionError("refused"))
+        comfy.record_failure(ConnectionError("refused"))
+        self.assertEqual(comfy.state, readiness.DEAD)
+        self.assertEqual(comfy.last_error, "refused")
+
+    def test_success_recovers_comfy(self):
+        comfy = self.make_readiness()
+        comfy.wait_until_ready()
+        for _ in range(3):
+            comfy.record_failure()
+
+        comfy.record_success()
+
+        self.assertEqual(comfy.state, readiness.READY)
+        self.assertEqual(comfy.consecutive_failures, 0)
+
+    def test_dead_comfy_recovers_when_probe_succeeds(self):
+        comfy = self.make_readiness(boot_result=False, probe_result=True)
+        comfy.wait_until_ready()
+
+        self.assertTrue(comfy.wait_until_ready())
+        self.assertEqual(comfy.state, readiness.READY)
@@ -0,0 +1,122 @@
+import importlib.util
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+from botocore.exceptions import ClientError
+
+# Make sure that "src" is known and can be used to import result_cache.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import result_cache
+
+WORKFLOW = {
+    "3": {
+        "inputs": {"seed": 42, "steps": 20, "model": ["4", 0]},
+        "class_type": "KSampler",
+        "_meta": {"title": "KSampler"},
+    },
+    "10": {"inputs": {"image": "vase.png"}, "class_type": "LoadImage", "_meta": {"title": "Vase"}},
+}
+
+
+class TestCacheKey(unittest.TestCase):
+    def test_ignores_titles_key_order_and_image_names(self):
+        renamed = {
+            "10": {"class_type": "LoadImage", "inputs": {"image": "other.png"}},
+            "3": {"class_type": "KSampler", "inputs": {"model": ["4", 0], "steps": 20, "seed": 42}},
+        }
+
+        self.assertEqual(
+            result_cache.cache_key(WORKFLOW, {"vase.png": "a" * 64}),
+            result_cache.cache_key(renamed, {"other.png": "a" * 64}),
+        )
+
+    def test_depends_on_the_values_and_images(self):
+        key = result_cache.cache_key(WORKFLOW, {"vase.png": "a" * 64})
+        reseeded = {**WORKFLOW, "3": {**WORKFLOW["3"], "inputs": {**WORKFLOW["3"]["inputs"], "seed": 43}}}
+
+        self.assertNotEqual(key, result_cache.cache_key(WORKFLOW, {"vase.png": "b" * 64}))
+        self.assertNotEqual(key, result_cache.cache_key(reseeded, {"vase.png": "a" * 64}))
+
+    def test_draws_random_seed(self):
+        random_seed = {**WORKFLOW, "3": {**WORKFLOW["3"], "inputs": {"seed": -1}}}
+
+        self.assertFalse(result_cache.draws_random_seed(WORKFLOW))
+        self.assertTrue(result_cache.draws_random_seed(random_seed))
+        self.assertTrue(result_cache.draws_random_seed(WORKFLOW, {"KSampler"}))
+
+
+class TestResultCache(unittest.TestCase):
+    RESULT = {"message": "https://bucket/a.png", "images": []}
+
+    def test_local_index(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        cache = result_cache.ResultCache(result_cache.LocalCacheIndex(root), ttl=60)
+
+        self.assertIsNone(cache.get("ab" * 32))
+        cache.put("ab" * 32, self.RESULT)
+        self.assertEqual(cache.get("ab" * 32), self.RESULT)
+
+        with patch.object(result_cache.time, "time", return_value=result_cache.time.time() + 120):
+            self.assertIsNone(cache.get("ab" * 32))
+
+    def test_local_index_works_without_boto3(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        spec = importlib.util.spec_from_file_location("result_cache_without_boto3", result_cache.__file__)
+        module = importlib.util.module_from_spec(spec)
+
+        with patch.dict(sys.modules, {"botocore": None, "botocore.exceptions": None}):
+            spec.loader.exec_module(module)
+            cache = module.ResultCache(module.LocalCacheIndex(root), ttl=60)
+            cache.put("ab" * 32, self.RESULT)
+            self.assertEqual(cache.get("ab" * 32), self.RESULT)
+
+    def test_s3_index(self):
+        client = MagicMock()
+        cache = result_cache.ResultCache(
+            result_cache.S3CacheIndex(lambda: client, "bucket"), ttl=60
+        )
+        client.get_object.side_effect = ClientError(
+            {"Error": {"Code": "NoSuchKey", "Message": "Not Found"}}, "GetObject"
+        )
+
+        self.assertIsNone(cache.get("key"))
+        cache.put("key", self.RESULT)
+
+        call = client.put_object.call_args.kwargs
+        self.assertEqual(call["Bucket"], "bucket")
+        self.assertEqual(call["Key"], "result-cache/key")
+        client.get_object.side_effect = None
+        client.get_object.return_value = {"Body": MagicMock(read=MagicMock(return_value=call["Body"]))}
+        self.assertEqual(cache.get("key"), self.RESULT)
+
+    def test_s3_index_keeps_results_with_many_images(self):
+        client = MagicMock()
+        index = result_cache.S3CacheIndex(lambda: client, "bucket")
+        # Presigned URLs take about 500 bytes each, far more than fit into the metadata of an object
+        entry = {"result": {"images": [{"data": "https://bucket/a.png?" + "x" * 500}] * 8}}
+
+        index.write("key", entry)
+
+        body = client.put_object.call_args.kwargs["Body"]
+        client.get_object.return_value = {"Body": MagicMock(read=MagicMock(return_value=body))}
+        self.assertEqual(index.read("key"), entry)
+
+    def test_s3_index_reads_entries_from_the_metadata(self):
+        client = MagicMock()
+        index = result_cache.S3CacheIndex(lambda: client, "bucket")
+        client.get_object.return_value = {
+            "Body": MagicMock(read=MagicMock(return_value=b"")),
+            "Metadata": {"entry": '{"result": {"images": []}}'},
+        }
+
+        self.assertEqual(index.read("key"), {"result": {"images": []}})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,155 @@
+import unittest
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+# Make sure that "src" is known and can be used to import result_spool.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import result_spool
+
+SRC = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src"))
+
+# A worker that spools an image and goes away before it is uploaded
+WORKER_THAT_GOES_AWAY = """
+import sys
+sys.path.append(sys.argv[1])
+from result_spool import ResultSpool
+
+def failing_upload(*args):
+    raise OSError("worker went away")
+
+ResultSpool(sys.argv[2], failing_upload, retry_delay=3600).enqueue(sys.argv[3], "bucket", "a.png", "image/png")
+"""
+
+
+class TestResultSpool(unittest.TestCase):
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.folder)
+        self.root = os.path.join(self.folder, "spool")
+        self.uploaded = []
+
+    def make_image(self, name, content=b"image"):
+        image_location = os.path.join(self.folder, name)
+        with open(image_location, "wb") as image_file:
+            image_file.write(content)
+        return image_location
+
+    def upload(self, path, bucket, key, content_type):
+        with open(path, "rb") as image_file:
+            self.uploaded.append((bucket, key, content_type, image_file.read()))
+
+    def test_enqueue_uploads_and_empties_the_spool(self):
+        spool = result_spool.ResultSpool(self.root, self.upload)
+        image_location = self.make_image("ComfyUI_00001_.png")
+
+        spool.enqueue(image_location, "bucket", "123.png", "image/png")
+
+        self.assertFalse(os.path.exists(image_location))
+        self.assertTrue(spool.drain(5))
+        self.assertEqual(self.uploaded, [("bucket", "123.png", "image/png", b"image")])
+        self.assertEqual(os.listdir(self.root), [])
+        self.assertEqual(spool.stats()["depth"], 0)
+        self.assertEqual(spool.stats()["uploaded_total"], 1)
+
+    def test_failed_uploads_are_retried(self):
+        attempts = []
+
+        def flaky_upload(*args):
+            attempts.append(args)
+            if len(attempts) < 3:
+                raise OSError("connection reset")
+            self.upload(*args)
+
+        uploaded = threading.Event()
+        spool = result_spool.ResultSpool(self.root, flaky_upload, retry_delay=0.01)
+        spool.enqueue(self.make_image("a.png"), "bucket", "a.png", "image/png", uploaded.set)
+
+        self.assertTrue(spool.drain(5))
+        self.assertEqual(len(attempts), 3)
+        self.assertEqual(len(self.uploaded), 1)
+        self.assertTrue(uploaded.wait(5))
+
+    def test_images_are_moved_aside_after_max_attempts(self):
+        def failing_upload(*args):
+            raise OSError("access denied")
+
+        uploaded = threading.Event()
+        spool = result_spool.ResultSpool(
+            self.root, failing_upload, max_attempts=2, retry_delay=0.01
+        )
+        spool.enqueue(self.make_image("a.png"), "bucket", "a.png", "image/png", uploaded.set)
+
+        self.assertTrue(spool.drain(5))
+        self.assertEqual(spool.stats()["failed_total"], 1)
+        self.assertFalse(uploaded.is_set())
+        self.assertEqual(len(os.listdir(os.path.join(self.root, "failed"))), 2)
+
+    def test_start_replays_the_images_of_a_worker_that_went_away(self):
+        image_location = self.make_image("a.png", b"left behind")
+        subprocess.run(
+            [sys.executable, "-c", WORKER_THAT_GOES_AWAY, SRC, self.root, image_location], check=True
+        )
+
+        second = result_spool.ResultSpool(self.root, self.upload)
+        second.start()
+
+        self.assertTrue(second.drain(5))
+        self.assertEqual(self.uploaded, [("bucket", "a.png", "image/png", b"left behind")])
+        self.assertEqual(os.listdir(self.root), [])
+
+    def test_images_of_a_running_worker_are_left_to_it(self):
+        def failing_upload(*args):
+            raise OSError("connection reset")
+
+        first = result_spool.ResultSpool(self.root, failing_upload, retry_delay=3600)
+        first.enqueue(self.make_image("a.png"), "bucket", "a.png", "image/png")
+        self.assertFalse(first.drain(0.05))
+        self.assertEqual(first.stats()["depth"], 1)
+        self.assertGreater(first.stats()["bytes"], 0)
+
+        second = result_spool.ResultSpool(self.root, self.upload, rescan_interval=0.01)
+        second.start()
+        # No more rescans once the folder is gone
+        self.addCleanup(setattr, second, "rescan_interval", 3600)
+        # Long enough for a few rescans
+        time.sleep(0.05)
+
+        self.assertTrue(second.drain(0.1))
+        self.assertEqual(self.uploaded, [])
+        self.assertEqual(first.stats()["depth"], 1)
+
+    def test_broken_entries_are_skipped(self):
+        os.makedirs(self.root)
+        with open(os.path.join(self.root, "broken.json"), "w") as entry_file:
+            entry_file.write("{")
+        with open(os.path.join(self.root, "ok.json"), "w") as entry_file:
+            json.dump(
+                {
+                    "data": "ok.png",
+                    "bucket": "bucket",
+                    "key": "ok.png",
+                    "content_type": "image/png",
+                    "size": 2,
+                    "created_at": 0,
+                    "attempts": 0,
+                },
+                entry_file,
+            )
+        with open(os.path.join(self.root, "ok.png"), "wb") as image_file:
+            image_file.write(b"ok")
+
+        spool = result_spool.ResultSpool(self.root, self.upload)
+        spool.start()
+
+        self.assertTrue(spool.drain(5))
+        self.assertEqual(self.uploaded, [("bucket", "ok.png", "image/png", b"ok")])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,19 +1,163 @@
 import unittest
-from unittest.mock import patch, MagicMock, mock_open, Mock
+import asyncio
+from unittest.mock import ANY, patch, MagicMock, mock_open, Mock
 import sys
 import os
 import json
 import base64
+import hashlib
+import shutil
+import tempfile
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib3.exceptions import NewConnectionError
+import runpod
+from runpod.serverless import worker as runpod_worker
+from runpod.serverless.modules import rp_http, rp_job, rp_scale
 
 # Make sure that "src" is known and can be used to import rp_handler.py
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
 from src import rp_handler
+from input_store import InputStore
+from job_deadline import JobDeadline, JobTimeoutError
+from node_profiler import load_aggregate
+from readiness import STARTING
+from result_cache import LocalCacheIndex, ResultCache
+from variant_scheduler import VariantScheduler
 
 # Local folder for test resources
 RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES = "./test_resources/images"
 
 
+class FakeRunPodApi:
+    """
+    Stand-in for the job API of RunPod, which the job loop of the runpod SDK takes jobs
+    from and sends their results to, and which tells the status of the jobs
+
+    Args:
+        jobs (list): The jobs that are waiting, taken one per request
+    """
+
+    def __init__(self, jobs):
+        self.waiting = queue.Queue()
+        for job in jobs:
+            self.waiting.put(job)
+        self.taken = []
+        self.results = {}
+        self.streamed = []
+        self.cancelled = set()
+        api = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def log_message(self, *args):
+                pass
+
+            def reply(self, status, body=None):
+                data = json.dumps(body).encode() if body is not None else b""
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_GET(self):
+                if "/status/" in self.path:
+                    job_id = self.path.rsplit("/", 1)[1]
+                    status = "CANCELLED" if job_id in api.cancelled else "IN_PROGRESS"
+                    return self.reply(200, {"id": job_id, "status": status})
+                # Like RunPod, the request waits for a job for a while
+                try:
+                    job = api.waiting.get(timeout=0.2)
+                except queue.Empty:
+                    return self.reply(204)
+                api.taken.append(job["id"])
+                self.reply(200, job)
+
+            def do_POST(self):
+                data = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                kind, job_id = self.path.split("?")[0].strip("/").split("/")
+                if kind == "done":
+                    api.results[job_id] = data
+                else:
+                    api.streamed.append((job_id, data))
+                self.reply(200)
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_port}"
+
+    def run_worker(self, config, scenario, timeout=20):
+        """
+        Run the job loop of the runpod SDK against this API until the scenario is done
+
+        Args:
+            config (dict): The config of runpod.serverless.start, the SDK uses this very dict
+            scenario (coroutine function): Called with this API on the loop of the worker
+
+        Returns:
+            The result of the scenario
+        """
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        loop = asyncio.new_event_loop()
+        outcome = {}
+
+        async def run_scenario():
+            # Cancelled when the worker stops the loop on its own
+            try:
+                outcome["result"] = await asyncio.wait_for(scenario(self), timeout)
+            except Exception as e:
+                outcome["error"] = e
+            loop.stop()
+
+        try:
+            with patch.object(rp_job, "JOB_GET_URL", f"{self.url}/take?worker=test"), patch.object(
+                rp_http, "JOB_DONE_URL", f"{self.url}/done/$ID?worker=test"
+            ), patch.object(rp_http, "JOB_STREAM_URL", f"{self.url}/stream/$ID?worker=test"), patch.object(
+                runpod, "endpoint_url_base", self.url
+            ):
+                config.setdefault("rp_args", {})
+                loop.create_task(runpod_worker.run_worker(config))
+                loop.create_task(run_scenario())
+                loop.run_forever()
+        finally:
+            tasks = asyncio.all_tasks(loop)
+            for task in tasks:
+                task.cancel()
+            loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+            loop.close()
+            self.server.shutdown()
+            self.server.server_close()
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome.get("result")
+
+
+async def wait_until(condition, interval=0.05):
+    while not condition():
+        await asyncio.sleep(interval)
+
+
 class TestRunpodWorkerComfy(unittest.TestCase):
+    def setUp(self):
+        # Every test starts with an empty input store and a ComfyUI without inputs
+        self.input_store_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.input_store_path)
+        patcher = patch.object(
+            rp_handler, "input_store", InputStore(self.input_store_path, 1024 * 1024)
+        )
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        rp_handler.staged_inputs.clear()
+        # There is no ComfyUI to fetch the node definitions from
+        patcher = patch.object(rp_handler, "validate_workflow", return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(rp_handler, "variant_scheduler", VariantScheduler())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
     def test_valid_input_with_workflow_only(self):
         input_data = {"workflow": {"key": "value"}}
         validated_data, error = rp_handler.validate_input(input_data)
@@ -43,9 +187,73 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         validated_data, error = rp_handler.validate_input(input_data)
         self.assertIsNotNone(error)
         self.assertEqual(
-            error, "'images' must be a list of objects with 'name' and 'image' keys"
+            error,
+            "'images' must be a list of objects with 'name' and either 'image' or 'sha256' keys",
         )
 
+    def test_valid_input_with_image_hashes(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "sha256": "a" * 64}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertIsNone(error)
+        self.assertEqual(validated_data, input_data)
+
+    def test_input_with_invalid_image_hash(self):
+        input_data = {
+            "workflow": {"key": "value"},
+            "images": [{"name": "image1.png", "sha256": "not a hash"}],
+        }
+        validated_data, error = rp_handler.validate_input(input_data)
+        self.assertEqual(
+            error, "'sha256' must be a lowercase hex encoded SHA-256 digest"
+        )
+
+    def test_valid_input_with_template(self):
+        templates = MagicMock()
+        templates.expand.return_value = {"552": {"inputs": {"value": 2}}}
+        input_data = {"template": "jasper-color@2", "params": {"552": {"value": 2}}}
+
+        with patch.object(rp_handler, "workflow_templates", templates):
+            validated_data, error = rp_handler.validate_input(input_data)
+
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["workflow"], {"552": {"inputs": {"value": 2}}})
+        templates.expand.assert_called_once_with("jasper-color@2", {"552": {"value": 2}})
+
+    def test_params_are_bound_to_the_workflow(self):
+        input_data = {
+            "workflow": {"552": {"inputs": {"value": 3}, "_meta": {"title": "WhatVase?"}}},
+            "params": {"WhatVase?": "2"},
+        }
+
+        validated_data, error = rp_handler.validate_input(input_data)
+
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["workflow"]["552"]["inputs"]["value"], 2)
+        self.assertEqual(input_data["workflow"]["552"]["inputs"]["value"], 3)
+
+        validated_data, error = rp_handler.validate_input({**input_data, "params": {"Seed": 1}})
+        self.assertEqual(error, "The workflow has no binding 'Seed'")
+
+    def test_input_with_unknown_template(self):
+        with patch.object(
+            rp_handler, "workflow_templates", rp_handler.WorkflowTemplates([])
+        ):
+            validated_data, error = rp_handler.validate_input({"template": "missing"})
+
+        self.assertEqual(error, "Unknown template 'missing'")
+
+    def test_input_with_timeout(self):
+        validated_data, error = rp_handler.validate_input({"workflow": {}, "timeout_s": 600})
+        self.assertIsNone(error)
+        self.assertEqual(validated_data["timeout_s"], 600)
+
+        for timeout in (0, "600", True):
+            _, error = rp_handler.validate_input({"workflow": {}, "timeout_s": timeout})
+            self.assertEqual(error, "'timeout_s' must be a positive number of seconds")
+
     def test_invalid_json_string_input(self):
         input_data = "invalid json"
         validated_data, error = rp_handler.validate_input(input_data)
@@ -64,55 +272,148 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIsNotNone(error)
         self.assertEqual(error, "Please provide input")
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_up(self, mock_requests):
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_check_server_server_up(self, mock_request):
         mock_response = MagicMock()
-        mock_response.status_code = 200
-        mock_requests.return_value = mock_response
+        mock_response.status = 200
+        mock_request.return_value = mock_response
 
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertTrue(result)
 
-    @patch("rp_handler.requests.get")
-    def test_check_server_server_down(self, mock_requests):
-        mock_requests.get.side_effect = rp_handler.requests.RequestException()
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_check_server_server_down(self, mock_request):
+        mock_request.side_effect = NewConnectionError(None, "refused")
         result = rp_handler.check_server("http://127.0.0.1:8188", 1, 50)
         self.assertFalse(result)
+        # check_server does its own retrying
+        mock_request.assert_called_once()
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_queue_prompt(self, mock_urlopen):
-        mock_response = MagicMock()
-        mock_response.read.return_value = json.dumps({"prompt_id": "123"}).encode()
-        mock_urlopen.return_value = mock_response
+    @patch.object(rp_handler, "COMFY_BOOT_TIMEOUT_S", 10)
+    @patch.object(rp_handler, "COMFY_API_AVAILABLE_INTERVAL_MS", 0)
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_a_slow_boot_keeps_comfy_starting_until_the_boot_timeout(self, mock_request):
+        readiness = rp_handler.ComfyReadiness(rp_handler.wait_for_comfy_boot, Mock(return_value=False))
+        states = []
+
+        def request(*args, **kwargs):
+            states.append(readiness.state)
+            # Loading the custom nodes takes more attempts than the boot probe used to make
+            if len(states) <= 600:
+                raise NewConnectionError(None, "refused")
+            return MagicMock(status=200)
+
+        mock_request.side_effect = request
+
+        with patch.object(rp_handler, "cold_start_timeline", rp_handler.ColdStartTimeline()):
+            self.assertTrue(readiness.wait_until_ready())
+
+        self.assertEqual(set(states), {STARTING})
+        self.assertEqual(readiness.state, rp_handler.READY)
+
+    @patch.object(rp_handler, "COMFY_BOOT_TIMEOUT_S", 0.2)
+    @patch.object(rp_handler, "COMFY_API_AVAILABLE_INTERVAL_MS", 10)
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_comfy_is_dead_once_the_boot_timeout_passed(self, mock_request):
+        mock_request.side_effect = NewConnectionError(None, "refused")
+        readiness = rp_handler.ComfyReadiness(rp_handler.wait_for_comfy_boot, Mock(return_value=False))
+
+        with patch.object(rp_handler, "cold_start_timeline", rp_handler.ColdStartTimeline()):
+            started = time.monotonic()
+            self.assertFalse(readiness.wait_until_ready())
+
+        self.assertGreaterEqual(time.monotonic() - started, 0.2)
+        self.assertEqual(readiness.state, rp_handler.DEAD)
+
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_queue_prompt(self, mock_request):
+        mock_response = MagicMock(status=200)
+        mock_response.data = json.dumps({"prompt_id": "123"}).encode()
+        mock_request.return_value = mock_response
         result = rp_handler.queue_workflow({"prompt": "test"})
         self.assertEqual(result, {"prompt_id": "123"})
 
-    @patch("rp_handler.urllib.request.urlopen")
-    def test_get_history(self, mock_urlopen):
-        # Mock response data as a JSON string
-        mock_response_data = json.dumps({"key": "value"}).encode("utf-8")
-
-        # Define a mock response function for `read`
-        def mock_read():
-            return mock_response_data
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_queue_prompt_with_client_id(self, mock_request):
+        mock_response = MagicMock(status=200)
+        mock_response.data = json.dumps({"prompt_id": "123"}).encode()
+        mock_request.return_value = mock_response
+        rp_handler.queue_workflow({"prompt": "test"}, "client-1")
+        payload = json.loads(mock_request.call_args.kwargs["body"])
+        self.assertEqual(payload["client_id"], "client-1")
 
-        # Create a mock response object
-        mock_response = Mock()
-        mock_response.read = mock_read
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_queue_prompt_is_not_retried(self, mock_request):
+        mock_request.side_effect = NewConnectionError(None, "refused")
+        with self.assertRaises(rp_handler.ComfyHttpError):
+            rp_handler.queue_workflow({"prompt": "test"})
+        mock_request.assert_called_once()
 
-        # Mock the __enter__ and __exit__ methods to support the context manager
-        mock_response.__enter__ = lambda s: s
-        mock_response.__exit__ = Mock()
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_queue_prompt_with_invalid_workflow(self, mock_request):
+        mock_response = MagicMock(status=400)
+        mock_response.data = b'{"error": "invalid prompt"}'
+        mock_request.return_value = mock_response
+        with self.assertRaises(rp_handler.ComfyHttpError) as context:
+            rp_handler.queue_workflow({"prompt": "test"})
+        self.assertIn("invalid prompt", str(context.exception))
 
-        # Set the return value of the urlopen mock
-        mock_urlopen.return_value = mock_response
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_get_history(self, mock_request):
+        mock_response = MagicMock(status=200)
+        mock_response.data = json.dumps({"key": "value"}).encode("utf-8")
+        mock_request.return_value = mock_response
 
         # Call the function under test
         result = rp_handler.get_history("123")
 
         # Assertions
         self.assertEqual(result, {"key": "value"})
-        mock_urlopen.assert_called_with("http://127.0.0.1:8188/history/123")
+        self.assertEqual(mock_request.call_args.args, ("GET", "http://127.0.0.1:8188/history/123"))
+
+    @patch.object(rp_handler.comfy_http_client, "post_json")
+    @patch.object(rp_handler.comfy_http_client, "get_json")
+    def test_cancel_prompts(self, mock_get_json, mock_post_json):
+        mock_get_json.return_value = {
+            "queue_running": [[3, "running", {}, {}, []]],
+            "queue_pending": [[4, "waiting", {}, {}, []], [5, "other", {}, {}, []]],
+        }
+
+        rp_handler.cancel_prompts(["waiting", "running"])
+
+        mock_post_json.assert_any_call("http://127.0.0.1:8188/queue", {"delete": ["waiting"]})
+        mock_post_json.assert_any_call("http://127.0.0.1:8188/interrupt", {"prompt_id": "running"})
+        self.assertEqual(mock_post_json.call_count, 2)
+
+    @patch.object(rp_handler, "cancel_prompts")
+    @patch.object(rp_handler, "get_history")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler, "COMFY_POLLING_INTERVAL_MS", 10)
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_cancels_the_prompt_after_the_timeout(
+        self, mock_wait_until_ready, mock_queue, mock_get_history, mock_cancel
+    ):
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_get_history.return_value = {}
+
+        result = rp_handler.handler({"id": "job", "input": {"workflow": {}, "timeout_s": 0.05}})
+
+        self.assertEqual(result["error"], "The job timed out after 0.05s")
+        mock_cancel.assert_called_once_with(["123"])
+
+    @patch("comfy_http.time.sleep")
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_get_history_is_retried(self, mock_request, mock_sleep):
+        mock_response = MagicMock(status=200)
+        mock_response.data = json.dumps({"key": "value"}).encode("utf-8")
+        mock_request.side_effect = [NewConnectionError(None, "refused"), mock_response]
+
+        result = rp_handler.get_history("123")
+
+        self.assertEqual(result, {"key": "value"})
+        self.assertEqual(mock_request.call_count, 2)
+        mock_sleep.assert_called_once()
 
     @patch("builtins.open", new_callable=mock_open, read_data=b"test")
     def test_base64_encode(self, mock_file):
@@ -123,7 +424,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(result, test_data)
 
     @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
+    @patch.object(rp_handler, "upload_image")
     @patch.dict(
         os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
     )
@@ -141,7 +442,7 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(result["status"], "success")
 
     @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
+    @patch.object(rp_handler, "upload_image")
     @patch.dict(
         os.environ,
         {
@@ -167,11 +468,16 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(result["status"], "success")
         self.assertEqual(result["message"], "http://example.com/uploaded/image.png")
         mock_upload_image.assert_called_once_with(
-            job_id, "./test_resources/images/test/ComfyUI_00001_.png"
+            job_id,
+            "./test_resources/images/test/ComfyUI_00001_.png",
+            result_index=0,
+            filename_info=None,
+            timings=ANY,
+            on_uploaded=None,
         )
 
     @patch("rp_handler.os.path.exists")
-    @patch("rp_handler.rp_upload.upload_image")
+    @patch.object(rp_handler, "upload_image")
     @patch.dict(
         os.environ,
         {
@@ -201,11 +507,152 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertIn("simulated_uploaded", result["message"])
         self.assertEqual(result["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler, "upload_image")
+    @patch.dict(
+        os.environ,
+        {
+            "COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES,
+            "BUCKET_ENDPOINT_URL": "http://example.com",
+        },
+    )
+    def test_process_output_images_returns_every_image(self, mock_upload_image):
+        mock_upload_image.side_effect = lambda job_id, path, result_index, filename_info, timings, on_uploaded: (
+            f"http://example.com/{result_index}.png"
+        )
+        outputs = {
+            "9": {
+                "images": [
+                    {"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"},
+                    {"filename": "ComfyUI_00001_.png", "subfolder": "test", "type": "output"},
+                ]
+            },
+            "12": {"images": [{"filename": "preview.png", "subfolder": "", "type": "temp"}]},
+            "15": {"text": ["not an image"]},
+            "20": {"images": [{"filename": "ComfyUI_00001_.png", "subfolder": "", "type": "output"}]},
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "success")
+        self.assertEqual(result["message"], "http://example.com/0.png")
+        self.assertEqual(
+            result["images"],
+            [
+                {"node_id": "9", "filename": "ComfyUI_00001_.png", "type": "s3_url", "data": "http://example.com/0.png"},
+                {"node_id": "9", "filename": "ComfyUI_00001_.png", "type": "s3_url", "data": "http://example.com/1.png"},
+                {"node_id": "20", "filename": "ComfyUI_00001_.png", "type": "s3_url", "data": "http://example.com/2.png"},
+            ],
+        )
+
+    @patch.dict(
+        os.environ, {"COMFY_OUTPUT_PATH": RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}
+    )
+    def test_process_output_images_reports_missing_images(self):
+        outputs = {
+            "9": {
+                "images": [
+                    {"filename": "ComfyUI_00001_.png", "subfolder": ""},
+                    {"filename": "missing.png", "subfolder": ""},
+                ]
+            }
+        }
+
+        result = rp_handler.process_output_images(outputs, "123")
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["images"][0]["type"], "base64")
+        self.assertIn("missing.png", result["images"][1]["error"])
+
+    def test_process_output_images_without_images(self):
+        result = rp_handler.process_output_images({"9": {"text": ["hello"]}}, "123")
+
+        self.assertEqual(result["status"], "error")
+        self.assertEqual(result["images"], [])
+
+    @patch.object(rp_handler, "get_boto_client")
+    def test_upload_image_streams_file_to_s3(self, mock_get_boto_client):
+        mock_client = MagicMock()
+        mock_client.generate_presigned_url.return_value = "http://example.com/123.png"
+        transfer_config = object()
+        mock_get_boto_client.return_value = (mock_client, transfer_config)
+        image_location = os.path.join(
+            RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+        )
+
+        result = rp_handler.upload_image("sync-123", image_location, bucket_name="bucket")
+
+        self.assertEqual(result, "http://example.com/123.png")
+        mock_client.upload_file.assert_called_once_with(
+            image_location,
+            "bucket",
+            "123.png",
+            ExtraArgs={"ContentType": "image/png"},
+            Config=transfer_config,
+        )
+        mock_client.put_object.assert_not_called()
+
+    @patch.object(rp_handler, "get_boto_client")
+    def test_upload_image_write_behind_spools_the_image(self, mock_get_boto_client):
+        mock_client = MagicMock()
+        mock_client.generate_presigned_url.return_value = "http://example.com/123.png"
+        mock_get_boto_client.return_value = (mock_client, object())
+        spool = MagicMock()
+        image_location = os.path.join(
+            RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+        )
+
+        with patch.object(rp_handler, "result_spool", spool):
+            result = rp_handler.upload_image("sync-123", image_location, bucket_name="bucket")
+
+        self.assertEqual(result, "http://example.com/123.png")
+        spool.enqueue.assert_called_once_with(image_location, "bucket", "123.png", "image/png", None)
+        mock_client.upload_file.assert_not_called()
+
+    @patch.object(rp_handler, "get_boto_client")
+    def test_upload_image_without_bucket_copies_the_image(self, mock_get_boto_client):
+        mock_get_boto_client.return_value = (None, None)
+        image_location = os.path.join(
+            RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES, "ComfyUI_00001_.png"
+        )
+        working_directory = os.getcwd()
+        with tempfile.TemporaryDirectory() as folder:
+            os.chdir(folder)
+            try:
+                result = rp_handler.upload_image(
+                    "123", os.path.join(working_directory, image_location), result_index=1
+                )
+                self.assertEqual(result, os.path.join("simulated_uploaded", "123_1.png"))
+                self.assertTrue(os.path.exists(result))
+            finally:
+                os.chdir(working_directory)
+
+    @patch.object(rp_handler, "_boto_client", None)
+    @patch.dict(
+        os.environ,
+        {
+            "BUCKET_ENDPOINT_URL": "https://bucket.s3.eu-west-1.amazonaws.com",
+            "BUCKET_ACCESS_KEY_ID": "key",
+            "BUCKET_SECRET_ACCESS_KEY": "secret",
+        },
+    )
+    def test_get_boto_client_is_created_once(self):
+        boto_client, transfer_config = rp_handler.get_boto_client()
+
+        self.assertIs(rp_handler.get_boto_client()[0], boto_client)
+        self.assertEqual(
+            boto_client.meta.config.max_pool_connections,
+            rp_handler.BUCKET_MAX_POOL_CONNECTIONS,
+        )
+        self.assertEqual(
+            transfer_config.multipart_chunksize,
+            rp_handler.BUCKET_MULTIPART_CHUNKSIZE_MB * 1024 * 1024,
+        )
+
+    @patch.object(rp_handler.comfy_http_client, "post")
     def test_upload_images_successful(self, mock_post):
         mock_response = unittest.mock.Mock()
-        mock_response.status_code = 200
-        mock_response.text = "Successfully uploaded"
+        mock_response.status = 200
+        mock_response.data = b"Successfully uploaded"
         mock_post.return_value = mock_response
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
@@ -217,11 +664,11 @@ class TestRunpodWorkerComfy(unittest.TestCase):
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "success")
 
-    @patch("rp_handler.requests.post")
+    @patch.object(rp_handler.comfy_http_client, "post")
     def test_upload_images_failed(self, mock_post):
         mock_response = unittest.mock.Mock()
-        mock_response.status_code = 400
-        mock_response.text = "Error uploading"
+        mock_response.status = 400
+        mock_response.data = b"Error uploading"
         mock_post.return_value = mock_response
 
         test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
@@ -232,3 +679,1049 @@ class TestRunpodWorkerComfy(unittest.TestCase):
 
         self.assertEqual(len(responses), 3)
         self.assertEqual(responses["status"], "error")
+
+    @patch.object(rp_handler, "COMFY_UPLOAD_CONCURRENCY", 4)
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_concurrently_aggregates_errors(self, mock_post):
+        def post(url, fields, idempotent):
+            name = fields["image"][0]
+            status = 500 if name == "broken.png" else 200
+            return Mock(status=status, data=b"Internal error")
+
+        mock_post.side_effect = post
+        test_image_data = base64.b64encode(b"Test Image Data").decode("utf-8")
+        images = [
+            {"name": f"image_{i}.png", "image": test_image_data} for i in range(5)
+        ] + [
+            {"name": "broken.png", "image": test_image_data},
+            {"name": "not_base64.png", "image": "not base64!"},
+        ]
+
+        responses = rp_handler.upload_images(images)
+
+        self.assertEqual(responses["status"], "error")
+        self.assertEqual(mock_post.call_count, 6)
+        self.assertEqual(len(responses["details"]), 2)
+        self.assertEqual(
+            responses["details"][0], "Error uploading broken.png: Internal error"
+        )
+        self.assertTrue(responses["details"][1].startswith("Error decoding not_base64.png"))
+
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_to_input_folder(self, mock_post):
+        with tempfile.TemporaryDirectory() as input_path:
+            with patch.multiple(
+                rp_handler, COMFY_INPUT_STAGING="auto", COMFY_INPUT_PATH=input_path
+            ):
+                images = [
+                    {"name": "test_image.png", "image": base64.b64encode(b"one").decode()},
+                    {"name": "sub/other.png", "image": base64.b64encode(b"two").decode()},
+                ]
+
+                responses = rp_handler.upload_images(images)
+
+            self.assertEqual(responses["status"], "success")
+            with open(os.path.join(input_path, "test_image.png"), "rb") as image_file:
+                self.assertEqual(image_file.read(), b"one")
+            with open(os.path.join(input_path, "sub", "other.png"), "rb") as image_file:
+                self.assertEqual(image_file.read(), b"two")
+            # No temporary files are left behind
+            self.assertEqual(sorted(os.listdir(input_path)), ["sub", "test_image.png"])
+        mock_post.assert_not_called()
+
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_to_input_folder_rejects_paths_outside(self, mock_post):
+        with tempfile.TemporaryDirectory() as input_path:
+            with patch.multiple(
+                rp_handler, COMFY_INPUT_STAGING="filesystem", COMFY_INPUT_PATH=input_path
+            ):
+                images = [{"name": "../escape.png", "image": base64.b64encode(b"x").decode()}]
+
+                responses = rp_handler.upload_images(images)
+
+        self.assertEqual(responses["status"], "error")
+        mock_post.assert_not_called()
+
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_falls_back_to_http_when_writing_fails(self, mock_post):
+        mock_post.return_value = Mock(status=200, data=b"")
+        with patch.multiple(
+            rp_handler,
+            COMFY_INPUT_STAGING="filesystem",
+            COMFY_INPUT_PATH="/dev/null/input",
+        ):
+            images = [{"name": "test_image.png", "image": base64.b64encode(b"x").decode()}]
+
+            responses = rp_handler.upload_images(images)
+
+        self.assertEqual(responses["status"], "success")
+        mock_post.assert_called_once()
+
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_by_hash(self, mock_post):
+        mock_post.return_value = Mock(status=200, data=b"")
+        sha256 = hashlib.sha256(b"Test Image Data").hexdigest()
+        first_job = [
+            {
+                "name": "test_image.png",
+                "image": base64.b64encode(b"Test Image Data").decode("utf-8"),
+            }
+        ]
+        second_job = [{"name": "other_name.png", "sha256": sha256}]
+
+        self.assertEqual(rp_handler.upload_images(first_job)["status"], "success")
+        self.assertEqual(rp_handler.find_missing_inputs(second_job), [])
+        self.assertEqual(rp_handler.upload_images(second_job)["status"], "success")
+
+        self.assertEqual(mock_post.call_count, 2)
+        self.assertEqual(
+            mock_post.call_args.kwargs["fields"]["image"],
+            ("other_name.png", b"Test Image Data", "image/png"),
+        )
+
+    @patch.object(rp_handler.comfy_http_client, "request")
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_skips_images_comfy_already_has(self, mock_post, mock_request):
+        mock_post.return_value = Mock(status=200, data=b"")
+        mock_request.return_value = Mock(status=200, data=b"")
+        images = [
+            {
+                "name": "test_image.png",
+                "image": base64.b64encode(b"Test Image Data").decode("utf-8"),
+            }
+        ]
+
+        rp_handler.upload_images(images)
+        rp_handler.upload_images(images)
+
+        mock_post.assert_called_once()
+        mock_request.assert_called_once_with(
+            "HEAD", "http://127.0.0.1:8188/view?filename=test_image.png&subfolder=&type=input"
+        )
+
+    @patch.object(rp_handler.comfy_http_client, "request")
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_uploads_images_comfy_lost_again(self, mock_post, mock_request):
+        mock_post.return_value = Mock(status=200, data=b"")
+        # ComfyUI restarted with an empty input folder
+        mock_request.return_value = Mock(status=404, data=b"")
+        images = [
+            {
+                "name": "test_image.png",
+                "image": base64.b64encode(b"Test Image Data").decode("utf-8"),
+            }
+        ]
+
+        rp_handler.upload_images(images)
+        rp_handler.upload_images(images)
+
+        self.assertEqual(mock_post.call_count, 2)
+
+    def test_staged_images_are_forgotten_when_comfy_comes_back(self):
+        rp_handler.staged_inputs["test_image.png"] = "ab" * 32
+
+        with patch.object(rp_handler.comfy_readiness, "state", rp_handler.DEAD):
+            rp_handler.comfy_readiness.record_success()
+
+        self.assertEqual(rp_handler.staged_inputs, {})
+
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_upload_images_with_wrong_hash(self, mock_post):
+        images = [
+            {
+                "name": "test_image.png",
+                "image": base64.b64encode(b"Test Image Data").decode("utf-8"),
+                "sha256": "a" * 64,
+            }
+        ]
+
+        responses = rp_handler.upload_images(images)
+
+        self.assertEqual(responses["status"], "error")
+        mock_post.assert_not_called()
+
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    @patch.object(rp_handler.comfy_http_client, "post")
+    def test_concurrent_jobs_stage_images_with_the_same_name_apart(self, mock_post):
+        workflow = {"10": {"inputs": {"image": "input.png", "upload": "image"}, "class_type": "LoadImage"}}
+        jobs = [
+            [{"name": "input.png", "image": base64.b64encode(content).decode()}] for content in (b"one", b"two")
+        ]
+        with tempfile.TemporaryDirectory() as input_path:
+            with patch.multiple(rp_handler, COMFY_INPUT_STAGING="filesystem", COMFY_INPUT_PATH=input_path):
+                for images in jobs:
+                    self.assertEqual(rp_handler.upload_images(images)["status"], "success")
+
+            for images, content in zip(jobs, (b"one", b"two")):
+                name = rp_handler.use_staged_image_names(workflow, images)["10"]["inputs"]["image"]
+                self.assertEqual(name, f"{hashlib.sha256(content).hexdigest()[:16]}-input.png")
+                with open(os.path.join(input_path, name), "rb") as image_file:
+                    self.assertEqual(image_file.read(), content)
+        self.assertEqual(workflow["10"]["inputs"]["image"], "input.png")
+        mock_post.assert_not_called()
+
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    def test_only_the_image_of_image_loaders_is_renamed(self):
+        workflow = {
+            "6": {"inputs": {"text": "input.png"}, "class_type": "CLIPTextEncode"},
+            "9": {"inputs": {"filename_prefix": "input.png", "images": ["8", 0]}, "class_type": "SaveImage"},
+            "10": {"inputs": {"image": "input.png", "upload": "image"}, "class_type": "LoadImage"},
+        }
+        images = [{"name": "input.png", "image": base64.b64encode(b"one").decode()}]
+
+        renamed = rp_handler.use_staged_image_names(workflow, images)
+
+        self.assertEqual(renamed["10"]["inputs"]["image"], f"{hashlib.sha256(b'one').hexdigest()[:16]}-input.png")
+        self.assertEqual(renamed["6"], workflow["6"])
+        self.assertEqual(renamed["9"], workflow["9"])
+
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_reports_missing_inputs(self, mock_wait_until_ready, mock_queue):
+        job_input = {
+            "workflow": {},
+            "images": [{"name": "image1.png", "sha256": "b" * 64}],
+        }
+
+        result = rp_handler.handler({"id": "job", "input": job_input})
+
+        self.assertIn("error", result)
+        self.assertEqual(
+            result["missing_inputs"], [{"name": "image1.png", "sha256": "b" * 64}]
+        )
+        mock_queue.assert_not_called()
+
+
+    def test_input_with_variants(self):
+        workflow = {"552": {"inputs": {"value": 3}, "_meta": {"title": "WhatVase?"}}}
+        input_data = {
+            "workflow": workflow,
+            "params": {"WhatVase?": 2},
+            "variants": [{}, {"WhatVase?": 4}, {"Seed": 1}],
+        }
+
+        validated_data, error = rp_handler.validate_input(input_data)
+
+        self.assertIsNone(error)
+        variants = validated_data["variants"]
+        self.assertEqual(variants[0]["workflow"]["552"]["inputs"]["value"], 2)
+        self.assertEqual(variants[1]["workflow"]["552"]["inputs"]["value"], 4)
+        self.assertEqual(variants[1]["input"]["params"], {"WhatVase?": 4})
+        self.assertEqual(variants[2], {"error": "The workflow has no binding 'Seed'"})
+
+        with patch.object(rp_handler, "COMFY_MAX_BATCH_SIZE", 2):
+            _, error = rp_handler.validate_input(input_data)
+        self.assertEqual(error, "At most 2 variants are allowed per job, got 3")
+        _, error = rp_handler.validate_input({"workflow": workflow, "variants": []})
+        self.assertEqual(error, "'variants' must be a non-empty list of objects")
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_queues_all_variants_before_waiting(
+        self, mock_wait_until_ready, mock_queue, mock_polling, mock_process
+    ):
+        workflow = {"552": {"inputs": {"value": 3}, "_meta": {"title": "WhatVase?"}}}
+        calls = []
+        mock_queue.side_effect = lambda workflow, client_id: calls.append(
+            ("queue", workflow["552"]["inputs"]["value"])
+        ) or {"prompt_id": f"p{len(calls)}"}
+        mock_polling.side_effect = lambda prompt_id, deadline, timings: calls.append(("wait", prompt_id)) or {
+            prompt_id: {"outputs": {}}
+        }
+        mock_process.side_effect = [
+            {"status": "success", "message": "a.png", "images": []},
+            {"status": "error", "message": "the workflow did not produce any images", "images": []},
+        ]
+        updates = []
+
+        result = rp_handler.handler(
+            {
+                "id": "job",
+                "input": {"workflow": workflow, "variants": [{"WhatVase?": 1}, {"Seed": 1}, {"WhatVase?": 2}]},
+            },
+            on_progress=updates.append,
+        )
+
+        self.assertEqual(calls, [("queue", 1), ("queue", 2), ("wait", "p1"), ("wait", "p2")])
+        self.assertEqual(result["status"], "partial")
+        self.assertEqual([variant["status"] for variant in result["variants"]], ["success", "error", "error"])
+        self.assertEqual(result["variants"][1]["error"], "The workflow has no binding 'Seed'")
+        self.assertEqual(set(result["variants"][0]["timings"]), {"queued_s", "render_s", "elapsed_s"})
+        self.assertEqual([update["variant"]["index"] for update in updates], [1, 0, 2])
+        self.assertEqual(mock_process.call_args_list[1].args[1], "job_2")
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_orders_variants_by_shared_nodes(
+        self, mock_wait_until_ready, mock_queue, mock_polling, mock_process
+    ):
+        workflow = {
+            "1": {"inputs": {"value": "Rabbit"}, "class_type": "Badman_String", "_meta": {"title": "Token"}},
+            "2": {"inputs": {"text": ["1", 0]}, "class_type": "CLIPTextEncode"},
+            "3": {"inputs": {"value": 1}, "class_type": "INTConstant", "_meta": {"title": "Vase"}},
+            "4": {"inputs": {"positive": ["2", 0], "vase": ["3", 0]}, "class_type": "KSampler"},
+        }
+        queued = []
+        mock_queue.side_effect = lambda workflow, client_id: queued.append(workflow) or {
+            "prompt_id": str(len(queued))
+        }
+        # ComfyUI reports the text encoder of the second prompt as cached
+        mock_polling.side_effect = lambda prompt_id, deadline, timings: {
+            prompt_id: {
+                "outputs": {},
+                "status": {"messages": [["execution_cached", {"nodes": ["1", "2"] if prompt_id == "2" else []}]]},
+            }
+        }
+        mock_process.return_value = {"status": "success", "message": "a.png", "images": []}
+        variants = [
+            {"Token": "Rabbit", "Vase": 1},
+            {"Token": "Fox", "Vase": 1},
+            {"Token": "Rabbit", "Vase": 2},
+        ]
+
+        result = rp_handler.handler({"id": "job", "input": {"workflow": workflow, "variants": variants}})
+
+        self.assertEqual(
+            [(w["1"]["inputs"]["value"], w["3"]["inputs"]["value"]) for w in queued],
+            [("Rabbit", 1), ("Rabbit", 2), ("Fox", 1)],
+        )
+        self.assertEqual(result["variants"][2]["cache"]["expected"], 0.5)
+        self.assertEqual(result["variants"][2]["cache"]["observed"], 0.5)
+        self.assertEqual(result["cache_hit_ratio"]["expected"], round(0.5 / 3, 3))
+
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_fails_when_all_variants_fail(self, mock_wait_until_ready, mock_queue):
+        mock_queue.side_effect = Exception("ComfyUI is gone")
+
+        result = rp_handler.handler(
+            {"id": "job", "input": {"workflow": {"1": {"inputs": {"value": 1}}}, "variants": [{}, {}]}}
+        )
+
+        self.assertEqual(
+            result["error"], "All 2 variants failed, the first with: Error queuing workflow: ComfyUI is gone"
+        )
+        self.assertEqual(len(result["variants"]), 2)
+
+    @patch.object(rp_handler, "wait_for_prompt")
+    @patch.object(rp_handler, "subscribe_to_events")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "websocket")
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_a_failed_subscription_fails_only_its_variant(
+        self, mock_wait_until_ready, mock_queue, mock_subscribe, mock_wait_for_prompt
+    ):
+        subscription = Mock()
+        mock_subscribe.side_effect = [("client", subscription), Exception("ComfyUI is gone")]
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_wait_for_prompt.return_value = (None, "Prompt failed")
+
+        result = rp_handler.handler(
+            {"id": "job", "input": {"workflow": {"1": {"inputs": {"value": 1}}}, "variants": [{}, {}]}}
+        )
+
+        self.assertEqual(
+            result["variants"][1]["error"], "Error queuing workflow: ComfyUI is gone"
+        )
+        # The subscription of the first variant is still open when it is waited for
+        mock_wait_for_prompt.assert_called_once()
+        self.assertIs(mock_wait_for_prompt.call_args.args[0], subscription)
+        subscription.close.assert_called_once()
+
+
+class TestWaitForHistoryWebsocket(unittest.TestCase):
+    HISTORY = {"123": {"outputs": {"9": {"images": []}}}}
+
+    def setUp(self):
+        # There is no ComfyUI to fetch the node definitions from
+        patcher = patch.object(rp_handler, "validate_workflow", return_value=[])
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def make_ws(self, *events):
+        ws = Mock()
+        ws.recv.side_effect = [
+            event if isinstance(event, (bytes, Exception)) else json.dumps(event)
+            for event in events
+        ]
+        return ws
+
+    @patch.object(rp_handler, "get_history")
+    def test_returns_history_when_prompt_is_done(self, mock_get_history):
+        mock_get_history.return_value = self.HISTORY
+        ws = self.make_ws(
+            {"type": "executing", "data": {"node": "9", "prompt_id": "123"}},
+            b"preview",
+            {"type": "executing", "data": {"node": None, "prompt_id": "other"}},
+            {"type": "executing", "data": {"node": None, "prompt_id": "123"}},
+        )
+
+        result = rp_handler.wait_for_history_websocket(ws, "123")
+
+        self.assertEqual(result, self.HISTORY)
+        mock_get_history.assert_called_once_with("123")
+
+    @patch.object(rp_handler, "get_history")
+    def test_reports_events_of_the_prompt(self, mock_get_history):
+        mock_get_history.return_value = self.HISTORY
+        ws = self.make_ws(
+            {"type": "progress", "data": {"node": "3", "value": 1, "max": 20, "prompt_id": "123"}},
+            {"type": "progress", "data": {"node": "3", "value": 1, "max": 20, "prompt_id": "other"}},
+            b"preview",
+            {"type": "executing", "data": {"node": None, "prompt_id": "123"}},
+        )
+        events = []
+
+        rp_handler.wait_for_history_websocket(ws, "123", lambda *event: events.append(event))
+
+        self.assertEqual(
+            [event_type for event_type, _ in events], ["progress", None, "executing"]
+        )
+
+    @patch.object(rp_handler, "get_history")
+    def test_raises_on_execution_error(self, mock_get_history):
+        ws = self.make_ws(
+            {
+                "type": "execution_error",
+                "data": {
+                    "prompt_id": "123",
+                    "node_id": "4",
+                    "node_type": "CheckpointLoaderSimple",
+                    "exception_message": "model not found",
+                },
+            }
+        )
+
+        with self.assertRaises(rp_handler.ComfyExecutionError) as context:
+            rp_handler.wait_for_history_websocket(ws, "123")
+
+        self.assertIn("model not found", str(context.exception))
+        mock_get_history.assert_not_called()
+
+    @patch.object(rp_handler, "get_history")
+    def test_checks_history_when_no_event_arrives(self, mock_get_history):
+        mock_get_history.return_value = self.HISTORY
+        ws = self.make_ws(rp_handler.websocket.WebSocketTimeoutException())
+
+        result = rp_handler.wait_for_history_websocket(ws, "123")
+
+        self.assertEqual(result, self.HISTORY)
+
+    @patch.object(rp_handler, "get_history")
+    def test_watchdog_fails_a_stalled_prompt(self, mock_get_history):
+        mock_get_history.return_value = {}
+        ws = self.make_ws({"type": "execution_start", "data": {"prompt_id": "123"}})
+        events = iter(ws.recv.side_effect)
+
+        def recv():
+            # Nothing arrives after the start, like when a node hangs
+            for event in events:
+                return event
+            time.sleep(ws.settimeout.call_args.args[0])
+            raise rp_handler.websocket.WebSocketTimeoutException()
+
+        ws.recv.side_effect = recv
+        deadline = rp_handler.JobDeadline(60, stall_timeout=0.05)
+
+        with self.assertRaises(rp_handler.JobTimeoutError) as context:
+            rp_handler.wait_for_history_websocket(ws, "123", deadline=deadline)
+
+        self.assertIn("no progress", str(context.exception))
+        # The socket never waits past the watchdog
+        self.assertLessEqual(ws.settimeout.call_args.args[0], 0.05)
+
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "open_websocket")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_falls_back_to_polling_when_websocket_drops(
+        self, mock_wait_until_ready, mock_open_websocket, mock_queue, mock_polling
+    ):
+        mock_open_websocket.return_value = self.make_ws(
+            rp_handler.websocket.WebSocketConnectionClosedException()
+        )
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+
+        with patch.object(rp_handler, "process_output_images") as mock_process:
+            mock_process.return_value = {"status": "success", "message": "image"}
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        mock_polling.assert_called_once_with("123", ANY, ANY)
+        self.assertEqual(result["status"], "success")
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "get_history")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "open_websocket")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_profiles_the_nodes(
+        self, mock_wait_until_ready, mock_open_websocket, mock_queue, mock_get_history, mock_process
+    ):
+        profile_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, profile_path)
+        workflow = {
+            "3": {"inputs": {"seed": 1}, "class_type": "KSampler"},
+            "9": {"inputs": {"images": ["3", 0]}, "class_type": "SaveImage"},
+        }
+        mock_open_websocket.side_effect = lambda client_id: self.make_ws(
+            {"type": "execution_start", "data": {"prompt_id": "123"}},
+            {"type": "executing", "data": {"node": "3", "prompt_id": "123"}},
+            {"type": "executing", "data": {"node": "9", "prompt_id": "123"}},
+            {"type": "executing", "data": {"node": None, "prompt_id": "123"}},
+        )
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_get_history.return_value = self.HISTORY
+        mock_process.return_value = {"status": "success", "message": "image", "images": []}
+        store = rp_handler.NodeProfileStore(profile_path, worker_id="test")
+
+        with patch.object(rp_handler, "node_profile_store", store):
+            result = rp_handler.handler({"id": "job", "input": {"workflow": workflow, "profile": True}})
+            unprofiled = rp_handler.handler({"id": "job", "input": {"workflow": workflow}})
+
+        self.assertEqual(
+            [node[:2] for node in result["profile"]["nodes"]], [["3", "KSampler"], ["9", "SaveImage"]]
+        )
+        self.assertNotIn("profile", unprofiled)
+        # Both prompts are added up, also the one that didn't ask for its profile
+        aggregate = load_aggregate(profile_path)
+        self.assertEqual(aggregate["prompts"], 2)
+        self.assertEqual(aggregate["classes"]["KSampler"][0], 2)
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "get_history")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "open_websocket")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_traces_the_job(
+        self, mock_wait_until_ready, mock_open_websocket, mock_queue, mock_get_history, mock_process
+    ):
+        trace_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, trace_path)
+        workflow = {"3": {"inputs": {"seed": 1}, "class_type": "KSampler"}}
+        mock_open_websocket.side_effect = lambda client_id: self.make_ws(
+            {"type": "execution_start", "data": {"prompt_id": "123"}},
+            {"type": "executing", "data": {"node": "3", "prompt_id": "123"}},
+            {"type": "executing", "data": {"node": None, "prompt_id": "123"}},
+        )
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_get_history.return_value = self.HISTORY
+        mock_process.return_value = {"status": "success", "message": "image", "images": []}
+
+        with patch.object(rp_handler, "COMFY_TRACE_PATH", trace_path):
+            untraced = rp_handler.handler({"id": "job", "input": {"workflow": workflow}})
+            traced = rp_handler.handler({"id": "job", "input": {"workflow": workflow, "trace": True}})
+            with patch.object(rp_handler, "COMFY_TRACE_OUTPUT", "inline"), patch.object(
+                rp_handler, "COMFY_TRACE_SAMPLE_PERCENT", 100
+            ):
+                sampled = rp_handler.handler({"id": "job", "input": {"workflow": workflow}})
+
+        self.assertNotIn("trace_path", untraced)
+        self.assertEqual(traced["trace_path"], os.path.join(trace_path, "job.trace.json"))
+        spans = {event["name"]: event for event in sampled["trace"]["traceEvents"] if event["ph"] == "X"}
+        self.assertTrue({"job", "validate", "queue", "wait", "outputs", "KSampler"} <= set(spans))
+        self.assertNotEqual(spans["KSampler"]["tid"], spans["wait"]["tid"])
+
+    def test_validate_input_with_invalid_trace(self):
+        validated_data, error = rp_handler.validate_input({"workflow": {}, "trace": "yes"})
+
+        self.assertIsNone(validated_data)
+        self.assertEqual(error, "'trace' must be a boolean")
+
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler, "COMFY_METRICS", True)
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_records_metrics(self, mock_wait_until_ready, mock_queue, mock_polling):
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+        jobs = {labels: value for _, labels, value in rp_handler.jobs_total.samples()}
+
+        with patch.object(rp_handler, "process_output_images") as mock_process:
+            mock_process.return_value = {"status": "success", "message": "image", "images": [{}, {}]}
+            rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+        rp_handler.handler({"id": "job", "input": {}})
+
+        samples = {labels: value for _, labels, value in rp_handler.jobs_total.samples()}
+        self.assertEqual(samples[("success",)], jobs.get(("success",), 0) + 1)
+        self.assertEqual(samples[("error",)], jobs.get(("error",), 0) + 1)
+        phases = {labels[0] for suffix, labels, _ in rp_handler.job_phase_seconds.samples() if suffix == "_count"}
+        self.assertTrue({"validate", "queue", "wait", "outputs"} <= phases)
+        self.assertIn("comfy_worker_output_images_total", rp_handler.metrics.render())
+
+    @patch.object(rp_handler.comfy_http_client, "get_json")
+    @patch.object(rp_handler.comfy_readiness, "state", rp_handler.READY)
+    def test_sample_metrics_from_comfy(self, mock_get_json):
+        mock_get_json.side_effect = lambda url, **kwargs: {
+            f"http://{rp_handler.COMFY_HOST}/queue": {"queue_running": [[0, "a"]], "queue_pending": []},
+            f"http://{rp_handler.COMFY_HOST}/system_stats": {
+                "system": {"ram_total": 64, "ram_free": 32},
+                "devices": [{"type": "cuda", "index": 0, "vram_total": 24, "vram_free": 8}],
+            },
+        }[url]
+
+        rp_handler.sample_metrics()
+
+        snapshot = rp_handler.metrics.snapshot()
+        self.assertIn([{"state": "running"}, 1], snapshot["comfy_queue_prompts"])
+        self.assertIn([{"kind": "free"}, 32], snapshot["comfy_ram_bytes"])
+        self.assertIn([{"device": "cuda:0", "kind": "vram_free"}, 8], snapshot["comfy_vram_bytes"])
+        self.assertEqual(snapshot["comfy_up"], [[{}, 1]])
+
+    @patch.object(rp_handler, "wait_for_prompt")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler, "COMFY_OPTIMIZE_WORKFLOW", False)
+    def test_warm_up_runs_the_templates_with_a_fixed_seed_and_few_steps(self, mock_queue, mock_wait):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        os.makedirs(os.path.join(root, "jasper-color"))
+        with open(os.path.join(root, "jasper-color", "2.json"), "w") as template_file:
+            json.dump(
+                {
+                    "3": {"inputs": {"seed": ["515", 0], "steps": 20}, "class_type": "KSampler"},
+                    "515": {"inputs": {"value": 6069}, "_meta": {"title": "GlobalSeed"}, "class_type": "INTConstant"},
+                },
+                template_file,
+            )
+        with open(os.path.join(root, "jasper-color", "2.rules.json"), "w") as rules_file:
+            json.dump({"GlobalSeed": "random_seed()"}, rules_file)
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_wait.return_value = ({}, None)
+        readiness = rp_handler.ComfyReadiness(Mock(return_value=True), Mock(return_value=True))
+
+        with patch.object(rp_handler, "workflow_templates", rp_handler.WorkflowTemplates([root])), patch.object(
+            rp_handler, "comfy_readiness", readiness
+        ), patch.object(rp_handler, "COMFY_WARMUP_WORKFLOWS", ["jasper-color@2"]):
+            self.assertTrue(rp_handler.warm_up())
+
+        workflow = mock_queue.call_args[0][0]
+        self.assertEqual(workflow["515"]["inputs"]["value"], rp_handler.COMFY_WARMUP_SEED)
+        self.assertEqual(workflow["3"]["inputs"]["steps"], rp_handler.COMFY_WARMUP_STEPS)
+        self.assertTrue(readiness.warm)
+        self.assertEqual(readiness.warmup[0]["status"], "success")
+
+    @patch.object(rp_handler, "queue_workflow")
+    def test_failed_warmup_marks_the_worker_unhealthy(self, mock_queue):
+        readiness = rp_handler.ComfyReadiness(Mock(return_value=True), Mock(return_value=True))
+
+        with patch.object(rp_handler, "comfy_readiness", readiness), patch.object(
+            rp_handler, "COMFY_WARMUP_WORKFLOWS", ["jasper-color@2", "missing.json"]
+        ), patch.object(rp_handler, "workflow_templates", rp_handler.WorkflowTemplates([])):
+            self.assertFalse(rp_handler.warm_up())
+            self.assertFalse(rp_handler.worker_health()["healthy"])
+            # Jobs don't run on a worker whose warmup failed, it is refreshed instead
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {"1": {"inputs": {"value": 1}}}}})
+
+        self.assertEqual(
+            result["error"], "The worker is unhealthy, its warmup failed: Unknown template 'jasper-color@2'"
+        )
+        self.assertTrue(result["refresh_worker"])
+        self.assertFalse(readiness.warm)
+        self.assertEqual(
+            [result["error"] for result in readiness.warmup],
+            [
+                "Unknown template 'jasper-color@2'",
+                "Can't read the warmup workflow missing.json: [Errno 2] No such file or directory: 'missing.json'",
+            ],
+        )
+        mock_queue.assert_not_called()
+
+    @patch.object(rp_handler, "COMFY_BOOT_TIMEOUT_S", 10)
+    @patch.object(rp_handler, "COMFY_API_AVAILABLE_INTERVAL_MS", 0)
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_http_client.pool, "request")
+    def test_the_first_job_waits_for_a_slow_boot(self, mock_request, mock_queue, mock_polling, mock_process):
+        attempts = []
+
+        def request(*args, **kwargs):
+            attempts.append(args)
+            # More attempts than the boot probe used to make before ComfyUI was considered dead
+            if len(attempts) <= 600:
+                raise NewConnectionError(None, "refused")
+            return MagicMock(status=200)
+
+        mock_request.side_effect = request
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+        mock_process.return_value = {"status": "success", "message": "https://bucket/a.png", "images": []}
+        readiness = rp_handler.ComfyReadiness(rp_handler.wait_for_comfy_boot, Mock(return_value=False))
+
+        with patch.object(rp_handler, "comfy_readiness", readiness), patch.object(
+            rp_handler, "cold_start_timeline", rp_handler.ColdStartTimeline()
+        ):
+            # Like boot_comfy, which probes ComfyUI while the worker already takes the first job
+            boot = threading.Thread(target=readiness.wait_until_ready)
+            boot.start()
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {"1": {"inputs": {"value": 1}}}}})
+            boot.join()
+
+        self.assertEqual(result["status"], "success")
+        self.assertFalse(result["refresh_worker"])
+
+    def test_first_job_reports_the_cold_start(self):
+        timeline = rp_handler.ColdStartTimeline()
+
+        with patch.object(rp_handler, "cold_start_timeline", timeline), patch.object(
+            rp_handler.comfy_readiness, "warm", False
+        ):
+            first = rp_handler.handler({"id": "job", "input": {}})
+            second = rp_handler.handler({"id": "job", "input": {}})
+
+        self.assertIn("first_job_done", first["cold_start"]["since_container_start_ms"])
+        self.assertFalse(first["cold_start"]["warm"])
+        self.assertNotIn("cold_start", second)
+
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_fails_fast_when_comfy_is_dead(self, mock_wait_until_ready, mock_queue):
+        mock_wait_until_ready.return_value = False
+
+        result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertIn("ComfyUI is not reachable", result["error"])
+        self.assertTrue(result["refresh_worker"])
+        mock_queue.assert_not_called()
+
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_queues_the_optimized_workflow(
+        self, mock_wait_until_ready, mock_queue, mock_polling
+    ):
+        workflow = {
+            "1": {"inputs": {"value": 2}, "class_type": "INTConstant"},
+            "2": {"inputs": {"image": "a.png"}, "class_type": "LoadImage"},
+            "3": {"inputs": {"image": "b.png"}, "class_type": "LoadImage"},
+            "4": {
+                "inputs": {"select": ["1", 0], "input1": ["2", 0], "input2": ["3", 0]},
+                "class_type": "ImpactSwitch",
+            },
+            "5": {"inputs": {"images": ["4", 0]}, "class_type": "SaveImage"},
+        }
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+
+        with patch.object(rp_handler, "process_output_images") as mock_process:
+            mock_process.return_value = {"status": "success", "message": "image"}
+            rp_handler.handler({"id": "job", "input": {"workflow": workflow}})
+            with patch.object(rp_handler, "COMFY_OPTIMIZE_WORKFLOW", False):
+                rp_handler.handler({"id": "job", "input": {"workflow": workflow}})
+
+        self.assertEqual(
+            mock_queue.call_args_list[0].args[0],
+            {"3": workflow["3"], "5": {"inputs": {"images": ["3", 0]}, "class_type": "SaveImage"}},
+        )
+        self.assertEqual(mock_queue.call_args_list[1].args[0], workflow)
+
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_returns_cached_results(self, mock_wait_until_ready, mock_queue, mock_polling):
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        workflow = {"9": {"inputs": {"seed": 1, "images": ["8", 0]}, "class_type": "SaveImage"}}
+        image = {"type": "s3_url", "data": "https://bucket/a.png", "node_id": "9", "filename": "a.png"}
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+
+        with patch.object(
+            rp_handler, "result_cache", ResultCache(LocalCacheIndex(cache_path), 60)
+        ), patch.object(rp_handler, "process_output_images") as mock_process:
+            def process(outputs, job_id, timings, on_uploaded):
+                # Jobs that aren't cached have no upload to confirm
+                if on_uploaded is not None:
+                    on_uploaded()
+                return {"status": "success", "message": image["data"], "images": [image]}
+
+            mock_process.side_effect = process
+            first = rp_handler.handler({"id": "job-1", "input": {"workflow": workflow}})
+            second = rp_handler.handler({"id": "job-2", "input": {"workflow": workflow}})
+            bypassed = rp_handler.handler({"id": "job-3", "input": {"workflow": workflow, "cache": False}})
+            random_seed = {"9": {**workflow["9"], "inputs": {"seed": -1, "images": ["8", 0]}}}
+            rp_handler.handler({"id": "job-4", "input": {"workflow": random_seed}})
+            rp_handler.handler({"id": "job-5", "input": {"workflow": random_seed}})
+
+        self.assertNotIn("cached", first)
+        self.assertTrue(second["cached"])
+        self.assertEqual(second["images"], [image])
+        self.assertEqual(second["message"], image["data"])
+        self.assertNotIn("cached", bypassed)
+        self.assertEqual(mock_queue.call_count, 4)
+
+    def test_results_are_cached_once_their_images_are_uploaded(self):
+        cache_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_path)
+        image = {"type": "s3_url", "data": "https://bucket/a.png", "node_id": "9", "filename": "a.png"}
+        result = {"status": "success", "message": image["data"], "images": [image, {**image, "filename": "b.png"}]}
+
+        with patch.object(rp_handler, "result_cache", ResultCache(LocalCacheIndex(cache_path), 60)):
+            # Like with BUCKET_WRITE_BEHIND, where the job returns before the upload is done
+            written_behind = rp_handler.PendingCacheEntry("written-behind")
+            written_behind.set_result(result)
+            self.assertIsNone(rp_handler.result_cache.get("written-behind"))
+            written_behind.uploaded()
+            self.assertIsNone(rp_handler.result_cache.get("written-behind"))
+            written_behind.uploaded()
+            self.assertEqual(rp_handler.result_cache.get("written-behind")["images"], result["images"])
+
+            # One of the uploads failed for good
+            failed = rp_handler.PendingCacheEntry("failed")
+            failed.uploaded()
+            failed.set_result(result)
+            self.assertIsNone(rp_handler.result_cache.get("failed"))
+
+    @patch.dict(os.environ, {"BUCKET_ENDPOINT_URL": "http://example.com"})
+    @patch.object(rp_handler, "get_boto_client", return_value=(None, None))
+    def test_simulated_uploads_are_never_confirmed(self, mock_get_boto_client):
+        on_uploaded = Mock()
+        self.addCleanup(shutil.rmtree, "simulated_uploaded", ignore_errors=True)
+
+        location = rp_handler.upload_image(
+            "123", f"{RUNPOD_WORKER_COMFY_TEST_RESOURCES_IMAGES}/ComfyUI_00001_.png", on_uploaded=on_uploaded
+        )
+
+        self.assertTrue(location.startswith("simulated_uploaded"))
+        on_uploaded.assert_not_called()
+
+    @patch.object(rp_handler, "process_output_images")
+    @patch.object(rp_handler, "wait_for_history_polling")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "COMFY_COMPLETION_MODE", "polling")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_returns_and_logs_the_timings_of_its_phases(
+        self, mock_wait_until_ready, mock_queue, mock_polling, mock_process
+    ):
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_polling.return_value = {"123": {"outputs": {}}}
+        mock_process.return_value = {"status": "success", "message": "image", "images": []}
+
+        with patch("builtins.print") as mock_print:
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertEqual(
+            list(result["timings"]),
+            ["validate_ms", "server_check_ms", "prepare_ms", "cache_ms", "upload_inputs_ms",
+             "queue_ms", "wait_ms", "outputs_ms", "total_ms"],
+        )
+        logged = [
+            json.loads(call.args[0].split("job timings ", 1)[1])
+            for call in mock_print.call_args_list
+            if "job timings" in call.args[0]
+        ]
+        self.assertEqual(logged, [{"job_id": "job", "status": "success", **result["timings"]}])
+
+        with patch.object(rp_handler, "COMFY_JOB_TIMINGS", False):
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+        self.assertNotIn("timings", result)
+
+    @patch.object(rp_handler, "upload_images")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_rejects_invalid_workflows_before_uploading(
+        self, mock_wait_until_ready, mock_queue, mock_upload
+    ):
+        rp_handler.validate_workflow.return_value = ["Node 1 (Foo): unknown node type 'Foo'"]
+
+        result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertEqual(result["error"], "The workflow is not valid: Node 1 (Foo): unknown node type 'Foo'")
+        self.assertEqual(result["validation_errors"], ["Node 1 (Foo): unknown node type 'Foo'"])
+        mock_upload.assert_not_called()
+        mock_queue.assert_not_called()
+
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    @patch.object(rp_handler, "wait_for_history_websocket")
+    @patch.object(rp_handler, "queue_workflow")
+    @patch.object(rp_handler, "comfy_event_router")
+    @patch.object(rp_handler.comfy_readiness, "wait_until_ready")
+    def test_handler_shares_the_event_router_between_concurrent_jobs(
+        self, mock_wait_until_ready, mock_router, mock_queue, mock_wait
+    ):
+        subscription = mock_router.subscribe.return_value
+        mock_queue.return_value = {"prompt_id": "123"}
+        mock_wait.return_value = {"123": {"outputs": {}}}
+
+        with patch.object(rp_handler, "process_output_images") as mock_process:
+            mock_process.return_value = {"status": "success", "message": "image"}
+            result = rp_handler.handler({"id": "job", "input": {"workflow": {}}})
+
+        self.assertEqual(result["status"], "success")
+        mock_queue.assert_called_once_with({}, mock_router.client_id)
+        subscription.bind.assert_called_once_with("123")
+        mock_wait.assert_called_once_with(subscription, "123", None, ANY, ANY)
+        subscription.close.assert_called_once()
+
+
+class TestAsyncHandler(unittest.TestCase):
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    @patch.object(rp_handler, "_job_executor", ThreadPoolExecutor(max_workers=2))
+    @patch.object(rp_handler, "handler")
+    def test_async_handler_runs_jobs_concurrently(self, mock_handler):
+        both_running = threading.Barrier(2, timeout=5)
+        busy = []
+
+        def handle(job):
+            # Only passes if both jobs run at the same time
+            both_running.wait()
+            busy.append(rp_handler.is_worker_busy())
+            # Neither job may finish before the other one checked
+            both_running.wait()
+            return {"status": "success", "job": job["id"]}
+
+        mock_handler.side_effect = handle
+
+        async def run_jobs():
+            return await asyncio.gather(
+                rp_handler.async_handler({"id": "a"}), rp_handler.async_handler({"id": "b"})
+            )
+
+        results = asyncio.run(run_jobs())
+
+        self.assertEqual([result["job"] for result in results], ["a", "b"])
+        self.assertEqual(busy, [True, True])
+        self.assertFalse(rp_handler.is_worker_busy())
+
+    @patch.object(rp_handler, "handler")
+    def test_stream_handler_yields_progress_and_result(self, mock_handler):
+        def handle(job, on_progress):
+            on_progress({"status": "progress", "step": 1})
+            on_progress({"status": "progress", "step": 2})
+            return {"status": "success", "message": "image"}
+
+        mock_handler.side_effect = handle
+
+        async def collect():
+            return [output async for output in rp_handler.stream_handler({"id": "job"})]
+
+        outputs = asyncio.run(collect())
+
+        self.assertEqual([output.get("step") for output in outputs[:2]], [1, 2])
+        self.assertEqual(outputs[-1], {"status": "success", "message": "image"})
+        self.assertFalse(rp_handler.is_worker_busy())
+
+    @patch.object(rp_handler, "handler")
+    def test_stream_handler_raises_for_failed_jobs(self, mock_handler):
+        mock_handler.return_value = {"error": "ComfyUI is not reachable", "refresh_worker": True}
+
+        async def collect():
+            return [output async for output in rp_handler.stream_handler({"id": "job"})]
+
+        with patch.dict(rp_handler.worker_config, clear=True):
+            with self.assertRaisesRegex(rp_handler.JobFailedError, "ComfyUI is not reachable"):
+                asyncio.run(collect())
+            self.assertTrue(rp_handler.worker_config["refresh_worker"])
+
+
+class TestRunPodWorker(unittest.TestCase):
+    """The handler in the job loop of the runpod SDK, against a stand-in for the job API of RunPod"""
+
+    def setUp(self):
+        patcher = patch.object(rp_scale.JobScaler, "SLEEP_INTERVAL_SEC", 0.1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    @patch.object(rp_handler, "COMFY_MAX_CONCURRENT_JOBS", 2)
+    @patch.object(rp_handler, "_job_executor", ThreadPoolExecutor(max_workers=2))
+    @patch.object(rp_scale, "get_job", rp_scale.get_job)
+    @patch.object(rp_handler, "handler")
+    def test_a_busy_worker_takes_no_more_jobs(self, mock_handler):
+        release = threading.Event()
+        self.addCleanup(release.set)
+        mock_handler.side_effect = lambda job: release.wait(10) and {"status": "success", "job": job["id"]}
+        api = FakeRunPodApi([{"id": f"job-{i}", "input": {}} for i in range(3)])
+        rp_handler.limit_concurrent_jobs()
+
+        async def scenario(api):
+            await wait_until(lambda: len(api.taken) == 2)
+            # Without the limit, the SDK takes the third job well within this time
+            await asyncio.sleep(1.5)
+            taken_while_busy = list(api.taken)
+            release.set()
+            await wait_until(lambda: len(api.results) == 3)
+            return taken_while_busy
+
+        taken_while_busy = api.run_worker(
+            {"handler": rp_handler.async_handler, "concurrency_controller": rp_handler.is_worker_busy}, scenario
+        )
+
+        self.assertEqual(taken_while_busy, ["job-0", "job-1"])
+        self.assertEqual(
+            {job_id: result["output"]["job"] for job_id, result in api.results.items()},
+            {"job-0": "job-0", "job-1": "job-1", "job-2": "job-2"},
+        )
+
+    @patch.object(rp_handler, "handler")
+    def test_a_failed_stream_fails_the_job_and_refreshes_the_worker(self, mock_handler):
+        def handle(job, on_progress):
+            on_progress({"status": "progress", "step": 1})
+            return {"error": "ComfyUI is not reachable at 127.0.0.1:8188 (state: DEAD)", "refresh_worker": True}
+
+        mock_handler.side_effect = handle
+        api = FakeRunPodApi([{"id": "job-0", "input": {}}, {"id": "job-1", "input": {}}])
+
+        async def scenario(api):
+            await wait_until(lambda: "job-0" in api.results)
+            # Long enough for a worker that keeps going to take the next job
+            await asyncio.sleep(1)
+
+        with patch.dict(rp_handler.worker_config, clear=True):
+            rp_handler.worker_config.update(handler=rp_handler.stream_handler, return_aggregate_stream=True)
+            api.run_worker(rp_handler.worker_config, scenario)
+
+        result = api.results["job-0"]
+        self.assertIn("ComfyUI is not reachable", result["error"])
+        self.assertTrue(result["stopPod"])
+        self.assertEqual(api.streamed, [("job-0", {"output": {"status": "progress", "step": 1}})])
+        self.assertEqual(api.taken, ["job-0"])
+
+    @patch.object(rp_handler, "COMFY_CANCEL_CHECK_INTERVAL_S", 0.1)
+    @patch.object(rp_handler, "RUNPOD_API_KEY", "key")
+    @patch.object(rp_handler, "RUNPOD_ENDPOINT_ID", "endpoint")
+    @patch.object(runpod, "api_key", None)
+    @patch.object(rp_handler, "cancel_prompts")
+    @patch.object(rp_handler, "handler")
+    def test_a_job_cancelled_in_runpod_is_stopped(self, mock_handler, mock_cancel_prompts):
+        def handle(job):
+            # Like run_workflow, which checks the deadline while it waits for its prompt
+            deadline = JobDeadline(60)
+            deadline.track("prompt")
+            rp_handler._job_deadlines[job["id"]] = deadline
+            try:
+                while True:
+                    deadline.check()
+                    time.sleep(0.05)
+            except JobTimeoutError as e:
+                return {"error": str(e)}
+            finally:
+                rp_handler._job_deadlines.pop(job["id"], None)
+
+        mock_handler.side_effect = handle
+        api = FakeRunPodApi([{"id": "job-0", "input": {}}])
+        stop = threading.Event()
+        self.addCleanup(stop.set)
+
+        async def scenario(api):
+            threading.Thread(target=rp_handler.watch_cancelled_jobs, args=(stop,), daemon=True).start()
+            await wait_until(lambda: "job-0" in rp_handler._job_deadlines)
+            api.cancelled.add("job-0")
+            await wait_until(lambda: "job-0" in api.results)
+
+        api.run_worker({"handler": rp_handler.async_handler}, scenario)
+
+        self.assertEqual(api.results["job-0"]["error"], "The job was cancelled")
+        mock_cancel_prompts.assert_called_once_with(["prompt"])
@@ -0,0 +1,73 @@
+import unittest
+import os
+import sys
+
+# Make sure that "src" is known and can be used to import variant_scheduler.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import variant_scheduler
+
+
+def make_workflow(token, vase):
+    return {
+        "1": {"inputs": {"ckpt_name": "sdxl.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+        "2": {"inputs": {"text": token, "clip": ["1", 1]}, "class_type": "CLIPTextEncode"},
+        "3": {"inputs": {"image": f"vase{vase}.png"}, "class_type": "LoadImage"},
+        "4": {"inputs": {"model": ["1", 0], "positive": ["2", 0], "image": ["3", 0]}, "class_type": "KSampler"},
+    }
+
+
+class TestNodeSignatures(unittest.TestCase):
+    def test_signatures_follow_links_but_not_ids(self):
+        rabbit = variant_scheduler.node_signatures(make_workflow("Rabbit", 1))
+        fox = variant_scheduler.node_signatures(make_workflow("Fox", 1))
+        renumbered = variant_scheduler.node_signatures(
+            {
+                "10": {"inputs": {"ckpt_name": "sdxl.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+                "20": {"inputs": {"text": "Rabbit", "clip": ["10", 1]}, "class_type": "CLIPTextEncode"},
+            }
+        )
+
+        self.assertEqual(rabbit["1"], fox["1"])
+        self.assertEqual(rabbit["3"], fox["3"])
+        self.assertNotEqual(rabbit["2"], fox["2"])
+        # The sampler depends on the text encoder
+        self.assertNotEqual(rabbit["4"], fox["4"])
+        self.assertEqual(renumbered["20"], rabbit["2"])
+
+
+class TestVariantScheduler(unittest.TestCase):
+    def test_groups_variants_that_share_nodes(self):
+        workflows = [
+            make_workflow("Rabbit", 1),
+            make_workflow("Fox", 2),
+            make_workflow("Rabbit", 2),
+            make_workflow("Fox", 1),
+        ]
+        scheduler = variant_scheduler.VariantScheduler()
+
+        order, expected, invalidated = scheduler.plan(workflows)
+
+        self.assertEqual(order, [0, 2, 1, 3])
+        self.assertEqual(expected, [0.0, 0.5, 0.5, 0.5])
+        self.assertEqual(invalidated, [3, 3, 3, 3])
+
+    def test_continues_from_the_last_queued_workflow(self):
+        scheduler = variant_scheduler.VariantScheduler()
+        scheduler.record(make_workflow("Fox", 2))
+
+        order, expected, _ = scheduler.plan([make_workflow("Rabbit", 1), make_workflow("Fox", 2)])
+
+        self.assertEqual(order, [1, 0])
+        self.assertEqual(expected, [0.25, 1.0])
+
+    def test_keeps_the_order_without_reorder(self):
+        workflows = [make_workflow("Rabbit", 1), make_workflow("Fox", 2), make_workflow("Rabbit", 2)]
+
+        order, expected, _ = variant_scheduler.VariantScheduler().plan(workflows, reorder=False)
+
+        self.assertEqual(order, [0, 1, 2])
+        self.assertEqual(expected, [0.0, 0.25, 0.5])
+
+
+if __name__ == "__main__":
+    unittest.main()
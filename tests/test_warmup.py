@@ -0,0 +1,67 @@
+import json
+import shutil
+import tempfile
+import unittest
+import os
+import sys
+
+# Make sure that "src" is known and can be used to import warmup.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import warmup
+
+WORKFLOW = {
+    "3": {"inputs": {"seed": 234234, "steps": 20, "model": ["4", 0]}, "class_type": "KSampler"},
+    "4": {"inputs": {"ckpt_name": "sd_xl_base_1.0.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+    "24": {
+        "inputs": {"noise_seed": ["515", 0], "steps": 25, "start_at_step": 0},
+        "class_type": "KSamplerAdvanced",
+    },
+    "68": {
+        "inputs": {"noise_seed": ["515", 0], "steps": 20, "start_at_step": 12},
+        "class_type": "KSamplerAdvanced",
+    },
+}
+
+
+class TestWarmup(unittest.TestCase):
+    def test_parse_warmup_specs(self):
+        self.assertEqual(
+            warmup.parse_warmup_specs(" jasper-color@2, /test_input.json ,"),
+            ["jasper-color@2", "/test_input.json"],
+        )
+        self.assertEqual(warmup.parse_warmup_specs(""), [])
+
+    def test_load_warmup_input_from_a_template_or_a_file(self):
+        root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, root)
+        path = os.path.join(root, "test_input.json")
+        with open(path, "w") as input_file:
+            json.dump({"input": {"workflow": WORKFLOW}}, input_file)
+
+        self.assertEqual(warmup.load_warmup_input("jasper-color@2"), {"template": "jasper-color@2"})
+        self.assertEqual(warmup.load_warmup_input(path), {"workflow": WORKFLOW})
+        with self.assertRaises(warmup.WarmupError):
+            warmup.load_warmup_input(os.path.join(root, "missing.json"))
+
+    def test_fix_seeds_leaves_linked_seeds(self):
+        workflow = warmup.fix_seeds(WORKFLOW, 1)
+
+        self.assertEqual(workflow["3"]["inputs"]["seed"], 1)
+        self.assertEqual(workflow["24"]["inputs"]["noise_seed"], ["515", 0])
+        # Only the changed nodes are copied
+        self.assertIs(workflow["4"], WORKFLOW["4"])
+        self.assertEqual(WORKFLOW["3"]["inputs"]["seed"], 234234)
+
+    def test_limit_steps_keeps_every_sampler_running(self):
+        workflow = warmup.limit_steps(WORKFLOW, 2)
+
+        self.assertEqual(workflow["3"]["inputs"]["steps"], 2)
+        self.assertEqual(workflow["24"]["inputs"]["start_at_step"], 0)
+        self.assertEqual(
+            (workflow["68"]["inputs"]["steps"], workflow["68"]["inputs"]["start_at_step"]), (2, 1)
+        )
+        self.assertEqual(WORKFLOW["68"]["inputs"]["steps"], 20)
+
+
+if __name__ == "__main__":
+    unittest.main()
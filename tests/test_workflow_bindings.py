@@ -0,0 +1,97 @@
+import unittest
+import os
+import sys
+from unittest.mock import patch
+
+# Make sure that "src" is known and can be used to import workflow_bindings.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import workflow_bindings
+
+WORKFLOW = {
+    "552": {"inputs": {"value": 3}, "class_type": "INTConstant", "_meta": {"title": "WhatVase?"}},
+    "512": {"inputs": {"value": "Rabbit"}, "class_type": "Badman_String", "_meta": {"title": "PromptTokenInput"}},
+    "515": {"inputs": {"value": 6069}, "class_type": "INTConstant", "_meta": {"title": "GlobalSeed"}},
+    "680": {"inputs": {"value": ""}, "class_type": "Badman_String", "_meta": {"title": "GlobalSeedString"}},
+    "3": {
+        "inputs": {"cfg": 7.0, "add_noise": "enable", "model": ["4", 0]},
+        "class_type": "KSamplerAdvanced",
+        "_meta": {"title": "KSampler (Advanced)"},
+    },
+    "4": {
+        "inputs": {"cfg": 5.0, "add_noise": "enable", "model": ["5", 0]},
+        "class_type": "KSamplerAdvanced",
+        "_meta": {"title": "KSampler (Advanced)"},
+    },
+}
+SEED_RULES = {"GlobalSeed": "random_seed()", "GlobalSeedString": "str(GlobalSeed)"}
+
+
+class TestWorkflowBindings(unittest.TestCase):
+    def test_bind_by_title_and_node_id(self):
+        bindings = workflow_bindings.WorkflowBindings(WORKFLOW)
+
+        workflow = bindings.apply(
+            {"WhatVase?": 2, "512": "Fox", "3.cfg": 6.5, "KSampler (Advanced)": {"add_noise": "disable"}}
+        )
+
+        self.assertEqual(workflow["552"]["inputs"]["value"], 2)
+        self.assertEqual(workflow["512"]["inputs"]["value"], "Fox")
+        self.assertEqual(workflow["3"]["inputs"]["cfg"], 6.5)
+        # A title that several nodes share binds all of them
+        self.assertEqual(workflow["3"]["inputs"]["add_noise"], "disable")
+        self.assertEqual(workflow["4"]["inputs"]["add_noise"], "disable")
+        self.assertEqual(workflow["4"]["inputs"]["model"], ["5", 0])
+
+    def test_only_changed_nodes_are_copied(self):
+        bindings = workflow_bindings.WorkflowBindings(WORKFLOW)
+
+        workflow = bindings.apply({"WhatVase?": 2})
+
+        self.assertEqual(WORKFLOW["552"]["inputs"]["value"], 3)
+        self.assertIs(workflow["512"], WORKFLOW["512"])
+
+    def test_links_and_unknown_names_are_rejected(self):
+        bindings = workflow_bindings.WorkflowBindings(WORKFLOW)
+
+        with self.assertRaisesRegex(workflow_bindings.BindingError, "'3.model', 'Missing'"):
+            bindings.apply({"3.model": ["6", 0], "Missing": 1})
+
+    def test_values_are_coerced_to_the_type_of_the_input(self):
+        bindings = workflow_bindings.WorkflowBindings(WORKFLOW)
+
+        workflow = bindings.apply({"WhatVase?": "2", "PromptTokenInput": 5005441, "3.cfg": 6})
+
+        self.assertEqual(workflow["552"]["inputs"]["value"], 2)
+        self.assertEqual(workflow["512"]["inputs"]["value"], "5005441")
+        self.assertIsInstance(workflow["3"]["inputs"]["cfg"], float)
+        with self.assertRaisesRegex(workflow_bindings.BindingError, "'WhatVase\\?' must be of type int"):
+            bindings.apply({"WhatVase?": "two"})
+        with self.assertRaises(workflow_bindings.BindingError):
+            bindings.apply({"WhatVase?": True})
+
+    @patch.object(workflow_bindings.random, "randint", return_value=42)
+    def test_rules_fill_in_missing_params(self, mock_randint):
+        bindings = workflow_bindings.WorkflowBindings(WORKFLOW, SEED_RULES)
+
+        drawn = bindings.apply({})
+        given = bindings.apply({"GlobalSeed": 7})
+
+        self.assertEqual(drawn["515"]["inputs"]["value"], 42)
+        self.assertEqual(drawn["680"]["inputs"]["value"], "42")
+        self.assertEqual(given["515"]["inputs"]["value"], 7)
+        self.assertEqual(given["680"]["inputs"]["value"], "7")
+        by_node_id = bindings.apply({"515": {"value": 7}})
+        self.assertEqual(by_node_id["680"]["inputs"]["value"], "7")
+        self.assertTrue(bindings.draws_random_seed({}))
+        self.assertFalse(bindings.draws_random_seed({"515": {"value": 7}}))
+        self.assertFalse(workflow_bindings.WorkflowBindings(WORKFLOW).draws_random_seed({}))
+
+    def test_invalid_rules(self):
+        with self.assertRaisesRegex(workflow_bindings.BindingError, "unknown binding 'Seed'"):
+            workflow_bindings.WorkflowBindings(WORKFLOW, {"GlobalSeedString": "str(Seed)"})
+        with self.assertRaisesRegex(workflow_bindings.BindingError, "Invalid rule"):
+            workflow_bindings.WorkflowBindings(WORKFLOW, {"GlobalSeed": "seed(("})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,95 @@
+import copy
+import json
+import unittest
+import os
+import sys
+
+# Make sure that "src" is known and can be used to import workflow_optimizer.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import workflow_optimizer
+
+WORKFLOW = {
+    "552": {"inputs": {"value": 2}, "class_type": "INTConstant"},
+    "513": {"inputs": {"value": "3"}, "class_type": "Badman_String"},
+    "503": {"inputs": {"value": ["513", 0]}, "class_type": "BadmanStringToInteger"},
+    "10": {"inputs": {"image": "vase1.png"}, "class_type": "LoadImage"},
+    "11": {"inputs": {"image": "vase2.png"}, "class_type": "LoadImage"},
+    "12": {"inputs": {"image": "vase3.png"}, "class_type": "LoadImage"},
+    "20": {
+        "inputs": {"select": ["552", 0], "sel_mode": False, "input1": ["10", 0], "input2": ["11", 0]},
+        "class_type": "ImpactSwitch",
+    },
+    "21": {
+        "inputs": {
+            "select": ["503", 0],
+            "images1": ["10", 0],
+            "mask1_opt": ["10", 1],
+            "images3_opt": ["12", 0],
+            "mask3_opt": ["12", 1],
+        },
+        "class_type": "ImageMaskSwitch",
+    },
+    "30": {
+        "inputs": {"image": ["20", 0], "destination": ["21", 0], "mask": ["21", 1]},
+        "class_type": "ImageCompositeMasked",
+    },
+    "40": {"inputs": {"filename_prefix": "ComfyUI", "images": ["30", 0]}, "class_type": "SaveImage"},
+}
+
+
+class TestOptimizeWorkflow(unittest.TestCase):
+    def test_folds_constant_switches_and_drops_dead_branches(self):
+        original = copy.deepcopy(WORKFLOW)
+
+        optimized = workflow_optimizer.optimize_workflow(WORKFLOW)
+
+        self.assertEqual(WORKFLOW, original)
+        self.assertEqual(
+            optimized["30"]["inputs"],
+            {"image": ["11", 0], "destination": ["12", 0], "mask": ["12", 1]},
+        )
+        self.assertEqual(sorted(optimized), ["11", "12", "30", "40"])
+        self.assertIs(optimized["40"], WORKFLOW["40"])
+
+    def test_keeps_switches_without_a_constant_selection(self):
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["552"] = {"inputs": {"a": ["10", 0]}, "class_type": "GetImageSize"}
+
+        optimized = workflow_optimizer.optimize_workflow(workflow)
+
+        self.assertEqual(optimized["30"]["inputs"]["image"], ["20", 0])
+        self.assertIn("10", optimized)
+        self.assertIn("11", optimized)
+
+    def test_keeps_switches_whose_selected_input_is_not_connected(self):
+        workflow = copy.deepcopy(WORKFLOW)
+        workflow["552"]["inputs"]["value"] = 5
+
+        optimized = workflow_optimizer.optimize_workflow(workflow)
+
+        self.assertEqual(optimized["30"]["inputs"]["image"], ["20", 0])
+        self.assertEqual(optimized["20"], WORKFLOW["20"])
+
+    def test_keeps_only_what_the_output_classes_depend_on(self):
+        workflow = {
+            **WORKFLOW,
+            "50": {"inputs": {"images": ["10", 0]}, "class_type": "PreviewImage"},
+        }
+
+        self.assertIn("50", workflow_optimizer.optimize_workflow(workflow))
+        self.assertNotIn("50", workflow_optimizer.optimize_workflow(workflow, {"SaveImage"}))
+
+    def test_prunes_the_jasper_workflow(self):
+        path = os.path.join(
+            os.path.dirname(__file__), "..", "JasperAI_Runpod_Final_ColorTest_New_API_V2.json"
+        )
+        with open(path) as workflow_file:
+            workflow = json.load(workflow_file)
+
+        optimized = workflow_optimizer.optimize_workflow(workflow)
+
+        classes = [node["class_type"] for node in optimized.values()]
+        self.assertNotIn("ImpactSwitch", classes)
+        self.assertNotIn("ImageMaskSwitch", classes)
+        self.assertLess(classes.count("LoadImage"), 10)
+        self.assertIn("72", optimized)
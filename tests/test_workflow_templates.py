@@ -0,0 +1,82 @@
+import unittest
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+# Make sure that "src" is known and can be used to import workflow_templates.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import workflow_templates
+from workflow_bindings import BindingError
+
+WORKFLOW = {
+    "552": {"inputs": {"value": 1}, "class_type": "INTConstant"},
+    "9": {"inputs": {"images": ["8", 0]}, "class_type": "SaveImage"},
+}
+
+
+class TestWorkflowTemplates(unittest.TestCase):
+    def setUp(self):
+        self.image = tempfile.mkdtemp()
+        self.volume = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.image)
+        self.addCleanup(shutil.rmtree, self.volume)
+        self.templates = workflow_templates.WorkflowTemplates([self.image, self.volume])
+
+    def add_template(self, root, name, version, workflow=WORKFLOW):
+        os.makedirs(os.path.join(root, name), exist_ok=True)
+        with open(os.path.join(root, name, f"{version}.json"), "w") as template_file:
+            json.dump(workflow, template_file)
+
+    def test_latest_version_is_used_by_default(self):
+        self.add_template(self.image, "jasper-color", "2", {"v": 2})
+        self.add_template(self.image, "jasper-color", "10", {"v": 10})
+
+        self.assertEqual(self.templates.get("jasper-color"), {"v": 10})
+        self.assertEqual(self.templates.get("jasper-color@2"), {"v": 2})
+        self.assertEqual(self.templates.available(), {"jasper-color": ["2", "10"]})
+
+    def test_earlier_roots_win_and_later_ones_are_rescanned(self):
+        self.add_template(self.image, "jasper-color", "2", {"from": "image"})
+        self.add_template(self.volume, "jasper-color", "2", {"from": "volume"})
+        self.assertEqual(self.templates.get("jasper-color@2"), {"from": "image"})
+
+        # Added to the network volume while the worker is running
+        self.add_template(self.volume, "jasper-token", "1")
+        self.assertEqual(self.templates.get("jasper-token@1"), WORKFLOW)
+
+    def test_template_is_parsed_once(self):
+        self.add_template(self.image, "jasper-color", "2")
+
+        self.assertIs(self.templates.get("jasper-color"), self.templates.get("jasper-color@2"))
+
+    def test_unknown_and_invalid_templates(self):
+        with self.assertRaisesRegex(workflow_templates.TemplateError, "Unknown template"):
+            self.templates.get("missing")
+        with self.assertRaisesRegex(workflow_templates.TemplateError, "Invalid template"):
+            self.templates.get("../etc@1")
+
+    def test_expand_copies_only_the_changed_nodes(self):
+        self.add_template(self.image, "jasper-color", "2")
+        template = self.templates.get("jasper-color")
+
+        workflow = self.templates.expand("jasper-color", {"552": {"value": 3}})
+
+        self.assertEqual(workflow["552"]["inputs"]["value"], 3)
+        self.assertEqual(template["552"]["inputs"]["value"], 1)
+        self.assertIs(workflow["9"], template["9"])
+
+    def test_expand_applies_params_and_rules(self):
+        self.add_template(self.image, "jasper-color", "2")
+        with open(os.path.join(self.image, "jasper-color", "2.rules.json"), "w") as rules_file:
+            json.dump({"552": "int(552)"}, rules_file)
+
+        with self.assertRaisesRegex(BindingError, "no binding '1.value'"):
+            self.templates.expand("jasper-color", {"1": {"value": 3}})
+        self.assertEqual(self.templates.expand("jasper-color")["552"]["inputs"]["value"], 1)
+        # The rules file is not a version of its own
+        self.assertEqual(self.templates.available(), {"jasper-color": ["2"]})
+
+if __name__ == "__main__":
+    unittest.main()
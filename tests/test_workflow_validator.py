@@ -0,0 +1,142 @@
+import unittest
+import os
+import sys
+from unittest.mock import MagicMock, patch
+
+# Make sure that "src" is known and can be used to import workflow_validator.py
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "src")))
+from src import workflow_validator
+
+OBJECT_INFO = {
+    "CheckpointLoaderSimple": {
+        "input": {"required": {"ckpt_name": [["sdxl.safetensors", "sd15.safetensors"]]}},
+        "output": ["MODEL", "CLIP", "VAE"],
+    },
+    "LoadImage": {
+        "input": {"required": {"image": [["a.png"], {"image_upload": True}]}},
+        "output": ["IMAGE", "MASK"],
+    },
+    "VAEDecode": {
+        "input": {"required": {"samples": ["LATENT"], "vae": ["VAE"]}},
+        "output": ["IMAGE"],
+    },
+    "SaveImage": {
+        "input": {
+            "required": {"images": ["IMAGE"], "filename_prefix": ["STRING", {"default": "ComfyUI"}]}
+        },
+        "output": [],
+        "output_node": True,
+    },
+    "PreviewAny": {
+        "input": {"required": {"source": ["*"]}, "optional": {"mode": ["COMBO", {"options": ["a", "b"]}]}},
+        "output": [],
+        "output_node": True,
+    },
+}
+
+WORKFLOW = {
+    "4": {"inputs": {"ckpt_name": "sdxl.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+    "10": {"inputs": {"image": "uploaded-by-the-job.png"}, "class_type": "LoadImage"},
+    "9": {
+        "inputs": {"filename_prefix": "ComfyUI", "images": ["10", 0]},
+        "class_type": "SaveImage",
+        "_meta": {"title": "Save"},
+    },
+    "11": {"inputs": {"source": ["4", 2], "mode": "a"}, "class_type": "PreviewAny"},
+}
+
+
+class TestWorkflowValidator(unittest.TestCase):
+    def make_validator(self, **kwargs):
+        fetch = MagicMock(return_value=OBJECT_INFO)
+        return workflow_validator.WorkflowValidator(fetch, **kwargs), fetch
+
+    def test_accepts_a_valid_workflow(self):
+        validator, fetch = self.make_validator()
+
+        self.assertEqual(validator.validate(WORKFLOW), [])
+        self.assertEqual(validator.output_classes(), {"SaveImage", "PreviewAny"})
+        fetch.assert_called_once()
+
+    def test_lists_every_error(self):
+        validator, _ = self.make_validator()
+        workflow = {
+            **WORKFLOW,
+            "4": {"inputs": {"ckpt_name": "missing.safetensors"}, "class_type": "CheckpointLoaderSimple"},
+            "9": {"inputs": {"images": ["4", 0]}, "class_type": "SaveImage", "_meta": {"title": "Save"}},
+            "11": {"inputs": {"source": ["12", 0], "mode": "c"}, "class_type": "PreviewAny"},
+            "12": {"inputs": {}, "class_type": "FancyNode"},
+            "13": {"inputs": {"images": ["4", 5]}, "class_type": "SaveImage"},
+        }
+
+        errors = validator.validate(workflow)
+
+        self.assertCountEqual(
+            errors,
+            [
+                "Node 9 (Save): required input 'filename_prefix' is missing",
+                "Node 9 (Save): input 'images' expects IMAGE, but Node 4 (CheckpointLoaderSimple) returns MODEL",
+                "Node 4 (CheckpointLoaderSimple): 'missing.safetensors' is not a valid value for 'ckpt_name', "
+                "expected one of 'sdxl.safetensors', 'sd15.safetensors'",
+                "Node 11 (PreviewAny): 'c' is not a valid value for 'mode', expected one of 'a', 'b'",
+                "Node 12 (FancyNode): unknown node type 'FancyNode'",
+                "Node 13 (SaveImage): required input 'filename_prefix' is missing",
+                "Node 13 (SaveImage): input 'images' links to output 5 of Node 4 (CheckpointLoaderSimple), "
+                "which has 3 outputs",
+            ],
+        )
+
+    def test_only_checks_what_the_outputs_depend_on(self):
+        validator, _ = self.make_validator()
+        workflow = {**WORKFLOW, "20": {"inputs": {}, "class_type": "FancyNode"}}
+
+        self.assertEqual(validator.validate(workflow), [])
+        self.assertEqual(
+            validator.validate({"4": WORKFLOW["4"]}), ["The workflow has no output nodes"]
+        )
+
+    def test_reports_links_to_missing_nodes(self):
+        validator, _ = self.make_validator()
+        workflow = {**WORKFLOW, "9": {**WORKFLOW["9"], "inputs": {"filename_prefix": "x", "images": ["99", 0]}}}
+
+        self.assertEqual(
+            validator.validate(workflow),
+            ["Node 9 (Save): input 'images' links to node 99, which is not in the workflow"],
+        )
+
+    def test_memoizes_results_by_workflow_hash(self):
+        validator, _ = self.make_validator()
+        reordered = dict(reversed(list(WORKFLOW.items())))
+
+        with patch.object(validator, "check", wraps=validator.check) as mock_check:
+            validator.validate(WORKFLOW)
+            validator.validate(reordered)
+
+        mock_check.assert_called_once()
+
+    def test_fetches_again_when_the_custom_nodes_change(self):
+        fingerprint = MagicMock(return_value=("a", 1))
+        validator, fetch = self.make_validator(fingerprint=fingerprint)
+
+        validator.validate(WORKFLOW)
+        validator.validate(WORKFLOW)
+        fingerprint.return_value = ("a", 2)
+        validator.validate(WORKFLOW)
+
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_failed_workflows_fetch_again_once_the_definitions_are_old(self):
+        validator, fetch = self.make_validator(refresh_interval=0)
+        workflow = {**WORKFLOW, "12": {"inputs": {}, "class_type": "FancyNode"}}
+        workflow["9"] = {**WORKFLOW["9"], "inputs": {"filename_prefix": "x", "images": ["12", 0]}}
+        fetch.side_effect = [
+            OBJECT_INFO,
+            {**OBJECT_INFO, "FancyNode": {"input": {}, "output": ["IMAGE"]}},
+        ]
+
+        self.assertEqual(validator.validate(workflow), [])
+        self.assertEqual(fetch.call_count, 2)
+
+
+if __name__ == "__main__":
+    unittest.main()